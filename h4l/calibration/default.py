@@ -11,6 +11,7 @@ from columnflow.production.cms.seeds import deterministic_seeds
 from columnflow.util import maybe_import
 
 from h4l.calibration.jets import jet_energy, jet_lepton_cleaner
+from h4l.util import instrument_step
 
 ak = maybe_import("awkward")
 
@@ -21,9 +22,12 @@ ak = maybe_import("awkward")
 )
 def default(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array:
     if self.dataset_inst.is_mc:
-       events = self[mc_weight](events, **kwargs)
-    events = self[deterministic_seeds](events, **kwargs)
-    events = self[jets](events, **kwargs)
+        with instrument_step(self, "mc_weight", events, **kwargs):
+            events = self[mc_weight](events, **kwargs)
+    with instrument_step(self, "deterministic_seeds", events, **kwargs):
+        events = self[deterministic_seeds](events, **kwargs)
+    with instrument_step(self, "jets", events, **kwargs):
+        events = self[jets](events, **kwargs)
 
     return events
 
@@ -35,11 +39,14 @@ def default(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array:
 def skip_jecunc(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array:
     """ only uses jec_nominal for test purposes """
     if self.dataset_inst.is_mc:
-          events = self[mc_weight](events, **kwargs)
-    # from IPython import embed; embed()
-    events = self[deterministic_seeds](events, **kwargs)
-    events = self[jet_lepton_cleaner](events, **kwargs)
-    events = self[jet_energy](events, **kwargs)
+        with instrument_step(self, "mc_weight", events, **kwargs):
+            events = self[mc_weight](events, **kwargs)
+    with instrument_step(self, "deterministic_seeds", events, **kwargs):
+        events = self[deterministic_seeds](events, **kwargs)
+    with instrument_step(self, "jet_lepton_cleaner", events, **kwargs):
+        events = self[jet_lepton_cleaner](events, **kwargs)
+    with instrument_step(self, "jet_energy", events, **kwargs):
+        events = self[jet_energy](events, **kwargs)
 
     return events
 
@@ -51,8 +58,11 @@ def skip_jecunc(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array:
 def skip_jecunc_wo_cleaner(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array:
     """ only uses jec_nominal for test purposes """
     if self.dataset_inst.is_mc:
-        events = self[mc_weight](events, **kwargs)
-    events = self[deterministic_seeds](events, **kwargs)
-    events = self[jet_energy](events, **kwargs)
+        with instrument_step(self, "mc_weight", events, **kwargs):
+            events = self[mc_weight](events, **kwargs)
+    with instrument_step(self, "deterministic_seeds", events, **kwargs):
+        events = self[deterministic_seeds](events, **kwargs)
+    with instrument_step(self, "jet_energy", events, **kwargs):
+        events = self[jet_energy](events, **kwargs)
 
     return events
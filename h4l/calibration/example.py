@@ -9,34 +9,85 @@ from columnflow.production.cms.seeds import deterministic_seeds
 from columnflow.util import maybe_import
 from columnflow.columnar_util import set_ak_column
 
+from h4l.util import jagged_ufunc, counter_random, compute_dtype
+from h4l.calibration.jets import variation_unc_field
+
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
 
 @calibrator(
     uses={deterministic_seeds, "Jet.{pt,eta,phi,mass}"},
-    produces={deterministic_seeds, "Jet.{pt,mass}{,_jec_up,_jec_down}"},
+    produces={deterministic_seeds, "Jet.{pt,mass}"},
+    # fake relative JEC uncertainties per source
+    variation_sources={"jec": 0.05},
+    # how variations are stored, "flat": as shifted copies Jet.{pt,mass}_<source>_{up,down},
+    # "ratios": as relative uncertainties Jet.<source>_unc only (see h4l.calibration.jets)
+    variation_mode="flat",
+    # fake relative jet resolution for a stochastic smearing of Jet.{pt,mass}, disabled when None
+    smearing_resolution=None,
 )
 def example(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array:
     # a) "correct" Jet.pt by scaling four momenta by 1.1 (pt<30) or 0.9 (pt<=30)
-    # b) add 4 new columns faking the effect of JEC variations
+    # b) optionally smear four momenta with a fake resolution
+    # c) add columns faking the effect of JEC variations, based on the smeared four momenta
 
-    # add deterministic seeds that could (e.g.) be used for smearings
+    # add deterministic seeds used for smearings
     events = self[deterministic_seeds](events, **kwargs)
 
     # a)
-    pt_mask = ak.flatten(events.Jet.pt < 30)
-    n_jet_pt = np.asarray(ak.flatten(events.Jet.pt))
-    n_jet_mass = np.asarray(ak.flatten(events.Jet.mass))
-    n_jet_pt[pt_mask] *= 1.1
-    n_jet_pt[~pt_mask] *= 0.9
-    n_jet_mass[pt_mask] *= 1.1
-    n_jet_mass[~pt_mask] *= 0.9
+    # (scaled into a single new buffer per column, see jagged_ufunc)
+    pt_mask = events.Jet.pt < 30
+    for var in ["pt", "mass"]:
+        values = jagged_ufunc(events.Jet[var], np.multiply, 1.1, mask=pt_mask, inplace=False)
+        values = jagged_ufunc(values, np.multiply, 0.9, mask=~pt_mask, inplace=True)
+        events = set_ak_column(events, f"Jet.{var}", values)
 
     # b)
-    events = set_ak_column(events, "Jet.pt_jec_up", events.Jet.pt * 1.05)
-    events = set_ak_column(events, "Jet.mass_jec_up", events.Jet.mass * 1.05)
-    events = set_ak_column(events, "Jet.pt_jec_down", events.Jet.pt * 0.95)
-    events = set_ak_column(events, "Jet.mass_jec_down", events.Jet.mass * 0.95)
+    if self.smearing_resolution:
+        # one normal variate per jet, reproducible independent of chunking (see counter_random)
+        rnd = counter_random(
+            events.deterministic_seed,
+            events.Jet,
+            stream=1,
+            distribution="normal",
+            dtype=compute_dtype(self.config_inst),
+        )
+        smear = np.maximum(1 + self.smearing_resolution * rnd, 0)
+        for var in ["pt", "mass"]:
+            values = jagged_ufunc(events.Jet[var], np.multiply, smear, inplace=False)
+            events = set_ak_column(events, f"Jet.{var}", values)
+
+    # c)
+    if self.variation_mode == "ratios":
+        # one relative uncertainty per source, evaluated once for all variations and fields
+        for source, unc in self.variation_sources.items():
+            values = ak.full_like(events.Jet.pt, unc, dtype=np.float32)
+            events = set_ak_column(events, f"Jet.{variation_unc_field(source)}", values)
+    else:
+        # (new columns are written into a single new buffer each)
+        for source, unc in self.variation_sources.items():
+            for var in ["pt", "mass"]:
+                for direction, factor in [("up", 1 + unc), ("down", 1 - unc)]:
+                    values = jagged_ufunc(events.Jet[var], np.multiply, factor, inplace=False)
+                    events = set_ak_column(events, f"Jet.{var}_{source}_{direction}", values)
 
     return events
+
+
+@example.init
+def example_init(self: Calibrator) -> None:
+    if self.variation_mode == "ratios":
+        self.produces |= {f"Jet.{variation_unc_field(source)}" for source in self.variation_sources}
+    else:
+        self.produces |= {
+            f"Jet.{var}_{source}_{direction}"
+            for source in self.variation_sources
+            for var in ["pt", "mass"]
+            for direction in ["up", "down"]
+        }
+
+
+# same as example, but storing only the relative uncertainties from which the shifted columns are
+# created on demand
+example_ratios = example.derive("example_ratios", cls_dict={"variation_mode": "ratios"})
@@ -2,16 +2,26 @@
 
 """
 Custom jet energy calibration methods that disable data uncertainties (for searches).
+
+Calibrators can store systematic variations of jet columns in a compact form, i.e., as a single
+relative uncertainty ``<source>_unc`` per jet and uncertainty source rather than as flat, shifted
+copies ``<field>_<source>_{up,down}`` of all affected columns. The flat columns are then created
+on demand by :py:func:`add_variation_columns`, and only for the requested shift. This is done by
+the :py:func:`h4l.production.jets.variation_columns` producer which is invoked by the h4l selector
+and reducer, i.e., in the tasks that apply shift aliases to calibrated columns.
 """
 
+from __future__ import annotations
+
+import math
+
 from columnflow.calibration import Calibrator, calibrator
 from columnflow.calibration.cms.jets import jec, jer
+from columnflow.types import Iterable
 from columnflow.util import maybe_import
-from columnflow.production.util import attach_coffea_behavior
-from columnflow.columnar_util import set_ak_column
+from columnflow.columnar_util import Route, set_ak_column, has_ak_column
 
-# TODO: Define in util if we want to use this
-from h4l.util import lv_xyzt, lv_mass
+from h4l.util import njit, jagged_buffer, jagged_ufunc, compute_dtype
 
 
 ak = maybe_import("awkward")
@@ -51,16 +61,165 @@ def jet_energy_init(self: Calibrator) -> None:
         self.produces |= {jec_nominal}
 
 
+def variation_unc_field(source: str) -> str:
+    """
+    Returns the name of the field that holds the relative uncertainty of the variation *source*.
+    """
+    return f"{source}_unc"
+
+
+def variation_routes(route: Route | str) -> list[tuple[Route, Route, float]]:
+    """
+    Returns all candidates for the nominal column and the relative uncertainty from which the flat
+    variation column *route* (e.g. ``Jet.pt_jec_up``) can be computed, as well as the sign of the
+    variation, e.g. ``(Route("Jet.pt"), Route("Jet.jec_unc"), 1.0)``. As both the field and the
+    source can contain underscores, all splits are returned. Routes that do not end in ``_up`` or
+    ``_down`` result in an empty list.
+    """
+    *parent, name = Route(route).fields
+    stem, _, direction = name.rpartition("_")
+    if direction not in ("up", "down"):
+        return []
+
+    sign = 1.0 if direction == "up" else -1.0
+    parts = stem.split("_")
+    return [
+        (
+            Route(parent + ["_".join(parts[:i])]),
+            Route(parent + [variation_unc_field("_".join(parts[i:]))]),
+            sign,
+        )
+        for i in range(1, len(parts))
+    ]
+
+
+def add_variation_columns(events: ak.Array, routes: Iterable[Route | str]) -> ak.Array:
+    """
+    Creates the flat variation columns in *routes*, e.g. ``Jet.pt_jec_up``, that are missing in
+    *events* but can be computed from the nominal column (``Jet.pt``) and the relative uncertainty
+    of the source (``Jet.jec_unc``, see :py:func:`variation_routes`) as ``nominal * (1 +/- unc)``.
+    All other routes are ignored.
+    """
+    for route in map(Route, routes):
+        if has_ak_column(events, route):
+            continue
+
+        for nominal, unc, sign in variation_routes(route):
+            if has_ak_column(events, nominal) and has_ak_column(events, unc):
+                values = nominal.apply(events) * (1.0 + sign * unc.apply(events))
+                events = set_ak_column(events, route, values, value_type=np.float32)
+                break
+
+    return events
+
+
+@njit(cache=True)
+def _eta(x, y, z):
+    pt = math.sqrt(x**2 + y**2)
+    return math.asinh(z / pt) if pt > 0 else math.nan
+
+
+@njit(cache=True)
+def _xyzt(kin, k):
+    # cartesian four-vector from pt, eta, phi and mass in kin[:, k], in double precision regardless
+    # of the dtype of *kin*, as masses of cleaned jets suffer from cancellation
+    pt, eta, phi, mass = (np.float64(kin[0, k]), np.float64(kin[1, k]), np.float64(kin[2, k]), np.float64(kin[3, k]))
+    z = pt * math.sinh(eta)
+    return pt * math.cos(phi), pt * math.sin(phi), z, math.sqrt(pt**2 + z**2 + mass**2)
+
+
+@njit(cache=True)
+def _clean_jets(
+    jet_event, kin, mu_ef, ch_em_ef, lep_idx,
+    e_offsets, e_kin, m_offsets, m_kin, tolerance, out,
+):
+    """
+    Subtracts the leptons matched to each jet from its four-vector in the order of the slots in
+    *lep_idx* (electronIdx1, electronIdx2, muonIdx1, muonIdx2), and writes the resulting pt, eta,
+    phi and mass into *out*. Jet and lepton kinematics *kin*, *e_kin* and *m_kin* are given as
+    arrays of shape (4, n) of pt, eta, phi and mass, and converted to cartesian four-vectors in
+    double precision registers only. All jet arrays can refer to an arbitrary subset of jets, with
+    *jet_event* being the index of their events.
+    """
+    for j in range(len(jet_event)):
+        i = jet_event[j]
+        n_e = e_offsets[i + 1] - e_offsets[i]
+        n_m = m_offsets[i + 1] - m_offsets[i]
+        x, y, z, t = _xyzt(kin, j)
+
+        # total energy from clustered leptonic PF candidates
+        pf_e = t * ch_em_ef[j]
+        pf_mu = t * mu_ef[j]
+
+        for slot in range(4):
+            idx = lep_idx[slot, j]
+            is_mu = slot >= 2
+            if idx < 0 or idx >= (n_m if is_mu else n_e):
+                continue
+            if is_mu:
+                lx, ly, lz, lt = _xyzt(m_kin, m_offsets[i] + idx)
+                pf = pf_mu
+            else:
+                lx, ly, lz, lt = _xyzt(e_kin, e_offsets[i] + idx)
+                pf = pf_e
+            cx, cy, cz, ct = x - lx, y - ly, z - lz, t - lt
+
+            # lepton energy compatible with PF energy fraction (within tolerance)
+            if not lt < (1 + tolerance) * pf:
+                continue
+
+            # cleaning does not result in a negative mass (unless only within tolerance, which
+            # is likely a lepton fake)
+            if ct**2 - (cx**2 + cy**2 + cz**2) < -tolerance:
+                continue
+
+            # angle before/after cleaning is similar or the cleaned pt is very low (likely a
+            # lepton fake), see the description of method 1 in jet_lepton_cleaner
+            if math.sqrt(cx**2 + cy**2) >= 10:
+                dphi = (math.atan2(cy, cx) - math.atan2(y, x) + math.pi) % (2 * math.pi) - math.pi
+                deta = _eta(cx, cy, cz) - _eta(x, y, z)
+                if not math.sqrt(deta**2 + dphi**2) <= math.pi / 2:
+                    continue
+
+            # update jet four-vector and PF energies
+            x, y, z, t = cx, cy, cz, ct
+            if is_mu:
+                pf_mu -= lt
+            else:
+                pf_e -= lt
+
+        # convert back to pt, eta, phi and mass, ensuring finite values
+        pt = math.sqrt(x**2 + y**2)
+        out[0, j] = pt
+        out[1, j] = math.asinh(z / pt) if pt > 0 else 0.0
+        out[2, j] = math.atan2(y, x)
+        out[3, j] = math.sqrt(max(t**2 - pt**2 - z**2, 0.0))
+
+
+def _flat(array: ak.Array) -> np.ndarray:
+    return np.asarray(ak.flatten(array, axis=1))
+
+
+def _flat_kin(pt, eta, phi, mass, dtype: np.dtype) -> np.ndarray:
+    # flat (4, n) array of pt, eta, phi and mass
+    return np.stack([np.asarray(arr, dtype=dtype) for arr in [pt, eta, phi, mass]])
+
+
+def _offsets(objects: ak.Array) -> np.ndarray:
+    offsets = np.zeros(len(objects) + 1, dtype=np.int64)
+    np.cumsum(ak.num(objects, axis=1), out=offsets[1:])
+    return offsets
+
+
 @calibrator(
     uses={
         "Electron.{pt,eta,phi,mass}",
         "Muon.{pt,eta,phi,mass}",
-        "Jet.{pt,eta,phi,mass}",
+        "Jet.{pt,eta,phi,mass,rawFactor}",
         # index of electrons/muons matched to jets
         "Jet.{muonIdx1,muonIdx2,electronIdx1,electronIdx2}",
         # PF energy fractions
         "Jet.{chEmEF,muEF}",
-        attach_coffea_behavior,
     },
     produces={
         "Jet.{pt,eta,phi,mass,rawFactor}",
@@ -69,128 +228,76 @@ def jet_energy_init(self: Calibrator) -> None:
 )
 def jet_lepton_cleaner(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array:
     """
-    Calibrator to clean jet four-vectors from contributions from nearby leptons
-    """
+    Calibrator to clean jet four-vectors from contributions from nearby leptons.
 
-    # load coffea behaviors for simplified arithmetic with vectors
-    events["Electron"] = ak.with_name(events.Electron, "PtEtaPhiMLorentzVector")
-    events["Muon"] = ak.with_name(events.Muon, "PtEtaPhiMLorentzVector")
-    events["Jet"] = ak.with_name(events.Jet, "PtEtaPhiMLorentzVector")
+    JECs are reverted first (and the correction factor set to 0). Then, for each jet, the matched
+    leptons are subtracted in the order electronIdx1, electronIdx2, muonIdx1, muonIdx2, as long as
 
-    # revert JEC for jet pt and jet mass,
-    # set correction factor to 0
-    events = set_ak_column(events, "Jet.pt", events.Jet.pt * (1 - events.Jet.rawFactor))
-    events = set_ak_column(events, "Jet.mass", events.Jet.mass * (1 - events.Jet.rawFactor))
-    events = set_ak_column(events, "Jet.rawFactor", 0)
+        - the lepton energy is compatible with the electron or muon PF energy of the jet (within a
+          relative tolerance of 10%, reduced by leptons of the same type subtracted before),
+        - the cleaned jet mass squared is not below -tolerance (0.1 GeV^2), and
+        - the angle before/after cleaning is similar (delta_r <= pi / 2), or the cleaned pt is
+          below 10 GeV (high probablility that this was a lepton fake).
 
-    # build jet lorentz vectors
-    jet_lv = lv_xyzt(events.Jet)
-
-    # create arrays with indices of leptons that are matched to jet,
-    # not if no matched lepton
-    idx_e1 = ak.mask(events.Jet.electronIdx1, events.Jet.electronIdx1 >= 0)
-    idx_e2 = ak.mask(events.Jet.electronIdx2, events.Jet.electronIdx2 >= 0)
-    idx_m1 = ak.mask(events.Jet.muonIdx1, events.Jet.muonIdx1 >= 0)
-    idx_m2 = ak.mask(events.Jet.muonIdx2, events.Jet.muonIdx2 >= 0)
-
-    # list with matched leptons
-    jet_leptons_types = [
-        (events.Electron[idx_e1], "e"),
-        (events.Electron[idx_e2], "e"),
-        (events.Muon[idx_m1], "mu"),
-        (events.Muon[idx_m2], "mu"),
-    ]
+    All steps are performed in a single compiled pass over the flat buffers of the (usually few)
+    jets with at least one matched lepton, whose results are written into new flat jet buffers.
+    The input columns are not modified. Kinematics are read with the configured compute_dtype (see
+    :py:func:`h4l.util.compute_dtype`), and the subtraction is done in double precision registers.
 
-    # total energy from clustered leptonic PF candidates
-    jet_pf_energies = {
-      "mu": jet_lv.energy * events.Jet.muEF,
-      "e": jet_lv.energy * events.Jet.chEmEF,
+    Note: a pt-dependent heuristic for the maximum angle difference could increase the allowed
+    angle difference for low-pt jets in order to catch pure lepton fakes whose direction after
+    cleaning is dominated by resolution effects. It is not used for now.
+    """
+    jets = events.Jet
+    jet_offsets = _offsets(jets)
+
+    # revert JECs on all jets, writing into new buffers (see jagged_ufunc)
+    raw_scale = 1 - _flat(jets.rawFactor)
+    jet_columns = {
+        var: jagged_ufunc(jets[var], np.multiply, raw_scale)
+        for var in ["pt", "mass"]
     }
-    # subtract lepton contributions from jets
-    tolerance = 0.1
-    for jet_lepton, jet_lepton_type in jet_leptons_types:
-        jet_lepton_lv = lv_xyzt(jet_lepton)
-        jet_lv_cleaned = lv_xyzt(jet_lv - jet_lepton_lv)
-        jet_pf_energy = jet_pf_energies[jet_lepton_type]
-        jet_pf_energy_cleaned = jet_pf_energy - jet_lepton_lv.energy
-        # only perform the cleaning of the current lepton
-        # if the following conditions are met
-
-        # lepton energy compatible with PF energy fraction (within tolerance)
-        lep_energy_pf_compatible = (jet_lepton_lv.energy < (1 + tolerance) * jet_pf_energy)
-
-        # calculate square of cleaned jet mass
-        jet_lv_cleaned_mass_sq = jet_lv_cleaned.energy**2 - jet_lv_cleaned.rho**2
-        # mask values that would lead to imaginary masses,
-        # but substitute absolute value if the mass square is only negative within
-        # tolerance (high probablility that this was a lepton fake)
-        jet_lv_cleaned_mass = ak.mask(
-            np.sqrt(abs(jet_lv_cleaned_mass_sq)),
-            jet_lv_cleaned_mass_sq >= -tolerance,
-        )
-        # cleaning does not result in a negative/imaginary/undefined mass
-        mass_stays_positive = ~ak.is_none(jet_lv_cleaned_mass, axis=1)
-
-        # angle before/after cleaning is similar (delta_r < max_angle_diff)
-        #
-        # note: we use a pt-dependent heuristic for `max_angle_diff` to increase the
-        # allowed angle difference for low-pt jets. The reason is to catch the cases
-        # where the jet is a pure lepton fake (i.e. consists of only one lepton). Since
-        # the resulting momentum after the cleaning is close to zero in this case, the
-        # angle may change sign due to resolution effects. We want to clean these jets as
-        # well, so if the jet pt after cleaning is below a chosen threshold `ref_pt`, we
-        # calculate the maximum angle difference as a function ~1/pt, reaching the maximum
-        # value `np.pi` when extrapolating towards pt = 0.
-
-        #
-        # method 1: fixed threshold
-        #
-        # clean only if angle difference below fixed threshold OR the cleaned pt is very low
-        # (high probablility that this was a lepton fake)
-        angle_change_small = (
-            (jet_lv.delta_r(jet_lv_cleaned) <= np.pi / 2) |
-            (jet_lv_cleaned.pt < 10)
-        )
 
-        #
-        # method 2: heuristic (needs tweaking)
-        #
-
-        # # tweakable parameters
-        # ref_pt = 30.  # pt below which heuristic is active
-        # ref_angle = np.pi / 2  # constant max angle difference at (pt > = ref_pt)
-
-        # # calculate maximum allowed angle difference using heuristic below `ref_pt`
-        # pt_scale = (ref_angle * ref_pt) / (np.pi - ref_angle)
-        # max_angle_diff = np.pi * pt_scale / (jet_lv_cleaned.pt + pt_scale)
-        # max_angle_diff = ak.where(jet_lv_cleaned.pt > ref_pt, ref_angle, max_angle_diff)
-
-        # # clean only if angle difference passes the check
-        # angle_change_small = jet_lv.delta_phi(jet_lv_cleaned) <= max_angle_diff
-
-        # AND of cleaning conditions
-        do_clean = mass_stays_positive & angle_change_small & lep_energy_pf_compatible
-        # `None` if no matched lepton -> no cleaning
-        do_clean = ak.fill_none(do_clean, False)
-        # update jet LV
-        jet_lv = ak.where(
-            do_clean,
-            jet_lv_cleaned,
-            jet_lv,
-        )
-        # update jet PF energies
-        jet_pf_energies[jet_lepton_type] = ak.where(
-            do_clean,
-            jet_pf_energy_cleaned,
-            jet_pf_energy,
+    # matched lepton indices in the order of subtraction
+    lep_idx = np.stack([
+        _flat(jets[f"{lep}Idx{i}"]).astype(np.int64)
+        for lep in ["electron", "muon"]
+        for i in [1, 2]
+    ])
+
+    # only jets with at least one matched lepton need to be cleaned
+    sel = np.flatnonzero((lep_idx >= 0).any(axis=0))
+    if len(sel):
+        # writable views of the new pt and mass buffers, and of copies of the eta and phi buffers
+        # (see jagged_buffer)
+        jet_columns["pt"], pt = jagged_buffer(jet_columns["pt"], inplace=True)
+        jet_columns["mass"], mass = jagged_buffer(jet_columns["mass"], inplace=True)
+        jet_columns["eta"], eta = jagged_buffer(jets.eta)
+        jet_columns["phi"], phi = jagged_buffer(jets.phi)
+
+        dtype = compute_dtype(self.config_inst)
+        out = np.empty((4, len(sel)), dtype=dtype)
+        _clean_jets(
+            np.searchsorted(jet_offsets, sel, side="right") - 1,
+            _flat_kin(pt[sel], eta[sel], phi[sel], mass[sel], dtype),
+            _flat(jets.muEF)[sel].astype(dtype),
+            _flat(jets.chEmEF)[sel].astype(dtype),
+            lep_idx[:, sel],
+            _offsets(events.Electron),
+            _flat_kin(*(_flat(events.Electron[var]) for var in ["pt", "eta", "phi", "mass"]), dtype),
+            _offsets(events.Muon),
+            _flat_kin(*(_flat(events.Muon[var]) for var in ["pt", "eta", "phi", "mass"]), dtype),
+            0.1,
+            out,
         )
 
+        # write into the new buffers, leaving all other jets untouched
+        for i, buffer in enumerate([pt, eta, phi, mass]):
+            buffer[sel] = out[i]
+
     # save updated jet variables
-    jet_lv = lv_mass(jet_lv)
-    for var in ["pt", "eta", "phi", "mass"]:
-        # ensure no missing values
-        value = ak.fill_none(ak.nan_to_none(getattr(jet_lv, var)), 0.0)
-        value = ak.where(np.isfinite(value), value, 0)
-        events = set_ak_column(events, f"Jet.{var}", value)
+    for var, values in jet_columns.items():
+        events = set_ak_column(events, f"Jet.{var}", values)
+    events = set_ak_column(events, "Jet.rawFactor", 0)
 
     return events
@@ -2,40 +2,102 @@
 
 """
 H4L Categorization methods.
+
+All leaf categories are evaluated in a single pass by :py:func:`category_bits`, which computes
+their shared inputs (e.g. lepton multiplicities) once per chunk and stores the result of each leaf
+as one bit of the per-event integer column ``category_bits``. The categorizers used in category
+definitions are thin views testing bits of this column, so that adding a category does not add
+another pass over the events.
 """
 
+from __future__ import annotations
+
 from columnflow.categorization import Categorizer, categorizer
+from columnflow.production import Producer, producer
+from columnflow.types import Callable
 from columnflow.util import maybe_import
+from columnflow.columnar_util import set_ak_column, has_ak_column
 
+np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
 
+#
+# shared inputs and leaf categories
+#
+
+def category_inputs(events: ak.Array) -> dict[str, np.ndarray]:
+    """
+    Returns the inputs shared by all leaf categories in :py:data:`leaf_categories` as flat arrays
+    with one entry per event.
+    """
+    return {
+        "n_electron": np.asarray(ak.num(events.Electron, axis=1)),
+        "n_muon": np.asarray(ak.num(events.Muon, axis=1)),
+        "n_jet": np.asarray(ak.num(events.Jet, axis=1)),
+    }
+
+
+# functions of the shared inputs returning event masks per leaf category, with the position of
+# each entry defining its bit in category_bits (new leaves should be appended)
+leaf_categories: dict[str, Callable[[dict[str, np.ndarray]], np.ndarray]] = {
+    "4e": lambda inputs: (inputs["n_electron"] == 4) & (inputs["n_muon"] == 0),
+    "4mu": lambda inputs: (inputs["n_electron"] == 0) & (inputs["n_muon"] == 4),
+    "2e2mu": lambda inputs: (inputs["n_electron"] == 2) & (inputs["n_muon"] == 2),
+    "eq0j": lambda inputs: inputs["n_jet"] == 0,
+    "eq1j": lambda inputs: inputs["n_jet"] == 1,
+    "ge2j": lambda inputs: inputs["n_jet"] >= 2,
+}
+
+
+def category_mask(*leaves: str) -> int:
+    """
+    Returns the bitmask with the bits of all *leaves* (see :py:data:`leaf_categories`) set.
+    """
+    names = list(leaf_categories)
+    return sum(1 << names.index(leaf) for leaf in leaves)
+
+
+@producer(
+    uses={"{Electron,Muon,Jet}.pt"},
+    produces={"category_bits"},
+)
+def category_bits(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
+    """
+    Evaluates all :py:data:`leaf_categories` on inputs computed once, and stores their results as
+    bits of the ``category_bits`` column.
+    """
+    inputs = category_inputs(events)
+    bits = np.zeros(len(events), dtype=np.int64)
+    for bit, func in enumerate(leaf_categories.values()):
+        bits |= np.asarray(func(inputs), dtype=np.int64) << bit
+
+    return set_ak_column(events, "category_bits", bits, value_type=np.int64)
+
+
+def bitmask_categorizer(name: str, *leaves: str) -> Categorizer:
+    """
+    Creates a categorizer *name* selecting events in any of the *leaves*, testing the bits in
+    ``category_bits`` that are evaluated only when missing in the events array. The bitmask is
+    stored as ``category_mask`` class attribute, allowing
+    :py:func:`h4l.production.categories.category_ids` to skip the call entirely.
+    """
+    def call(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, np.ndarray]:
+        if not has_ak_column(events, "category_bits"):
+            events = self[category_bits](events, **kwargs)
+        return events, (np.asarray(events.category_bits) & self.category_mask) != 0
+
+    return categorizer(uses={category_bits}, cls_name=name, category_mask=category_mask(*leaves))(call)
+
+
 #
 # categorizer functions used by categories definitions
 #
 
-@categorizer(uses={"event"})
-def catid_incl(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak.Array]:
-      mask_4e = (ak.num(events.Electron, axis=-1) == 4) & (ak.num(events.Muon, axis=-1) == 0)
-      mask_4mu = (ak.num(events.Electron, axis=-1) == 0) & (ak.num(events.Muon, axis=-1) == 4)
-      mask_2e2mu = (ak.num(events.Electron, axis=-1) == 2) & (ak.num(events.Muon, axis=-1) == 2)
-      mask = mask_4e | mask_4mu | mask_2e2mu
-      return events, mask
-
-@categorizer(uses={"event"}, call_force=True)
-def catid_4e(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak.Array]:
-      mask = (ak.num(events.Electron, axis=-1) == 4) & (ak.num(events.Muon, axis=-1) == 0)
-      return events, mask
-
-# Task 1. Define categories for 4mu and 2e2mu
-# Hint: modify also config/categories.py
-
-@categorizer(uses={"event"}, call_force=True)
-def catid_4mu(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak.Array]:
-      mask = (ak.num(events.Electron, axis=-1) == 0) & (ak.num(events.Muon, axis=-1) == 4)
-      return events, mask
-
-@categorizer(uses={"event"}, call_force=True)
-def catid_2e2mu(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak.Array]:
-      mask = (ak.num(events.Electron, axis=-1) == 2) & (ak.num(events.Muon, axis=-1) == 2)
-      return events, mask
+catid_incl = bitmask_categorizer("catid_incl", "4e", "4mu", "2e2mu")
+catid_4e = bitmask_categorizer("catid_4e", "4e")
+catid_4mu = bitmask_categorizer("catid_4mu", "4mu")
+catid_2e2mu = bitmask_categorizer("catid_2e2mu", "2e2mu")
+catid_eq0j = bitmask_categorizer("catid_eq0j", "eq0j")
+catid_eq1j = bitmask_categorizer("catid_eq1j", "eq1j")
+catid_ge2j = bitmask_categorizer("catid_ge2j", "ge2j")
@@ -5,6 +5,8 @@ Collection of patches of underlying columnflow tasks.
 """
 
 import os
+import sys
+import json
 
 import law
 from columnflow.util import memoize
@@ -34,6 +36,75 @@ def patch_bundle_repo_exclude_files():
     logger.debug("patched exclude_files of cf.BundleRepo")
 
 
+@memoize
+def patch_uses_audit():
+    """
+    When enabled (see :py:func:`h4l.util.uses_audit_enabled`), audits the first call of each h4l
+    calibrator, selector and producer invoked by a task, reporting declared-but-unused and
+    used-but-undeclared columns via the logger and the sidecar file ``uses_audit_<branch>.jsonl``
+    in the output directory of the task.
+    """
+    from h4l.util import uses_audit_enabled
+
+    if not uses_audit_enabled():
+        return
+
+    from columnflow.columnar_util import TaskArrayFunction
+    from h4l.util import audit_uses
+
+    call_orig = TaskArrayFunction.__call__
+    audited = set()
+
+    def __call__(self, *args, **kwargs):
+        # only audit top-level calls (nested ones are flagged through _clear_cache) of h4l functions
+        module = getattr(type(self).call_func, "__module__", None) or ""
+        if (
+            "_clear_cache" in kwargs or
+            not args or
+            not module.startswith("h4l") or
+            self.cls_name in audited
+        ):
+            return call_orig(self, *args, **kwargs)
+        audited.add(self.cls_name)
+
+        invoke = lambda *_args, **_kwargs: call_orig(self, *_args, **_kwargs)
+        result, report = audit_uses(self, *args, invoke=invoke, **kwargs)
+        logger.info(f"uses audit of {self.cls_name}: {report}")
+
+        task = kwargs.get("task")
+        if task is not None:
+            path = task.local_path(f"uses_audit_{getattr(task, 'branch', -1)}.jsonl")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "a") as f:
+                f.write(json.dumps({"func": self.cls_name, **report}) + "\n")
+
+        return result
+
+    TaskArrayFunction.__call__ = __call__
+
+    logger.debug("patched TaskArrayFunction.__call__ to audit declared uses")
+
+
+@memoize
+def patch_load_correction_set():
+    """
+    Replaces :py:func:`columnflow.util.load_correction_set` with the process-wide cached version in
+    :py:func:`h4l.util.load_correction_set`, also in columnflow modules that imported it already.
+    """
+    import columnflow.util
+    from h4l.util import load_correction_set
+
+    load_orig = columnflow.util.load_correction_set
+    columnflow.util.load_correction_set = load_correction_set
+    for name, module in list(sys.modules.items()):
+        if name.startswith("columnflow.") and getattr(module, "load_correction_set", None) is load_orig:
+            module.load_correction_set = load_correction_set
+
+    logger.debug("patched columnflow.util.load_correction_set")
+
+
 @memoize
 def patch_all():
     patch_bundle_repo_exclude_files()
+    patch_uses_audit()
+    patch_load_correction_set()
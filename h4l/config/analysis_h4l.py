@@ -48,7 +48,11 @@ ana.x.cmssw_sandboxes = [
 ana.x.config_groups = {}
 
 # named function hooks that can modify store_parts of task outputs if needed
-ana.x.store_parts_modifiers = {}
+# (selection_hash addresses cf.SelectEvents outputs by the content they depend on, see law.cfg)
+from h4l.selection.cache import selection_hash_store_parts
+ana.x.store_parts_modifiers = {
+    "selection_hash": selection_hash_store_parts,
+}
 
 # histogramming hooks, invoked before creating plots when --hist-hook parameter set
 ana.x.hist_hooks = {}
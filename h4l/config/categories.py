@@ -6,9 +6,19 @@ Definition of categories.
 Categories are assigned a unique integer ID according to a fixed numbering
 scheme, with digits/groups of digits indicating the different category groups:
 
-TODO, document here.
+    - 1: inclusive
+    - tens digit (10, 20, 30): lepton channel (4e, 4mu, 2e2mu)
+    - hundreds digit (100, 200, 300): jet multiplicity (0, 1, >=2 jets)
+
+Combinations of categories of different groups (e.g. "4mu__ge2j" with ID 320) are registered
+lazily (see :py:func:`add_lazy_category_combinations`) and their IDs are the sums of the IDs of
+their constituents. They are created by :py:func:`materialize_category_combinations`, which the h4l
+tasks call when resolving their parameters (see :py:class:`h4l.tasks.base.H4LTask`), as
+histograms are filled for all leaf categories. Tasks up to the event production do not need them.
 """
 
+import itertools
+
 import law
 
 from columnflow.util import maybe_import
@@ -43,10 +53,153 @@ def skip_fn(categories: dict[str, od.Category]):
   """Custom function for skipping certain category combinations."""
   return False  # don't skip
 
+
+def _digit_scale(ids: list[int]) -> int:
+    # power of ten of a group of ids that must only differ in a single digit
+    scale = 1
+    while all(_id % (scale * 10) == 0 for _id in ids):
+        scale *= 10
+    if not all(0 < _id // scale < 10 and _id % scale == 0 for _id in ids):
+        raise ValueError(f"category ids {ids} of a combination group must only differ in a single digit")
+    return scale
+
+
+def add_lazy_category_combinations(config: od.Config, groups: dict[str, list[str]]) -> None:
+    """
+    Declares all combinations of one category per group in *groups*, mapping group names to names
+    of existing categories, without creating them. Categories within a group must not overlap and
+    their IDs must only use a single digit that differs between groups, so that the ID of a
+    combination is the sum of the IDs of its constituents (see :py:func:`kwargs_fn`).
+
+    Combinations are named with :py:func:`name_fn` and only created by explicit calls to
+    :py:func:`materialize_category_combinations`, so until then, lookups by name or ID and
+    :py:meth:`order.Config.get_leaf_categories` do not know them. Combinations for which
+    :py:func:`skip_fn` returns *True* are never created.
+    """
+    scales = [
+        _digit_scale([config.categories.get(name).id for name in names])
+        for names in groups.values()
+    ]
+    if len(set(scales)) != len(scales):
+        raise ValueError(f"category ids of the combination groups {list(groups)} must use different digits")
+
+    config.x.lazy_category_groups = {group: list(names) for group, names in groups.items()}
+
+
+def _add_combination(config: od.Config, categories: dict[str, od.Category]) -> od.Category | None:
+    # creates the combination of *categories* if not existing or skipped, and connects it to its
+    # constituents
+    name = name_fn(categories)
+    if config.categories.has(name):
+        return config.categories.get(name)
+    if skip_fn(categories):
+        return None
+
+    combination = config.add_category(name=name, **kwargs_fn(categories))
+    combination.add_tag("lazy_combination")
+    for cat in categories.values():
+        cat.add_category(combination)
+
+    return combination
+
+
+def decode_category_combination(config: od.Config, obj: str | int) -> dict[str, od.Category] | None:
+    """
+    Returns the constituents of a combined category declared in *config* via
+    :py:func:`add_lazy_category_combinations`, given by its name or ID, as a dictionary mapping group
+    names to categories, or *None* when *obj* does not describe a combination.
+    """
+    groups = config.x("lazy_category_groups", None)
+    if not groups:
+        return None
+
+    categories = {}
+    if isinstance(obj, str):
+        names = obj.split("__")
+        if len(names) != len(groups):
+            return None
+        for group, name in zip(groups, names):
+            if name not in groups[group]:
+                return None
+            categories[group] = config.categories.get(name)
+    elif isinstance(obj, int):
+        remainder = obj
+        for group, names in groups.items():
+            cats = [config.categories.get(name) for name in names]
+            scale = _digit_scale([cat.id for cat in cats])
+            cat = next((cat for cat in cats if cat.id == (obj // scale) % 10 * scale), None)
+            if cat is None:
+                return None
+            categories[group] = cat
+            remainder -= cat.id
+        if remainder != 0:
+            return None
+    else:
+        return None
+
+    return categories
+
+
+def materialize_category_combinations(config: od.Config, obj: str | int | od.Category | None = None) -> int:
+    """
+    Creates the lazily declared category combinations of *config* (see
+    :py:func:`add_lazy_category_combinations`) that are required to look up *obj*, i.e., the
+    combination itself when *obj* is the name or ID of a combination, all combinations containing
+    *obj* when it is one of their constituents, and all combinations when *obj* is *None*. Returns
+    the number of newly created categories.
+    """
+    groups = config.x("lazy_category_groups", None)
+    if not groups:
+        return 0
+
+    if isinstance(obj, od.Category):
+        obj = obj.name
+
+    # a single combination
+    categories = decode_category_combination(config, obj) if obj is not None else None
+    if categories is not None:
+        existed = config.categories.has(name_fn(categories))
+        return int(_add_combination(config, categories) is not None and not existed)
+
+    # all combinations, optionally only those containing obj
+    names = [list(names) for names in groups.values()]
+    if obj is not None:
+        found = False
+        for group_names in names:
+            match = [
+                name for name in group_names
+                if obj in (name, config.categories.get(name).id)
+            ]
+            if match:
+                group_names[:] = match
+                found = True
+        if not found:
+            return 0
+
+    n_before = len(config.categories)
+    for combination in itertools.product(*names):
+        _add_combination(config, {
+            group: config.categories.get(name)
+            for group, name in zip(groups, combination)
+        })
+    n_created = len(config.categories) - n_before
+    if n_created:
+        logger.debug(f"materialized {n_created} combined categories for {obj or 'all leaf categories'}")
+
+    return n_created
+
+
 @call_once_on_config()
 def add_all_categories(config: od.Config) -> None:
     add_incl_cat(config)
     add_lepton_categories(config)
+    add_jet_categories(config)
+
+    # combinations of lepton channels and jet multiplicities, created on demand
+    add_lazy_category_combinations(config, {
+        "channel": ["4e", "4mu", "2e2mu"],
+        "jets": ["eq0j", "eq1j", "ge2j"],
+    })
 
 
 @call_once_on_config()
@@ -83,4 +236,26 @@ def add_lepton_categories(config: od.Config) -> None:
       id=30,
       selection="catid_2e2mu",
       label="2 Electrons 2 Muons",
-    )
\ No newline at end of file
+    )
+
+
+@call_once_on_config()
+def add_jet_categories(config: od.Config) -> None:
+    config.add_category(
+        name="eq0j",
+        id=100,
+        selection="catid_eq0j",
+        label="0 jets",
+    )
+    config.add_category(
+        name="eq1j",
+        id=200,
+        selection="catid_eq1j",
+        label="1 jet",
+    )
+    config.add_category(
+        name="ge2j",
+        id=300,
+        selection="catid_ge2j",
+        label=r"$\geq$ 2 jets",
+    )
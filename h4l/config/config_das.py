@@ -96,6 +96,17 @@ def add_das_config(
         for trigger in triggers
     }
 
+    # bit positions of all triggers in the packed per-event trigger word (see trigger_selection),
+    # following the order of the trigger matrix and sorted by name within each primary dataset
+    cfg.x.trigger_bits = {
+        trigger: bit
+        for bit, trigger in enumerate(dict.fromkeys(
+            trigger
+            for _, triggers in cfg.x.trigger_matrix
+            for trigger in sorted(triggers)
+        ))
+    }
+
     # add processes we are interested in
     process_names = [
         # data
@@ -247,6 +258,7 @@ def add_das_config(
     # default objects, such as calibrator, selector, producer, ml model, inference model, etc
     cfg.x.default_calibrator = "example" # TODO: Do we need any calibration?
     cfg.x.default_selector = "default"
+    cfg.x.default_reducer = "default"
     cfg.x.default_selector_steps = (
         "trigger",
         "four_leptons",
@@ -262,6 +274,11 @@ def add_das_config(
     cfg.x.default_categories = ("cat_incl",)
     cfg.x.default_variables = ("jet1_pt",)
 
+    # floating point type of intermediate arrays in h4l calibrators, selectors and producers
+    # (quantities prone to cancellation are computed in double precision regardless, see
+    # h4l.util.compute_dtype and tests/validate_precision.py)
+    cfg.x.compute_dtype = "float32"
+
     # process groups for conveniently looping over certain processs
     # (used in wrapper_factory and during plotting)
     cfg.x.process_groups = {}
@@ -517,6 +534,7 @@ def add_das_config(
             "electron_weight*",
             "muon_weight*",
             "n_ele", "n_mu",
+            "ZZCand.*", "trigger_bits",
         } | {
             # four momenta information
             f"{field}.{var}"
@@ -531,6 +549,32 @@ def add_das_config(
         },
     })
 
+    # electron MVA working points (used in electron_selection), given as BDT thresholds per bin in
+    # pt (rows) and |eta_SC| (columns), with pt bins being upper-inclusive (pt <= 10, pt > 10) and
+    # |eta_SC| bins lower-inclusive (< 0.8, 0.8 - 1.479, >= 1.479)
+    electron_mva_wps = {
+        # pre-UL WP for Run II (miniAOD branch: Run2_CutBased_BTag16)
+        "preUL": {
+            "pt_edges": [10.0],
+            "eta_sc_edges": [0.8, 1.479],
+            "thresholds": [
+                [0.85216885148, 0.82684550976, 0.86937630022],
+                [0.98248928759, 0.96919224579, 0.79349796445],
+            ],
+        },
+        # UL WP (miniAOD branch Run2_CutBased_UL)
+        "UL": {
+            "pt_edges": [10.0],
+            "eta_sc_edges": [0.8, 1.479],
+            "thresholds": [
+                [0.9128577458, 0.9056792368, 0.9439440575],
+                [0.1559788054, 0.0273863727, -0.5532483665],
+            ],
+        },
+    }
+    if year in (2017, 2018):
+        cfg.x.electron_mva_wp = DotDict.wrap(electron_mva_wps["preUL" if campaign.x("preUL", False) else "UL"])
+
     # names of electron correction sets and working points
     # (used in the electron_sf producer)
     cfg.x.electron_sf_names = ("UL-Electron-ID-SF", f"{year}{corr_postfix}", "wp80iso")
@@ -553,6 +597,15 @@ def add_das_config(
         "electron_weight": get_shifts("e"),
     })
 
+    # config entries the results of cf.SelectEvents depend on, entering the selection hash that
+    # addresses its outputs (see h4l.selection.cache), split into common and data/mc specific ones
+    # (the category tree and the process ids always enter the hash and need not be listed)
+    cfg.x.selection_hash_aux = {
+        "all": ["trigger_bits", "electron_mva_wp", "compute_dtype"],
+        "data": ["external_files.lumi.golden"],
+        "mc": ["electron_sf_names", "muon_sf_names", "external_files.electron_sf", "external_files.muon_sf"],
+    }
+
     # versions per task family, either referring to strings or to callables receving the invoking
     # task instance and parameters to be passed to the task family
     cfg.x.versions = {
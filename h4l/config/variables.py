@@ -158,3 +158,50 @@ def add_variables(config: od.Config) -> None:
         unit="GeV",
         x_title=r"$m_{Z2}$",
     )
+
+    # decay angles and kinematics of the four-lepton system (see production/zz_observables.py)
+    for name, title in [
+        ("cos_theta_star", r"$\cos\theta^{*}$"),
+        ("cos_theta1", r"$\cos\theta_{1}$"),
+        ("cos_theta2", r"$\cos\theta_{2}$"),
+    ]:
+        config.add_variable(
+            name=name,
+            null_value=EMPTY_FLOAT,
+            binning=(20, -1.0, 1.0),
+            x_title=title,
+        )
+    for name, title in [("Phi", r"$\Phi$"), ("Phi1", r"$\Phi_{1}$")]:
+        config.add_variable(
+            name=name,
+            null_value=EMPTY_FLOAT,
+            binning=(20, -np.pi, np.pi),
+            x_title=title,
+        )
+    config.add_variable(
+        name="pt4l",
+        null_value=EMPTY_FLOAT,
+        binning=(40, 0.0, 200.0),
+        unit="GeV",
+        x_title=r"$p_{T}^{4l}$",
+    )
+    config.add_variable(
+        name="eta4l",
+        null_value=EMPTY_FLOAT,
+        binning=(40, -8.0, 8.0),
+        x_title=r"$\eta^{4l}$",
+    )
+    config.add_variable(
+        name="y4l",
+        null_value=EMPTY_FLOAT,
+        binning=(30, -3.0, 3.0),
+        x_title=r"$y^{4l}$",
+    )
+    for i in range(1, 5):
+        config.add_variable(
+            name=f"lep{i}_pt",
+            null_value=EMPTY_FLOAT,
+            binning=(40, 0.0, 200.0),
+            unit="GeV",
+            x_title=rf"Lepton {i} $p_{{T}}$",
+        )
@@ -0,0 +1,347 @@
+# coding: utf-8
+
+"""
+Histogram producer filling all variables, categories and weight variants in a single pass.
+"""
+
+from __future__ import annotations
+
+import law
+import order as od
+
+from columnflow.histogramming import HistProducer
+from columnflow.hist_util import create_hist_from_variables
+from columnflow.columnar_util import Route, has_ak_column, ak_concatenate_safe
+from columnflow.util import maybe_import
+from columnflow.types import Any
+
+from h4l.histogramming.example import example, event_weight_variants
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+hist = maybe_import("hist")
+
+
+class DenseHistogram(object):
+    """
+    Dense accumulator of weighted counts and squared weights of a histogram with a category,
+    process and shift axis, followed by the axes of *variable_insts* including their flow bins.
+    Entries of the categorical axes are added on demand. Use :py:meth:`to_hist` to convert it into a
+    ``hist.Hist`` as created by columnflow's default hist producer.
+    """
+
+    def __init__(self, variable_insts: list[od.Variable]):
+        super().__init__()
+
+        self.variable_insts = list(variable_insts)
+
+        # axes of the variables, taken from an empty histogram
+        self.axes = list(create_hist_from_variables(*self.variable_insts, weight=True).axes)
+        self.var_shape = tuple(ax.extent for ax in self.axes)
+
+        # ids per categorical axis mapped to their position, in order of appearance
+        self.ids = {"category": {}, "process": {}, "shift": {}}
+
+        self.values = np.zeros((0, 0, 0) + self.var_shape, dtype=np.float64)
+        self.variances = np.zeros_like(self.values)
+
+    @property
+    def size(self) -> int:
+        return self.values.size
+
+    @classmethod
+    def supports(cls, variable_insts: list[od.Variable]) -> bool:
+        """
+        Returns whether the axes of all *variable_insts* can be accumulated densely, i.e., whether
+        they are variable or integer axes.
+        """
+        h = create_hist_from_variables(*variable_insts, weight=True)
+        return all(isinstance(ax, (hist.axis.Variable, hist.axis.Regular, hist.axis.Integer)) for ax in h.axes)
+
+    def register(self, axis: str, ids: np.ndarray) -> np.ndarray:
+        """
+        Adds new *ids* to the categorical *axis*, growing the arrays when needed, and returns the
+        position of each id.
+        """
+        id_map = self.ids[axis]
+        new_ids = [int(_id) for _id in np.unique(ids) if int(_id) not in id_map]
+        if new_ids:
+            for _id in new_ids:
+                id_map[_id] = len(id_map)
+            dim = list(self.ids).index(axis)
+            pad = [(0, 0)] * self.values.ndim
+            pad[dim] = (0, len(new_ids))
+            self.values = np.pad(self.values, pad)
+            self.variances = np.pad(self.variances, pad)
+
+        if not len(id_map):
+            return np.zeros(len(ids), dtype=np.int64)
+        keys = np.fromiter(id_map.keys(), dtype=np.int64)
+        positions = np.fromiter(id_map.values(), dtype=np.int64)
+        order = np.argsort(keys)
+        return positions[order][np.searchsorted(keys[order], ids)]
+
+    def bin_index(self, values: list[np.ndarray], last_edge_inclusive: bool | None = None) -> np.ndarray:
+        """
+        Returns the flat index of the variable bins (including flow bins) of the flat arrays in
+        *values*, one per variable axis, with the same treatment of values on the last edge as
+        :py:func:`columnflow.hist_util.fill_hist`.
+        """
+        index = np.zeros(len(values[0]) if values else 0, dtype=np.int64)
+        for ax, vals, extent in zip(self.axes, values, self.var_shape):
+            vals = np.asarray(vals, dtype=np.float64)
+            if isinstance(ax, hist.axis.Variable) and len(ax.widths):
+                if last_edge_inclusive or (
+                    last_edge_inclusive is None and ax.traits.continuous and not ax.traits.circular
+                ):
+                    vals = np.where(vals == ax.edges[-1], vals - ax.widths[-1] * 1e-5, vals)
+            # underflow at 0 (when existing), overflow at the end
+            idx = np.asarray(ax.index(vals), dtype=np.int64) + int(ax.traits.underflow)
+            index = index * extent + np.clip(idx, 0, extent - 1)
+        return index
+
+    def add(self, flat_values: np.ndarray, flat_variances: np.ndarray) -> None:
+        """
+        Adds flat arrays of values and variances with the layout of this histogram.
+        """
+        self.values += flat_values.reshape(self.values.shape)
+        self.variances += flat_variances.reshape(self.variances.shape)
+
+    def to_hist(self) -> hist.Hist:
+        """
+        Returns the accumulated counts as ``hist.Hist`` with integer category, process and shift
+        axes.
+        """
+        h = create_hist_from_variables(
+            *self.variable_insts,
+            categorical_axes=[(axis, "intcat", list(ids)) for axis, ids in self.ids.items()],
+            weight=True,
+        )
+        view = h.view(flow=True)
+        view.value = self.values
+        view.variance = self.variances
+        return h
+
+
+def fill_dense_histograms(
+    histograms: dict[Any, DenseHistogram],
+    values: dict[Any, list[Any]],
+    category: ak.Array,
+    process: np.ndarray,
+    weights: dict[int, np.ndarray],
+    masks: dict[Any, np.ndarray] | None = None,
+    last_edge_inclusive: bool | None = None,
+) -> None:
+    """
+    Fills all *histograms* at once with a single weighted ``np.bincount`` over the concatenated flat
+    indices of all entries. *values* maps the keys of *histograms* to lists of values, one per
+    variable, either per event or singly jagged per object (broadcast-compatible among each other).
+    *category* contains the (jagged) category ids and *process* the process id per event, and
+    *weights* maps shift ids to per-event weights, all of which are filled in the shift axis.
+    Optional event *masks* per histogram key select the events to fill.
+    """
+    n_events = len(process)
+    shift_ids = np.fromiter(weights.keys(), dtype=np.int64)
+    weight_matrix = np.stack([np.asarray(w, dtype=np.float64) for w in weights.values()])
+
+    # categorical ids, shared by all histograms, as indices into their unique values
+    n_cats = np.asarray(ak.num(category, axis=1))
+    cat_ids, cat_inv = np.unique(np.asarray(ak.flatten(category, axis=1), dtype=np.int64), return_inverse=True)
+    cat_starts = np.cumsum(n_cats) - n_cats
+    proc_ids, proc_inv = np.unique(np.asarray(process, dtype=np.int64), return_inverse=True)
+
+    indices, entry_weights, offsets = [], [], [0]
+    for key, h in histograms.items():
+        cat_pos = h.register("category", cat_ids)
+        proc_pos = h.register("process", proc_ids)
+        shift_pos = h.register("shift", shift_ids)
+        n_procs, n_shifts = len(h.ids["process"]), len(h.ids["shift"])
+
+        # events to fill, and values broadcast to objects when jagged
+        mask = None if masks is None or masks.get(key) is None else np.asarray(masks[key], dtype=bool)
+        event_idx = np.arange(n_events) if mask is None else np.flatnonzero(mask)
+        _values = [v if mask is None else v[mask] for v in values[key]]
+        jagged = [v for v in _values if isinstance(v, ak.Array) and v.ndim > 1]
+        if jagged:
+            n_objs = np.asarray(ak.num(jagged[0], axis=1))
+            if any(not np.array_equal(np.asarray(ak.num(v, axis=1)), n_objs) for v in jagged[1:]):
+                names = [variable_inst.name for variable_inst in h.variable_insts]
+                raise ValueError(f"values of variables {names} are not broadcasting-compatible")
+            obj_idx = np.repeat(np.arange(len(event_idx)), n_objs)
+            _values = [
+                ak.flatten(v, axis=1) if isinstance(v, ak.Array) and v.ndim > 1 else np.asarray(v)[obj_idx]
+                for v in _values
+            ]
+            event_idx = event_idx[obj_idx]
+        _values = [np.asarray(ak.fill_none(v, np.nan) if isinstance(v, ak.Array) else v) for v in _values]
+        var_idx = h.bin_index(_values, last_edge_inclusive=last_edge_inclusive)
+
+        # one entry per filled event (or object) and category of its event, and per shift
+        entry_cats = n_cats[event_idx]
+        entry_idx = np.repeat(np.arange(len(event_idx)), entry_cats)
+        entry_event = event_idx[entry_idx]
+        entry_cat = cat_pos[cat_inv[cat_starts[entry_event] + _local_index(entry_cats)]]
+        base = (entry_cat * n_procs + proc_pos[proc_inv[entry_event]]) * n_shifts
+        var_size = int(np.prod(h.var_shape))
+        idx = (base[None, :] + shift_pos[:, None]) * var_size + var_idx[entry_idx][None, :]
+
+        indices.append(idx.reshape(-1) + offsets[-1])
+        entry_weights.append(weight_matrix[:, entry_event].reshape(-1))
+        offsets.append(offsets[-1] + h.size)
+
+    if not indices:
+        return
+
+    # single reduction for all histograms
+    idx = np.concatenate(indices)
+    w = np.concatenate(entry_weights)
+    sum_w = np.bincount(idx, weights=w, minlength=offsets[-1])
+    sum_w2 = np.bincount(idx, weights=w * w, minlength=offsets[-1])
+    for h, start, stop in zip(histograms.values(), offsets[:-1], offsets[1:]):
+        h.add(sum_w[start:stop], sum_w2[start:stop])
+
+
+def _local_index(counts: np.ndarray) -> np.ndarray:
+    # position of each entry within consecutive segments of lengths *counts*
+    starts = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) - np.repeat(starts, counts)
+
+
+def _variable_values(events: ak.Array, variable_inst: od.Variable) -> Any:
+    # evaluates the expression of a variable as done in CreateHistograms
+    expr = variable_inst.expression
+    if callable(expr):
+        return expr(events)
+    route = Route(expr)
+    if len(events) == 0 and not has_ak_column(events, route):
+        return np.array([], dtype=np.int32 if variable_inst.discrete_x else np.float32)
+    return route.apply(events, null_value=variable_inst.null_value)
+
+
+def dense_hist(self: HistProducer, variable_insts: list[od.Variable]) -> DenseHistogram | None:
+    """
+    Returns the :py:class:`DenseHistogram` of the hist producer *self* for *variable_insts*, created
+    on first access, or *None* when their axes do not support dense filling.
+    """
+    key = tuple(variable_inst.name for variable_inst in variable_insts)
+    if key not in self.dense_hists:
+        self.dense_hists[key] = DenseHistogram(variable_insts) if DenseHistogram.supports(variable_insts) else None
+    return self.dense_hists[key]
+
+
+@example.hist_producer(
+    # whether the nominal task fills the variants of weight-only shifts as well
+    emit_weight_shifts=True,
+)
+def default(self: HistProducer, events: ak.Array, task: law.Task, **kwargs) -> ak.Array:
+    """
+    Hist producer with the event weight of :py:func:`h4l.histogramming.example.example` that, per
+    chunk, computes the flat bin indices of all requested variables, categories and processes at
+    once and accumulates them with a single ``np.bincount`` into dense arrays of sums of weights
+    and squared weights (see :py:class:`DenseHistogram`). The per-variable filling by the task is
+    skipped, and the arrays are converted to ``hist.Hist`` objects only after the last chunk.
+    Variables with other axis types are filled as usual.
+
+    When *emit_weight_shifts* is set, the nominal task of an MC dataset fills the variants of all
+    weight-only shifts together with the nominal weight, all derived from a single product of
+    weight columns (see :py:func:`h4l.histogramming.example.event_weight_variants`), and the dense
+    histograms of the tasks of these shifts remain empty so that their sum in
+    ``MergeShiftedHistograms`` is unchanged.
+    """
+    shift_inst = task.global_shift_inst
+    emit = self.emit_weight_shifts and self.dataset_inst.is_mc
+    if emit and shift_inst.name in self.weight_shift_columns:
+        # filled by the nominal task
+        events, weight = example.call_func(self, events, task=task, **kwargs)
+        return events, weight
+
+    # weights per shift id, with the nominal one of the task first
+    weights = {shift_inst.id: np.ones(len(events), dtype=np.float32)}
+    if self.dataset_inst.is_mc and len(events):
+        shifts = list(self.weight_shift_columns) if emit and shift_inst.is_nominal else []
+        variants = event_weight_variants(self, events, shifts)
+        weights = {shift_inst.id: variants.pop("nominal").astype(np.float32)}
+        for name, w in variants.items():
+            weights[self.config_inst.get_shift(name).id] = w.astype(np.float32)
+    weight = ak.Array(weights[shift_inst.id])
+    if not len(events):
+        return events, weight
+
+    # category ids as used by the task
+    category_ids = ak_concatenate_safe([Route(c).apply(events) for c in task.category_id_columns], axis=-1)
+
+    histograms, values, masks = {}, {}, {}
+    for var_names in task.variable_tuples.values():
+        variable_insts = [self.config_inst.get_variable(var_name) for var_name in var_names]
+        h = dense_hist(self, variable_insts)
+        if h is None:
+            continue
+
+        # selections of variables mask events
+        mask = None
+        for variable_inst in variable_insts:
+            if callable(variable_inst.selection):
+                sel = np.asarray(variable_inst.selection(events), dtype=bool)
+                mask = sel if mask is None else (mask & sel)
+            elif variable_inst.selection != "1":
+                raise ValueError(f"invalid selection '{variable_inst.selection}', for now only callables are supported")
+
+        histograms[var_names] = h
+        values[var_names] = [_variable_values(events, variable_inst) for variable_inst in variable_insts]
+        masks[var_names] = mask
+
+    fill_dense_histograms(
+        histograms,
+        values,
+        category_ids,
+        np.asarray(events.process_id),
+        weights,
+        masks=masks,
+        last_edge_inclusive=task.last_edge_inclusive,
+    )
+
+    return events, weight
+
+
+@default.init
+def default_init(self: HistProducer) -> None:
+    example.init_func(self)
+
+    # the nominal task reads the varied weight columns of all weight-only shifts
+    if self.emit_weight_shifts:
+        self.uses |= {
+            column
+            for columns in self.weight_shift_columns.values()
+            for column in columns.values()
+        }
+
+    # dense histograms per tuple of variable names, or None for variables filled as usual
+    self.dense_hists = {}
+
+
+@default.create_hist
+def default_create_hist(self: HistProducer, variables: list[od.Variable], task: law.Task) -> Any:
+    h = dense_hist(self, variables)
+    return h if h is not None else super(default, self).create_hist_func(variables, task)
+
+
+@default.fill_hist
+def default_fill_hist(
+    self: HistProducer,
+    h: Any,
+    data: dict[str, Any],
+    variables: list[od.Variable],
+    events: ak.Array,
+    task: law.Task,
+) -> None:
+    # dense histograms were already filled for all variables when the chunk was processed
+    if isinstance(h, DenseHistogram):
+        return
+    super(default, self).fill_hist_func(h, data, variables, events, task)
+
+
+@default.post_process_hist
+def default_post_process_hist(self: HistProducer, h: Any, task: law.Task) -> hist.Hist:
+    if isinstance(h, DenseHistogram):
+        h = h.to_hist()
+    return super(default, self).post_process_hist_func(h, task)
@@ -4,16 +4,77 @@
 Example histogram producer.
 """
 
+from __future__ import annotations
+
 from columnflow.histogramming import HistProducer
 from columnflow.histogramming.default import cf_default
 from columnflow.util import maybe_import
-from columnflow.config_util import get_shifts_from_sources
 from columnflow.columnar_util import Route
 
 ak = maybe_import("awkward")
 np = maybe_import("numpy")
 
 
+def _weight_column(self: HistProducer, events: ak.Array, column: str) -> np.ndarray | None:
+    # flat weight column, or None when it is identically one for the dataset, which is detected in
+    # the first chunk and verified with a cheap comparison in later ones
+    values = np.asarray(Route(column).apply(events))
+    if column in self.unit_weight_columns:
+        if np.all(values == 1):
+            return None
+        self.unit_weight_columns.discard(column)
+    elif column not in self.checked_weight_columns:
+        self.checked_weight_columns.add(column)
+        if np.all(values == 1):
+            self.unit_weight_columns.add(column)
+            return None
+    return values
+
+
+def event_weight_variants(
+    self: HistProducer,
+    events: ak.Array,
+    shifts: list[str] | tuple[str, ...] = (),
+) -> dict[str, np.ndarray]:
+    """
+    Returns the product of all :py:attr:`weight_columns` of the hist producer *self* as
+    ``"nominal"`` weight, and, for each of the weight-only *shifts*, the varied weight, mapped to
+    the shift names.
+
+    The nominal product is computed once per chunk, skipping columns that are identically one.
+    Varied weights are derived from it by multiplying with the ratio of the varied and nominal
+    values of only the columns changed by the shift (see :py:attr:`weight_shift_columns`), with the
+    product being recomputed only for events whose nominal column value is zero.
+    """
+    columns = {column: _weight_column(self, events, column) for column in self.weight_columns}
+    nominal = np.ones(len(events), dtype=np.float64)
+    for values in columns.values():
+        if values is not None:
+            nominal *= values
+    variants = {"nominal": nominal}
+
+    for shift_name in shifts:
+        weight = nominal
+        for column, varied_column in self.weight_shift_columns[shift_name].items():
+            varied = np.asarray(Route(varied_column).apply(events), dtype=np.float64)
+            values = columns[column]
+            if values is None:
+                weight = weight * varied
+                continue
+            zero = values == 0
+            weight = weight * np.divide(varied, values, out=np.zeros_like(varied), where=~zero)
+            if np.any(zero):
+                # product of all other columns for events with vanishing nominal values
+                others = np.ones(int(zero.sum()), dtype=np.float64)
+                for other, other_values in columns.items():
+                    if other != column and other_values is not None:
+                        others *= other_values[zero]
+                weight[zero] = others * varied[zero]
+        variants[shift_name] = weight
+
+    return variants
+
+
 # extend columnflow's default hist producer
 @cf_default.hist_producer()
 def example(self: HistProducer, events: ak.Array, **kwargs) -> ak.Array:
@@ -21,23 +82,35 @@ def example(self: HistProducer, events: ak.Array, **kwargs) -> ak.Array:
     weight = ak.Array(np.ones(len(events), dtype=np.float32))
 
     if self.dataset_inst.is_mc and len(events):
-        for column in self.weight_columns:
-            weight = weight * Route(column).apply(events)
+        weight = ak.Array(event_weight_variants(self, events)["nominal"].astype(np.float32))
 
     return events, weight
 
 
 @example.init
 def example_init(self: HistProducer) -> None:
-    self.weight_columns = {}
+    self.weight_columns = []
+
+    # names of weight-only shifts mapped to the weight columns they change and their varied columns
+    self.weight_shift_columns = {}
+
+    # weight columns found to be identically one, and all columns checked for that
+    self.unit_weight_columns = set()
+    self.checked_weight_columns = set()
 
     if self.dataset_inst.is_data:
         return
 
-    # store column names referring to weights to multiply
-    self.weight_columns |= {"normalization_weight", "muon_weight"}
-    self.uses |= self.weight_columns
+    # store column names referring to weights to multiply, and the shifts they depend on,
+    # from the config and the dataset
+    event_weights = dict(self.config_inst.x("event_weights", {}))
+    event_weights.update(self.dataset_inst.x("event_weights", {}))
+    for column, shift_insts in event_weights.items():
+        self.weight_columns.append(column)
+        for shift_inst in shift_insts:
+            varied_column = shift_inst.x("column_aliases", {}).get(column, column)
+            self.weight_shift_columns.setdefault(shift_inst.name, {})[column] = varied_column
+    self.uses |= set(self.weight_columns)
 
     # declare shifts that the produced event weight depends on
-    shift_sources = {"mu"}
-    self.shifts |= set(get_shifts_from_sources(self.config_inst, *shift_sources))
+    self.shifts |= set(self.weight_shift_columns)
@@ -0,0 +1,213 @@
+# coding: utf-8
+
+"""
+Compact partial histograms, stored as NumPy arrays of values and variances (including flow bins)
+next to a JSON file with the axis metadata, so that they can be memory-mapped and merged without
+unpickling full ``hist.Hist`` objects.
+"""
+
+from __future__ import annotations
+
+import os
+import json
+
+from columnflow.util import maybe_import
+from columnflow.types import Any
+
+np = maybe_import("numpy")
+hist = maybe_import("hist")
+
+
+def _axis_to_dict(ax: hist.axis.AxesMixin) -> dict[str, Any]:
+    # json-serializable description of an axis
+    # (the label property falls back to the name when unset)
+    data = {
+        "name": ax.name,
+        "label": ax.__dict__.get("label", ax.label),
+        "growth": ax.traits.growth,
+        "overflow": ax.traits.overflow,
+    }
+    if isinstance(ax, (hist.axis.StrCategory, hist.axis.IntCategory)):
+        data["type"] = "str_category" if isinstance(ax, hist.axis.StrCategory) else "int_category"
+        data["categories"] = [(c if isinstance(c, str) else int(c)) for c in ax]
+        return data
+
+    data.update({"underflow": ax.traits.underflow, "circular": ax.traits.circular})
+    if isinstance(ax, hist.axis.Regular) and ax.transform is None:
+        data.update({"type": "regular", "bins": ax.size, "start": float(ax.edges[0]), "stop": float(ax.edges[-1])})
+    elif isinstance(ax, hist.axis.Integer):
+        data.update({"type": "integer", "start": int(ax.edges[0]), "stop": int(ax.edges[-1])})
+    elif isinstance(ax, hist.axis.Variable):
+        data.update({"type": "variable", "edges": [float(e) for e in ax.edges]})
+    else:
+        raise TypeError(f"axis '{ax.name}' of type {type(ax).__name__} is not supported in partial histograms")
+
+    return data
+
+
+def _axis_from_dict(data: dict[str, Any]) -> hist.axis.AxesMixin:
+    # inverse of _axis_to_dict
+    kwargs = {"name": data["name"], "label": data["label"], "growth": data["growth"], "overflow": data["overflow"]}
+    if data["type"] == "str_category":
+        return hist.axis.StrCategory(data["categories"], **kwargs)
+    if data["type"] == "int_category":
+        return hist.axis.IntCategory(data["categories"], **kwargs)
+
+    kwargs.update({"underflow": data["underflow"], "circular": data["circular"]})
+    if data["type"] == "regular":
+        return hist.axis.Regular(data["bins"], data["start"], data["stop"], **kwargs)
+    if data["type"] == "integer":
+        return hist.axis.Integer(data["start"], data["stop"], **kwargs)
+    return hist.axis.Variable(data["edges"], **kwargs)
+
+
+class PartialHistogram(object):
+    """
+    Histogram stored as flat axis metadata *axes* (see :py:meth:`from_hist`) and arrays of *values*
+    and optional *variances* of all bins including flow bins. Partial histograms with the same
+    non-categorical axes can be merged with :py:func:`merge_partials`, taking the union of the
+    entries of their categorical axes.
+    """
+
+    def __init__(self, axes: list[dict[str, Any]], values: np.ndarray, variances: np.ndarray | None = None):
+        super().__init__()
+
+        self.axes = axes
+        self.values = values
+        self.variances = variances
+
+    @classmethod
+    def from_hist(cls, h: hist.Hist) -> PartialHistogram:
+        """
+        Creates a partial histogram from a ``hist.Hist`` *h* with double or weight storage.
+        """
+        view = h.view(flow=True)
+        if issubclass(h.storage_type, hist.storage.Weight):
+            values, variances = np.array(view.value), np.array(view.variance)
+        elif issubclass(h.storage_type, hist.storage.Double):
+            values, variances = np.array(view), None
+        else:
+            raise TypeError(f"storage {h.storage_type.__name__} is not supported in partial histograms")
+
+        return cls([_axis_to_dict(ax) for ax in h.axes], values, variances)
+
+    def to_hist(self) -> hist.Hist:
+        """
+        Returns the partial histogram as ``hist.Hist``.
+        """
+        storage = hist.storage.Double() if self.variances is None else hist.storage.Weight()
+        h = hist.Hist(*map(_axis_from_dict, self.axes), storage=storage)
+        view = h.view(flow=True)
+        if self.variances is None:
+            view[...] = self.values
+        else:
+            view.value = self.values
+            view.variance = self.variances
+        return h
+
+    @classmethod
+    def paths(cls, directory: str, name: str) -> tuple[str, str, str]:
+        """
+        Returns the paths of the axis metadata, values and variances of the partial histogram *name*
+        in *directory*.
+        """
+        base = os.path.join(directory, name)
+        return f"{base}.json", f"{base}.values.npy", f"{base}.variances.npy"
+
+    def dump(self, directory: str, name: str) -> None:
+        """
+        Saves the partial histogram as *name* in *directory*.
+        """
+        axes_path, values_path, variances_path = self.paths(directory, name)
+        np.save(values_path, np.ascontiguousarray(self.values))
+        if self.variances is not None:
+            np.save(variances_path, np.ascontiguousarray(self.variances))
+        with open(axes_path, "w") as f:
+            json.dump({"axes": self.axes, "variances": self.variances is not None}, f)
+
+    @classmethod
+    def load(cls, directory: str, name: str, mmap: bool = True) -> PartialHistogram:
+        """
+        Loads the partial histogram *name* from *directory*, with its arrays being memory-mapped
+        read-only when *mmap* is set.
+        """
+        axes_path, values_path, variances_path = cls.paths(directory, name)
+        with open(axes_path, "r") as f:
+            meta = json.load(f)
+        mmap_mode = "r" if mmap else None
+        values = np.load(values_path, mmap_mode=mmap_mode)
+        variances = np.load(variances_path, mmap_mode=mmap_mode) if meta["variances"] else None
+        return cls(meta["axes"], values, variances)
+
+
+def merge_partials(partials: list[PartialHistogram]) -> PartialHistogram:
+    """
+    Sums *partials* into a new partial histogram whose categorical axes contain the union of all
+    categories in order of appearance. Partials are read one at a time, so that memory-mapped
+    arrays are only loaded while being added.
+    """
+    if not partials:
+        raise ValueError("cannot merge empty list of partial histograms")
+
+    # merged axes, requiring equal non-categorical axes
+    axes = [dict(ax) for ax in partials[0].axes]
+    is_cat = [ax["type"].endswith("_category") for ax in axes]
+    for p in partials[1:]:
+        if len(p.axes) != len(axes) or (p.variances is None) != (partials[0].variances is None):
+            raise ValueError("cannot merge partial histograms with different axes or storages")
+        for ax, other, cat in zip(axes, p.axes, is_cat):
+            if not cat and ax != other:
+                raise ValueError(f"cannot merge partial histograms with different axes '{ax['name']}'")
+            if cat:
+                ax["categories"] = ax["categories"] + [c for c in other["categories"] if c not in ax["categories"]]
+
+    shape = tuple(
+        len(ax["categories"]) + int(ax["overflow"]) if cat else n
+        for ax, cat, n in zip(axes, is_cat, partials[0].values.shape)
+    )
+    values = np.zeros(shape, dtype=np.float64)
+    variances = None if partials[0].variances is None else np.zeros(shape, dtype=np.float64)
+
+    for p in partials:
+        # positions of the bins of p in the merged arrays
+        positions = []
+        for ax, p_ax, cat, n in zip(axes, p.axes, is_cat, shape):
+            if not cat:
+                positions.append(np.arange(n))
+                continue
+            pos = [ax["categories"].index(c) for c in p_ax["categories"]]
+            if p_ax["overflow"]:
+                pos.append(n - 1)
+            positions.append(np.array(pos, dtype=np.int64))
+        index = np.ix_(*positions)
+        values[index] += p.values
+        if variances is not None:
+            variances[index] += p.variances
+
+    return PartialHistogram(axes, values, variances)
+
+
+def merge_partial_files(sources: list[tuple[str, str]], destination: tuple[str, str]) -> tuple[str, str]:
+    """
+    Merges the partial histograms given by pairs of directory and name in *sources* and saves the
+    result at the *destination* pair, which is returned. Intended to be run in worker processes.
+    """
+    merged = merge_partials([PartialHistogram.load(*source) for source in sources])
+    merged.dump(*destination)
+    return destination
+
+
+def dump_partial_histograms(histograms: dict[str, hist.Hist], directory: str) -> None:
+    """
+    Saves all *histograms*, mapped to their names, as partial histograms in *directory*.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for name, h in histograms.items():
+        PartialHistogram.from_hist(h).dump(directory, name)
+
+
+def partial_histogram_names(directory: str) -> list[str]:
+    """
+    Returns the names of all partial histograms in *directory*.
+    """
+    return sorted(elem[:-5] for elem in os.listdir(directory) if elem.endswith(".json"))
@@ -0,0 +1,146 @@
+# coding: utf-8
+
+"""
+Category ids derived from the single-pass category bitmask.
+"""
+
+from __future__ import annotations
+
+import law
+
+from columnflow.categorization import Categorizer
+from columnflow.production import Producer
+from columnflow.production.categories import category_ids as cf_category_ids
+from columnflow.util import maybe_import
+from columnflow.columnar_util import set_ak_column
+
+from h4l.categorization.default import category_bits
+from h4l.config.categories import decode_category_combination, skip_fn
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def _resolve_categorizers(self: Producer, cat_inst) -> list[type[Categorizer]]:
+    # categorizer classes of the selection of *cat_inst*, added as dependencies
+    categorizers = []
+    for sel in law.util.flatten(cat_inst.selection):
+        if Categorizer.derived_by(sel):
+            categorizer = sel
+        elif Categorizer.has_cls(sel):
+            categorizer = Categorizer.get_cls(sel)
+        else:
+            raise Exception(
+                f"selection '{sel}' of category '{cat_inst.name}' cannot be resolved to an existing Categorizer",
+            )
+        if not categorizer.exposed:
+            raise RuntimeError(f"cannot use unexposed categorizer '{categorizer}' to evaluate category {cat_inst}")
+
+        self.uses.add(categorizer)
+        self.produces.add(categorizer)
+        categorizers.append(categorizer)
+
+    return categorizers
+
+
+def category_ids_bitmask_call(
+    self: Producer,
+    events: ak.Array,
+    target_events: ak.Array | None = None,
+    **kwargs,
+) -> ak.Array:
+    # evaluate all leaf categories once
+    events = self[category_bits](events, **kwargs)
+    bits = np.asarray(events.category_bits)
+
+    # masks of categorizers, tested directly on the bitmask for views (see bitmask_categorizer)
+    # and evaluated once otherwise
+    cat_masks = {}
+    for categorizer in self.unique_categorizers:
+        inst = self[categorizer]
+        if getattr(inst, "category_mask", None) is not None:
+            cat_masks[categorizer] = (bits & inst.category_mask) != 0
+        else:
+            events, mask = inst(events, **kwargs)
+            cat_masks[categorizer] = np.asarray(mask, dtype=bool)
+
+    def category_mask(cat_inst):
+        mask = np.ones(len(events), dtype=bool)
+        for categorizer in self.categorizer_map[cat_inst]:
+            mask &= cat_masks[categorizer]
+        return mask
+
+    # combine into (events, categories) matrices of ids and masks of all leaf categories
+    n_cols = len(self.plain_categories) + bool(self.group_categories)
+    ids = np.zeros((len(events), n_cols), dtype=np.int64)
+    masks = np.ones((len(events), n_cols), dtype=bool)
+    for i, cat_inst in enumerate(self.plain_categories):
+        ids[:, i] = cat_inst.id
+        masks[:, i] = category_mask(cat_inst)
+
+    # the id of the combined category of each event is the sum of the ids of the matching
+    # categories per group, combinations returned by skip_fn are dropped
+    if self.group_categories:
+        for cat_insts in self.group_categories.values():
+            group_mask = np.zeros(len(events), dtype=bool)
+            for cat_inst in cat_insts:
+                mask = category_mask(cat_inst) & ~group_mask
+                ids[mask, -1] += cat_inst.id
+                group_mask |= mask
+            masks[:, -1] &= group_mask
+        for combined_id in np.unique(ids[masks[:, -1], -1]):
+            if combined_id not in self.skipped_combinations:
+                categories = decode_category_combination(self.config_inst, int(combined_id))
+                self.skipped_combinations[combined_id] = skip_fn(categories)
+            if self.skipped_combinations[combined_id]:
+                masks[:, -1] &= ids[:, -1] != combined_id
+
+    category_ids = ak.unflatten(ids[masks], masks.sum(axis=1))
+
+    # save, optionally on a target events array
+    if target_events is None:
+        target_events = events
+    target_events = set_ak_column(target_events, "category_ids", category_ids, value_type=np.int64)
+
+    return target_events
+
+
+def category_ids_bitmask_init(self: Producer, **kwargs) -> None:
+    super(cf_category_ids, self).init_func(**kwargs)
+
+    # categories in lazily combined groups (see h4l.config.categories.add_lazy_category_combinations)
+    # are evaluated once per group instead of once per combination
+    groups = self.config_inst.x("lazy_category_groups", None) or {}
+    self.group_categories = {
+        group: [self.config_inst.categories.get(name) for name in names]
+        for group, names in groups.items()
+    }
+    grouped = [cat_inst for cat_insts in self.group_categories.values() for cat_inst in cat_insts]
+
+    # all other leaf categories, looked up without materializing combinations
+    self.plain_categories = []
+    for cat_inst, _, children in self.config_inst.walk_categories():
+        if (
+            not children and
+            cat_inst not in grouped and
+            not cat_inst.has_tag("lazy_combination") and
+            cat_inst not in self.plain_categories and
+            not self.skip_category(cat_inst)
+        ):
+            self.plain_categories.append(cat_inst)
+
+    self.categorizer_map = {
+        cat_inst: _resolve_categorizers(self, cat_inst)
+        for cat_inst in self.plain_categories + grouped
+    }
+    self.unique_categorizers = law.util.make_unique(sum(self.categorizer_map.values(), []))
+    self.skipped_combinations = {}
+
+    self.uses.add(category_bits)
+
+
+# category ids with all bitmask views evaluated from a single category_bits pass
+category_ids = cf_category_ids.derive(
+    "category_ids_bitmask",
+    cls_dict={"call_func": category_ids_bitmask_call, "init_func": category_ids_bitmask_init},
+)
@@ -5,23 +5,31 @@ Column production methods related to higher-level features.
 """
 import functools
 
+import law
+
 from columnflow.production import Producer, producer
-from columnflow.production.categories import category_ids
 from columnflow.production.normalization import normalization_weights
 from columnflow.production.util import attach_coffea_behavior
 from columnflow.production.cms.seeds import deterministic_seeds
-from columnflow.util import maybe_import
-
-from columnflow.production.cms.electron import electron_weights
-from columnflow.production.cms.muon import muon_weights
-
+from columnflow.util import maybe_import, DotDict
+from columnflow.columnar_util import has_ak_column
+from columnflow.types import Any
 
+from h4l.production.categories import category_ids
+from h4l.production.weights import electron_weights, muon_weights
 from h4l.production.invariant_mass import four_lep_invariant_mass
+from h4l.production.zz_observables import zz_observables
+from h4l.selection.lepton import (
+    electron_sf_mask, muon_sf_mask, lepton_sf_mask_hash, LEPTON_SF_MASK_HASH_STATS,
+)
+from h4l.util import instrument_step
 
+np = maybe_import("numpy")
 ak = maybe_import("awkward")
 coffea = maybe_import("coffea")
 maybe_import("coffea.nanoevents.methods.nanoaod")
 
+logger = law.logger.get_logger(__name__)
 
 
 @producer(
@@ -30,33 +38,89 @@ maybe_import("coffea.nanoevents.methods.nanoaod")
         deterministic_seeds,
         electron_weights, muon_weights,
         category_ids, normalization_weights,
-        four_lep_invariant_mass,
+        four_lep_invariant_mass, zz_observables,
         "process_id",
+        # lepton weights computed during the selection
+        "{electron,muon}_weight{,_up,_down}",
     },
     produces={
         attach_coffea_behavior,
         deterministic_seeds,
         electron_weights, muon_weights,
         category_ids, normalization_weights,
-        four_lep_invariant_mass,
-        "process_id"
-    }
+        four_lep_invariant_mass, zz_observables,
+        "process_id",
+    },
+    # whether lepton weights from the selection are reused when their mask definition is unchanged
+    reuse_lepton_weights=True,
 )
 def default(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     # Build categories
-    events = self[category_ids](events, **kwargs)
+    with instrument_step(self, "category_ids", events, **kwargs):
+        events = self[category_ids](events, **kwargs)
 
     # deterministic seeds
-    events = self[deterministic_seeds](events, **kwargs)
+    with instrument_step(self, "deterministic_seeds", events, **kwargs):
+        events = self[deterministic_seeds](events, **kwargs)
 
     if self.dataset_inst.is_mc:
         # normalization weights
-        events = self[normalization_weights](events, **kwargs)
-        
-        # electron/muon scale factors using pT>15 masks
-        events = self[electron_weights](events, electron_mask=(events.Electron.pt > 15), **kwargs)
-        events = self[muon_weights](events, muon_mask=(events.Muon.pt > 15), **kwargs)
+        with instrument_step(self, "normalization_weights", events, **kwargs):
+            events = self[normalization_weights](events, **kwargs)
+
+        # electron/muon scale factors, reused from the selection if they were computed with the
+        # same masks (see default_setup), and otherwise recomputed with these masks on the
+        # (selected) leptons
+        routes = self[electron_weights].produced_columns | self[muon_weights].produced_columns
+        if not (self.lepton_weights_reusable and all(has_ak_column(events, route) for route in routes)):
+            with instrument_step(self, "lepton_sfs", events, **kwargs):
+                events = self[electron_weights](events, electron_mask=electron_sf_mask(events.Electron), **kwargs)
+                events = self[muon_weights](events, muon_mask=muon_sf_mask(events.Muon), **kwargs)
 
-    events = self[four_lep_invariant_mass](events, **kwargs)
+    with instrument_step(self, "four_lep_invariant_mass", events, **kwargs):
+        events = self[four_lep_invariant_mass](events, **kwargs)
+
+    with instrument_step(self, "zz_observables", events, **kwargs):
+        events = self[zz_observables](events, **kwargs)
 
     return events
+
+
+@default.requires
+def default_requires(self: Producer, task: law.Task, reqs: dict[str, DotDict[str, Any]], **kwargs) -> None:
+    super(default, self).requires_func(task=task, reqs=reqs, **kwargs)
+
+    # the merged selection stats record the lepton scale factor masks the weights were computed with
+    if self.reuse_lepton_weights and self.dataset_inst.is_mc and "lepton_sf_stats" not in reqs:
+        from columnflow.tasks.selection import MergeSelectionStats
+        reqs["lepton_sf_stats"] = MergeSelectionStats.req_different_branching(
+            task,
+            branch=-1 if task.is_workflow() else 0,
+        )
+
+
+@default.setup
+def default_setup(
+    self: Producer,
+    task: law.Task,
+    reqs: dict[str, DotDict[str, Any]],
+    inputs: dict[str, Any],
+    reader_targets: law.util.InsertableDict,
+    **kwargs,
+) -> None:
+    super(default, self).setup_func(task=task, reqs=reqs, inputs=inputs, reader_targets=reader_targets, **kwargs)
+
+    # lepton weights from the selection are reusable when all events of the dataset were selected
+    # with the current lepton scale factor mask definition
+    self.lepton_weights_reusable = False
+    if "lepton_sf_stats" in inputs:
+        stats = task.cached_value(
+            key=f"selection_stats_{self.dataset_inst.name}",
+            func=lambda: inputs["lepton_sf_stats"]["stats"].load(formatter="json"),
+        )
+        sf_hashes = set(stats.get(LEPTON_SF_MASK_HASH_STATS, {}))
+        self.lepton_weights_reusable = sf_hashes == {str(lepton_sf_mask_hash(self.config_inst))}
+        logger.debug(
+            f"lepton weights of dataset {self.dataset_inst.name} are "
+            f"{'' if self.lepton_weights_reusable else 'not '}reused from the selection",
+        )
@@ -3,12 +3,12 @@
 import functools
 from columnflow.production import Producer, producer
 from columnflow.util import maybe_import
-from columnflow.columnar_util import EMPTY_FLOAT, set_ak_column
+from columnflow.columnar_util import EMPTY_FLOAT, set_ak_column, has_ak_column
 from columnflow.production.util import attach_coffea_behavior
 
 # Task 3.
 # Produce variables for ZZ, Z1, Z2
-from h4l.util import build_2e2mu, build_4sf
+from h4l.util import best_zz_candidate, compute_dtype
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
@@ -16,6 +16,44 @@ ak = maybe_import("awkward")
 set_ak_column_f32 = functools.partial(set_ak_column, value_type=np.float32)
 set_ak_column_i32 = functools.partial(set_ak_column, value_type=np.int32)
 
+# columns describing the chosen ZZ candidate, written during the selection
+# (lepton indices refer to the selected, i.e., reduced Electron and Muon collections)
+zz_candidate_columns = {
+    f"ZZCand.{z}_{var}"
+    for z in ["z1", "z2", "zz"]
+    for var in ["pt", "eta", "phi", "mass"]
+} | {
+    f"ZZCand.{z}_{var}"
+    for z in ["z1", "z2"]
+    for var in ["flavor", "lep_idx1", "lep_idx2"]
+}
+
+
+@producer(
+    produces=zz_candidate_columns,
+)
+def zz_candidate(
+    self: Producer,
+    events: ak.Array,
+    candidate: ak.Array,
+    **kwargs,
+) -> ak.Array:
+    """
+    Stores the per-event ZZ *candidate* (see :py:func:`h4l.util.best_zz_candidate`) as flat
+    ``ZZCand`` columns, so that later producers do not need to rebuild the lepton combinatorics.
+    Events without a candidate are filled with ``EMPTY_FLOAT`` and indices of -1.
+    """
+    for z in ["z1", "z2", "zz"]:
+        chosen = candidate[z]
+        for var in ["pt", "eta", "phi", "mass"]:
+            events = set_ak_column_f32(events, f"ZZCand.{z}_{var}", ak.fill_none(chosen[var], EMPTY_FLOAT))
+        if z == "zz":
+            continue
+        for var in ["flavor", "lep_idx1", "lep_idx2"]:
+            events = set_ak_column_i32(events, f"ZZCand.{z}_{var}", ak.fill_none(chosen[var], -1))
+
+    return events
+
 
 @producer(
     uses=(
@@ -25,6 +63,8 @@ set_ak_column_i32 = functools.partial(set_ak_column, value_type=np.int32)
             for var in ["pt", "mass", "eta", "phi", "charge"]
         } | {
             attach_coffea_behavior,
+            # read when existing to skip rebuilding the candidates
+            "ZZCand.*",
         }
     ),
     produces={
@@ -37,7 +77,9 @@ set_ak_column_i32 = functools.partial(set_ak_column, value_type=np.int32)
 )
 def four_lep_invariant_mass(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     """
-    Construct four-lepton invariant mass given the Electron and Muon arrays.
+    Construct four-lepton invariant mass given the Electron and Muon arrays. When the selection
+    already stored the chosen candidate in ``ZZCand`` columns (see :py:func:`zz_candidate`), its
+    kinematics are used directly instead of rebuilding all candidates.
     """
 
     # attach coffea behavior for four-vector arithmetic
@@ -47,33 +89,29 @@ def four_lep_invariant_mass(self: Producer, events: ak.Array, **kwargs) -> ak.Ar
         **kwargs,
     )
 
-    electrons = events.Electron
-    muons = events.Muon
-
-    ele_plus = electrons[electrons.charge > 0]
-    ele_minus = electrons[electrons.charge < 0]
-    mu_plus = muons[muons.charge > 0]
-    mu_minus = muons[muons.charge < 0]
-
-    # Task 3.
-    # Produce variables for ZZ, Z1, Z2
-    # Hint: Build 2e2mu, 4e, 4mu separately and then zz_inclusive = ak.concatenate([zz_2e2mu, zz_4e, zz_4mu], axis=1)
-    zz_2e2mu = build_2e2mu(mu_plus, mu_minus, ele_plus, ele_minus)
-    zz_4e = build_4sf(ele_plus, ele_minus)
-    zz_4mu = build_4sf(mu_plus, mu_minus)
-    zz_inclusive = ak.concatenate([zz_2e2mu, zz_4e, zz_4mu], axis=1)
-
     # total number of leptons per event
     n_ele = ak.num(events.Electron, axis=1)
     n_mu = ak.num(events.Muon, axis=1)
     n_leptons = n_ele + n_mu
 
-    # four-lepton mass, taking into account only events with at least four leptons,
-    # and otherwise substituting a predefined EMPTY_FLOAT value
-    # Task 3 Hint: ak.firsts(zz_inclusive.zz.mass) could be useful
-    zz_mass = ak.firsts(zz_inclusive.zz.mass)
-    z1_mass = ak.firsts(zz_inclusive.z1.mass)
-    z2_mass = ak.firsts(zz_inclusive.z2.mass)
+    if has_ak_column(events, "ZZCand.zz_mass"):
+        # gather the candidate chosen during the selection
+        # (missing candidates are already filled with EMPTY_FLOAT)
+        zz_mass = events.ZZCand.zz_mass
+        z1_mass = events.ZZCand.z1_mass
+        z2_mass = events.ZZCand.z2_mass
+    else:
+        # Task 3.
+        # Produce variables for ZZ, Z1, Z2
+        # (the best of all 2e2mu, 4e and 4mu candidates is chosen in one compiled pass,
+        # see best_zz_candidate)
+        best = best_zz_candidate(events.Electron, events.Muon, dtype=compute_dtype(self.config_inst))
+
+        # four-lepton mass, taking into account only events with at least four leptons,
+        # and otherwise substituting a predefined EMPTY_FLOAT value
+        zz_mass = best.zz.mass
+        z1_mass = best.z1.mass
+        z2_mass = best.z2.mass
 
     fourlep_mass = ak.where(n_leptons >= 4, zz_mass, EMPTY_FLOAT)
     fourlep_mass = ak.fill_none(fourlep_mass, EMPTY_FLOAT)
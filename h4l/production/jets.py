@@ -0,0 +1,63 @@
+# coding: utf-8
+
+"""
+Jet related producers.
+"""
+
+from __future__ import annotations
+
+import law
+
+from columnflow.production import Producer, producer
+from columnflow.util import maybe_import
+from columnflow.columnar_util import Route, add_ak_aliases
+
+from h4l.calibration.jets import add_variation_columns, variation_routes
+
+ak = maybe_import("awkward")
+
+
+@producer(
+    # uses and aliases to apply are defined in the post_init, depending on the shift of the task
+    variation_aliases=None,
+)
+def variation_columns(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
+    """
+    Applies those shift aliases of the invoking task whose source columns were not stored by the
+    calibrators but only their relative uncertainties (e.g. ``Jet.pt_jec_up`` from ``Jet.pt`` and
+    ``Jet.jec_unc``, see :py:mod:`h4l.calibration.jets`). The source columns are created via
+    :py:func:`h4l.calibration.jets.add_variation_columns` and moved onto their destination, just
+    like the tasks do for stored columns. As columns are only replaced, nothing is declared as
+    produced. Tasks that apply aliases themselves leave the nominal columns in place in this case
+    (the "original" missing column alias strategy), so this producer must be invoked by the
+    selector and reducer that follow them.
+    """
+    if not self.variation_aliases:
+        return events
+
+    events = add_variation_columns(events, self.variation_aliases.values())
+
+    return add_ak_aliases(events, self.variation_aliases, remove_src=True)
+
+
+@variation_columns.post_init
+def variation_columns_post_init(self: Producer, task: law.Task, **kwargs) -> None:
+    super(variation_columns, self).post_init_func(task=task, **kwargs)
+
+    # aliases of the shift whose source can be computed from relative uncertainties stored by
+    # the calibrators of the task
+    self.variation_aliases = {}
+    shift_inst = getattr(task, "local_shift_inst", None)
+    calibrator_insts = getattr(task, "calibrator_insts", None) or []
+    if not shift_inst or not calibrator_insts:
+        return
+
+    calibrated = set.union(*(calibrator_inst.produced_columns for calibrator_inst in calibrator_insts))
+    for dst, src in shift_inst.x("column_aliases", {}).items():
+        if Route(src) in calibrated:
+            continue
+        for nominal, unc, _ in variation_routes(src):
+            if unc in calibrated:
+                self.variation_aliases[dst] = src
+                self.uses |= {nominal, unc}
+                break
@@ -0,0 +1,110 @@
+# coding: utf-8
+
+"""
+Lepton scale factor weights evaluated once per correction bin.
+"""
+
+from __future__ import annotations
+
+from columnflow.production import Producer
+from columnflow.production.cms.electron import electron_weights as cf_electron_weights
+from columnflow.production.cms.muon import muon_weights as cf_muon_weights
+from columnflow.util import maybe_import
+from columnflow.columnar_util import flat_np_view, layout_ak_array
+from columnflow.types import Any
+
+from h4l.util import correction_bin_edges, group_by_bins
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+class BinnedCorrection(object):
+    """
+    Wrapper around a correctionlib *correction* whose :py:meth:`evaluate` groups all entries of its
+    array inputs by the cells of the bin edges of the correction (see
+    :py:func:`h4l.util.correction_bin_edges`), evaluates the correction once per cell, and spreads
+    the values back with a single gather. Inputs can be scalars, numpy arrays or (jagged) awkward
+    arrays, the latter resulting in an awkward array with the same layout. Corrections that are not
+    piecewise constant in their inputs (e.g. those using formulas) are evaluated for all entries.
+    The grouping is reused as long as the same array objects are passed, as done by the columnflow
+    weight producers for the nominal value and all variations. All other attributes are forwarded
+    to the wrapped correction.
+    """
+
+    def __init__(self, correction: Any):
+        super().__init__()
+
+        self.correction = correction
+        self.edges = correction_bin_edges(correction)
+
+        # array inputs of the last call and their grouping, reused when the same arrays are passed
+        # again (e.g. for the nominal value and all variations)
+        self._grouped_args = None
+        self._grouping = None
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.correction, attr)
+
+    def _group(self, args: tuple, arrays: dict[str, np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+        array_args = [arg for arg in args if isinstance(arg, (np.ndarray, ak.Array))]
+        if (
+            self._grouped_args is None or
+            len(array_args) != len(self._grouped_args) or
+            any(a is not b for a, b in zip(array_args, self._grouped_args))
+        ):
+            self._grouped_args = array_args
+            self._grouping = group_by_bins(self.edges, arrays)
+        return self._grouping
+
+    def evaluate(self, *args) -> np.ndarray | ak.Array:
+        # flatten array inputs, remembering the layout of the first awkward array
+        layout = next((arg for arg in args if isinstance(arg, ak.Array)), None)
+        flat_args = [
+            flat_np_view(arg) if isinstance(arg, ak.Array) else arg
+            for arg in args
+        ]
+        arrays = {
+            inp.name: arg
+            for inp, arg in zip(self.correction.inputs, flat_args)
+            if isinstance(arg, np.ndarray)
+        }
+
+        if self.edges is None or not arrays or not len(next(iter(arrays.values()))):
+            values = self.correction.evaluate(*flat_args)
+        else:
+            first, inverse = self._group(args, arrays)
+            flat_args = [arg[first] if isinstance(arg, np.ndarray) else arg for arg in flat_args]
+            values = np.asarray(self.correction.evaluate(*flat_args))[inverse]
+
+        values = np.asarray(values)
+        if layout is None or layout.ndim == 1:
+            return values
+        return layout_ak_array(values, layout)
+
+    __call__ = evaluate
+
+
+def electron_weights_binned_setup(self: Producer, **kwargs) -> None:
+    cf_electron_weights.setup_func(self, **kwargs)
+
+    # evaluate the corrector once per bin
+    self.electron_sf_corrector = BinnedCorrection(self.electron_sf_corrector)
+
+
+def muon_weights_binned_setup(self: Producer, **kwargs) -> None:
+    cf_muon_weights.setup_func(self, **kwargs)
+
+    # evaluate the corrector once per bin
+    self.muon_sf_corrector = BinnedCorrection(self.muon_sf_corrector)
+
+
+# electron and muon weights of columnflow with bin-grouped evaluation of their correctors
+electron_weights = cf_electron_weights.derive(
+    "electron_weights_binned",
+    cls_dict={"setup_func": electron_weights_binned_setup},
+)
+muon_weights = cf_muon_weights.derive(
+    "muon_weights_binned",
+    cls_dict={"setup_func": muon_weights_binned_setup},
+)
@@ -0,0 +1,225 @@
+# coding: utf-8
+
+"""
+Decay angles and kinematic observables of the selected ZZ candidate.
+"""
+
+from __future__ import annotations
+
+import math
+
+from columnflow.production import Producer, producer
+from columnflow.util import maybe_import
+from columnflow.columnar_util import EMPTY_FLOAT, set_ak_column, has_ak_column
+
+from h4l.util import njit, best_zz_candidate, compute_dtype
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+# names of the observables in the order of the rows of the kernel output
+zz_observables_columns = [
+    "cos_theta_star", "cos_theta1", "cos_theta2", "Phi", "Phi1",
+    "pt4l", "eta4l", "y4l",
+    "lep1_pt", "lep2_pt", "lep3_pt", "lep4_pt",
+]
+
+
+@njit(cache=True)
+def _boost(v, b):
+    # boosts the four-vector *v* (px, py, pz, e) by the velocity *b* (bx, by, bz)
+    b2 = b[0]**2 + b[1]**2 + b[2]**2
+    if b2 <= 0.0 or b2 >= 1.0:
+        return v
+    gamma = 1.0 / math.sqrt(1.0 - b2)
+    bp = b[0] * v[0] + b[1] * v[1] + b[2] * v[2]
+    f = (gamma - 1.0) * bp / b2 + gamma * v[3]
+    return (v[0] + f * b[0], v[1] + f * b[1], v[2] + f * b[2], gamma * (v[3] + bp))
+
+
+@njit(cache=True)
+def _rest_frame(v):
+    # velocity that boosts into the rest frame of *v*
+    return (-v[0] / v[3], -v[1] / v[3], -v[2] / v[3])
+
+
+@njit(cache=True)
+def _add(a, b):
+    return (a[0] + b[0], a[1] + b[1], a[2] + b[2], a[3] + b[3])
+
+
+@njit(cache=True)
+def _unit(v):
+    norm = math.sqrt(v[0]**2 + v[1]**2 + v[2]**2)
+    if norm <= 0.0:
+        return (0.0, 0.0, 0.0)
+    return (v[0] / norm, v[1] / norm, v[2] / norm)
+
+
+@njit(cache=True)
+def _dot(a, b):
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+
+@njit(cache=True)
+def _cross(a, b):
+    return (a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0])
+
+
+@njit(cache=True)
+def _signed_angle(cos, sign):
+    angle = math.acos(min(max(cos, -1.0), 1.0))
+    return -angle if sign < 0 else angle
+
+
+@njit(cache=True)
+def _lepton(p4, charge, offsets, i, idx):
+    # four-vector of a lepton promoted to double precision, as boosts into the rest frames of
+    # nearly collinear pairs suffer from cancellation
+    k = offsets[i] + idx
+    return (np.float64(p4[k, 0]), np.float64(p4[k, 1]), np.float64(p4[k, 2]), np.float64(p4[k, 3])), charge[k]
+
+
+@njit(cache=True)
+def _zz_observables(e_p4, e_charge, e_offsets, m_p4, m_charge, m_offsets, flavor, lep_idx, out):
+    """
+    Computes all observables in :py:data:`zz_observables_columns` for each event with a valid
+    candidate, given the flavors (shape (2, n_events)) and local lepton indices (shape
+    (4, n_events)) of its Z1 and Z2, and writes them into the rows of *out*. The decay angles follow
+    the conventions of arXiv:1001.3396, with the negatively charged lepton being the first of each
+    pair. Rows of events without a candidate are left untouched.
+    """
+    for i in range(out.shape[1]):
+        if flavor[0, i] < 0 or flavor[1, i] < 0:
+            continue
+
+        # gather the leptons, ordered such that the negative one comes first per Z
+        leps = []
+        for z in range(2):
+            is_mu = flavor[z, i] == 13
+            for j in range(2):
+                idx = lep_idx[2 * z + j, i]
+                if is_mu:
+                    leps.append(_lepton(m_p4, m_charge, m_offsets, i, idx))
+                else:
+                    leps.append(_lepton(e_p4, e_charge, e_offsets, i, idx))
+        l11, q11 = leps[0]
+        l12, _ = leps[1]
+        l21, q21 = leps[2]
+        l22, _ = leps[3]
+        if q11 > 0:
+            l11, l12 = l12, l11
+        if q21 > 0:
+            l21, l22 = l22, l21
+        z1 = _add(l11, l12)
+        z2 = _add(l21, l22)
+        x = _add(z1, z2)
+
+        # kinematics of the four-lepton system
+        pt = math.sqrt(x[0]**2 + x[1]**2)
+        out[5, i] = pt
+        out[6, i] = math.asinh(x[2] / pt) if pt > 0 else 0.0
+        out[7, i] = 0.5 * math.log((x[3] + x[2]) / (x[3] - x[2])) if x[3] > abs(x[2]) else 0.0
+
+        # pt ordering of the four leptons
+        pts = sorted([-math.sqrt(lep[0]**2 + lep[1]**2) for lep in [l11, l12, l21, l22]])
+        for j in range(4):
+            out[8 + j, i] = -pts[j]
+
+        # everything in the rest frame of the four-lepton system
+        bx = _rest_frame(x)
+        z1_x, z2_x = _boost(z1, bx), _boost(z2, bx)
+        l11_x, l12_x = _boost(l11, bx), _boost(l12, bx)
+        l21_x, l22_x = _boost(l21, bx), _boost(l22, bx)
+
+        # production angle of z1 w.r.t. the beam axis
+        z1_dir = _unit(z1_x)
+        out[0, i] = z1_dir[2]
+
+        # helicity angles, defined in the rest frames of z1 and z2
+        b1 = _rest_frame(z1_x)
+        out[1, i] = -_dot(_unit(_boost(z2_x, b1)), _unit(_boost(l11_x, b1)))
+        b2 = _rest_frame(z2_x)
+        out[2, i] = -_dot(_unit(_boost(z1_x, b2)), _unit(_boost(l21_x, b2)))
+
+        # angle between the two decay planes, and between the z1 decay plane and the plane spanned
+        # by z1 and the beam axis
+        n1 = _unit(_cross(l11_x, l12_x))
+        n2 = _unit(_cross(l21_x, l22_x))
+        n_sc = _unit(_cross((0.0, 0.0, 1.0), z1_dir))
+        out[3, i] = _signed_angle(-_dot(n1, n2), _dot(z1_dir, _cross(n1, n2)))
+        out[4, i] = _signed_angle(_dot(n1, n_sc), _dot(z1_dir, _cross(n1, n_sc)))
+
+
+def _flat_p4(leptons: ak.Array, dtype: np.dtype) -> np.ndarray:
+    # flat (n, 4) array of px, py, pz, e
+    pt, eta, phi, mass = (
+        np.asarray(ak.flatten(leptons[var], axis=1), dtype=dtype)
+        for var in ["pt", "eta", "phi", "mass"]
+    )
+    pz = pt * np.sinh(eta)
+    return np.stack([pt * np.cos(phi), pt * np.sin(phi), pz, np.sqrt(pt**2 + pz**2 + mass**2)], axis=1)
+
+
+def _offsets(leptons: ak.Array) -> np.ndarray:
+    offsets = np.zeros(len(leptons) + 1, dtype=np.int64)
+    np.cumsum(ak.num(leptons, axis=1), out=offsets[1:])
+    return offsets
+
+
+@producer(
+    uses={
+        "{Electron,Muon}.{pt,eta,phi,mass,charge}",
+        # read when existing to skip rebuilding the candidates
+        "ZZCand.{z1,z2}_{flavor,lep_idx1,lep_idx2}",
+    },
+    produces=set(zz_observables_columns),
+)
+def zz_observables(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
+    """
+    Produces the decay angles cos(theta*), cos(theta1), cos(theta2), Phi and Phi1, the pt, eta and
+    rapidity of the four-lepton system, and the pt of its four leptons in descending order, from
+    the leptons of the ZZ candidate chosen during the selection (see
+    :py:func:`h4l.production.invariant_mass.zz_candidate`), or of the best candidate otherwise.
+
+    All observables are computed in one compiled pass over the events and written into a single
+    float32 buffer of fixed width, whose rows are stored as columns. Lepton four-vectors are read
+    with the configured compute_dtype (see :py:func:`h4l.util.compute_dtype`). Events without a candidate
+    are filled with ``EMPTY_FLOAT``.
+    """
+    dtype = compute_dtype(self.config_inst)
+    if has_ak_column(events, "ZZCand.z1_flavor"):
+        cand = {
+            f"{z}_{var}": events.ZZCand[f"{z}_{var}"]
+            for z in ["z1", "z2"]
+            for var in ["flavor", "lep_idx1", "lep_idx2"]
+        }
+    else:
+        best = best_zz_candidate(events.Electron, events.Muon, dtype=dtype)
+        cand = {
+            f"{z}_{var}": ak.fill_none(best[z][var], -1)
+            for z in ["z1", "z2"]
+            for var in ["flavor", "lep_idx1", "lep_idx2"]
+        }
+    as_int = lambda name: np.asarray(cand[name], dtype=np.int64)  # noqa: E731
+    flavor = np.stack([as_int("z1_flavor"), as_int("z2_flavor")])
+    lep_idx = np.stack([as_int(f"{z}_lep_idx{j}") for z in ["z1", "z2"] for j in [1, 2]])
+
+    out = np.full((len(zz_observables_columns), len(events)), EMPTY_FLOAT, dtype=np.float32)
+    _zz_observables(
+        _flat_p4(events.Electron, dtype),
+        np.asarray(ak.flatten(events.Electron.charge, axis=1), dtype=np.int64),
+        _offsets(events.Electron),
+        _flat_p4(events.Muon, dtype),
+        np.asarray(ak.flatten(events.Muon.charge, axis=1), dtype=np.int64),
+        _offsets(events.Muon),
+        flavor,
+        lep_idx,
+        out,
+    )
+
+    for name, values in zip(zz_observables_columns, out):
+        events = set_ak_column(events, name, values)
+
+    return events
@@ -0,0 +1,25 @@
+# coding: utf-8
+
+"""
+Default reduction methods.
+"""
+
+from columnflow.reduction import Reducer, reducer
+from columnflow.reduction.default import cf_default
+from columnflow.util import maybe_import
+
+from h4l.production.jets import variation_columns
+
+ak = maybe_import("awkward")
+
+
+@reducer(
+    uses={cf_default, variation_columns},
+    produces={cf_default},
+)
+def default(self: Reducer, events: ak.Array, selection: ak.Array, **kwargs) -> ak.Array:
+    # apply shifts of jet columns stored as relative uncertainties by the calibrators
+    events = self[variation_columns](events, **kwargs)
+
+    # run cf's default reduction which handles event selection and collection creation
+    return self[cf_default](events, selection, **kwargs)
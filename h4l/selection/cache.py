@@ -0,0 +1,290 @@
+# coding: utf-8
+
+"""
+Content-addressed caching of selection results.
+
+The results of cf.SelectEvents only depend on the input files of a dataset, the code of the
+selector (and all its dependencies), the columns it uses and produces and a small number of config
+entries. :py:func:`selection_hash` combines these inputs into a short hash that is inserted into the
+output path of the task by means of the ``selection_hash`` store parts modifier (registered in the
+analysis and activated in the ``[outputs]`` section of the law config). As long as the hash of a
+dataset is unchanged, previously computed masks and stats are found and reused, whereas datasets
+whose hash changed are recomputed without the need to bump versions by hand.
+"""
+
+from __future__ import annotations
+
+__all__ = ["selection_hash", "selection_hash_store_parts"]
+
+import hashlib
+import inspect
+import json
+
+import law
+import order as od
+
+from columnflow.types import Any
+
+_logger = law.logger.get_logger(__name__)
+
+# hashes per (config, dataset, shift, selector), computed once per process
+_hash_cache: dict[tuple, str] = {}
+
+# array function methods whose code enters the hash
+_func_attrs = [
+    "call_func", "pre_init_func", "init_func", "skip_func", "requires_func", "setup_func",
+    "teardown_func",
+]
+
+
+def _canonical(obj: Any) -> Any:
+    """
+    Converts *obj* into a json-serializable structure with a deterministic order.
+    """
+    if isinstance(obj, dict):
+        return {str(key): _canonical(value) for key, value in sorted(obj.items(), key=lambda item: str(item[0]))}
+    if isinstance(obj, (set, frozenset)):
+        return sorted(map(str, obj))
+    if isinstance(obj, (list, tuple)):
+        return [_canonical(value) for value in obj]
+    if isinstance(obj, od.UniqueObject):
+        return obj.name
+    if isinstance(obj, (str, int, float, bool)) or obj is None:
+        return obj
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    if hasattr(obj, "__dict__"):
+        return _canonical(vars(obj))
+    return repr(obj)
+
+
+def _h4l_object(obj: Any) -> Any:
+    """
+    Returns the python function or class behind *obj* when it is defined in an h4l module, unwrapping
+    compiled numba functions, and *None* otherwise.
+    """
+    obj = getattr(obj, "py_func", obj)
+    if not (inspect.isfunction(obj) or inspect.isclass(obj)):
+        return None
+    module = getattr(obj, "__module__", None) or ""
+    return obj if module.startswith("h4l") else None
+
+
+def _code_names(code) -> set[str]:
+    # global names referenced by *code* and all code objects nested in it (e.g. lambdas)
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _code_names(const)
+    return names
+
+
+def _value_source(value: Any, sources: dict[str, str]) -> Any:
+    # json-serializable representation of a module-level value, with functions replaced by their
+    # source (collected in *sources*) and everything else canonicalized
+    if isinstance(value, dict):
+        return {str(key): _value_source(v, sources) for key, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_value_source(v, sources) for v in value]
+    if callable(value):
+        obj = _h4l_object(value)
+        if obj is not None and obj.__name__ == "<lambda>":
+            return inspect.getsource(obj).strip()
+        if obj is not None:
+            _collect_sources(obj, sources)
+            return f"{obj.__module__}.{obj.__qualname__}"
+        return f"{getattr(value, '__module__', '')}.{getattr(value, '__qualname__', type(value).__name__)}"
+    return _canonical(value)
+
+
+def _collect_sources(obj: Any, sources: dict[str, str]) -> None:
+    """
+    Adds the source of the h4l function or class *obj* to *sources*, mapped to its qualified name,
+    and recursively the sources of all h4l functions, classes and module-level values it
+    references.
+    """
+    name = f"{obj.__module__}.{obj.__qualname__}"
+    if name in sources:
+        return
+    try:
+        sources[name] = inspect.getsource(obj)
+    except (OSError, TypeError):
+        # e.g. classes created dynamically by array function decorators
+        sources[name] = ""
+    if not inspect.isfunction(obj):
+        return
+
+    for global_name in sorted(_code_names(obj.__code__)):
+        if global_name not in obj.__globals__:
+            continue
+        value = obj.__globals__[global_name]
+        if inspect.ismodule(value):
+            continue
+        ref = _h4l_object(value)
+        if ref is not None:
+            _collect_sources(ref, sources)
+        elif not callable(value) and obj.__module__.startswith("h4l"):
+            # module-level values such as constants and lookup tables
+            key = f"{obj.__module__}.{global_name}"
+            if key not in sources:
+                sources[key] = ""
+                sources[key] = json.dumps(_value_source(value, sources), sort_keys=True, default=repr)
+
+
+def _array_function_sources(func_inst) -> dict[str, str]:
+    """
+    Returns the source code of the h4l functions of *func_inst* and all its dependencies (their
+    call, init, setup, etc. functions), as well as of all h4l functions, classes and module-level
+    values they reference (e.g. helpers in :py:mod:`h4l.util`), mapped to their qualified names.
+    Since dependencies are walked on the instance, only code that is actually part of the selection
+    of its dataset enters. Functions from columnflow and other packages are covered by their
+    version instead.
+    """
+    sources = {}
+    for inst in func_inst.walk_deps(include_self=True):
+        for attr in _func_attrs:
+            func = _h4l_object(getattr(type(inst), attr, None))
+            if func is not None:
+                _collect_sources(func, sources)
+
+    return dict(sorted(sources.items()))
+
+
+def _config_entries(config_inst: od.Config, dataset_inst: od.Dataset) -> dict[str, Any]:
+    """
+    Returns the config entries the selection of *dataset_inst* depends on, as defined by the
+    ``selection_hash_aux`` auxiliary entry of *config_inst* (common entries under ``"all"``, data
+    and mc specific ones under ``"data"`` and ``"mc"``).
+    """
+    aux = config_inst.x("selection_hash_aux", {})
+    keys = list(aux.get("all", []))
+    keys += list(aux.get("data" if dataset_inst.is_data else "mc", []))
+
+    entries = {}
+    for key in keys:
+        # resolve dotted keys into nested aux entries
+        value = config_inst.aux
+        for part in key.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        entries[key] = value
+
+    return entries
+
+
+def _selection_names(selection: Any) -> list[str]:
+    # names of the categorizers (or expressions) in the *selection* of a category
+    return [
+        sel if isinstance(sel, str) else getattr(sel, "cls_name", None) or getattr(sel, "__qualname__", repr(sel))
+        for sel in law.util.flatten(selection)
+    ]
+
+
+def _category_entries(config_inst: od.Config) -> dict[str, Any]:
+    """
+    Returns a canonical description of the category tree of *config_inst*, i.e., the id, selection
+    and children of each category, mapped to its name, which is evaluated by the category ids of
+    the selection. Combinations of lazily combined groups (see
+    :py:func:`h4l.config.categories.add_lazy_category_combinations`) are left out, as they only
+    depend on the groups (``cfg.x.lazy_category_groups``) and ids of the categories they combine,
+    and would otherwise only enter once materialized.
+    """
+    entries = {}
+    for cat_inst, _, children in config_inst.walk_categories():
+        if cat_inst.has_tag("lazy_combination") or cat_inst.name in entries:
+            continue
+        entries[cat_inst.name] = {
+            "id": cat_inst.id,
+            "selection": _selection_names(cat_inst.selection),
+            "children": sorted(child.name for child in children if not child.has_tag("lazy_combination")),
+        }
+
+    return {
+        "tree": dict(sorted(entries.items())),
+        "lazy_groups": _canonical(config_inst.x("lazy_category_groups", None)),
+    }
+
+
+def _process_entries(config_inst: od.Config, dataset_inst: od.Dataset) -> dict[str, Any]:
+    """
+    Returns the ids of all processes of *config_inst*, mapped to their names, and the names of the
+    processes of *dataset_inst*, whose first process id is stored by the selection.
+    """
+    return {
+        "ids": {proc_inst.name: proc_inst.id for proc_inst, _, _ in config_inst.walk_processes()},
+        "dataset": [proc_inst.name for proc_inst in dataset_inst.processes],
+    }
+
+
+def selection_hash(task: law.Task) -> str:
+    """
+    Returns a short hash of everything the selection results of *task* (usually cf.SelectEvents)
+    depend on:
+
+        - the dataset name, shift, number of files and the keys of its input files,
+        - the auxiliary data of the dataset (e.g. required and vetoed triggers),
+        - the source of all h4l functions involved in the selector and its dependencies,
+        - the resolved columns used and produced by the selector,
+        - the config entries listed in ``cfg.x.selection_hash_aux``,
+        - the category tree and the process ids of the config (see :py:func:`_category_entries` and
+          :py:func:`_process_entries`), and
+        - the columnflow version.
+
+    Input files are identified by their dataset keys rather than their content, as the latter is
+    only known after running cf.GetDatasetLFNs.
+    """
+    from columnflow import __version__ as cf_version
+
+    dataset_inst = task.dataset_inst
+    config_inst = task.config_inst
+    selector_inst = task.selector_inst
+    shift = task.global_shift_inst.name
+    cache_key = (config_inst.name, dataset_inst.name, shift, task.selector_repr)
+    if cache_key in _hash_cache:
+        return _hash_cache[cache_key]
+
+    info = dataset_inst.get_info(shift if shift in dataset_inst.info else "nominal")
+    content = {
+        "dataset": {
+            "name": dataset_inst.name,
+            "shift": shift,
+            "keys": list(info.keys),
+            "n_files": info.n_files,
+            "aux": _canonical(dataset_inst.aux),
+        },
+        "selector": {
+            "sources": {
+                name: hashlib.sha256(source.encode()).hexdigest()
+                for name, source in _array_function_sources(selector_inst).items()
+            },
+            "uses": sorted(map(str, selector_inst.used_columns)),
+            "produces": sorted(map(str, selector_inst.produced_columns)),
+        },
+        "config": _canonical(_config_entries(config_inst, dataset_inst)),
+        "categories": _category_entries(config_inst),
+        "processes": _process_entries(config_inst, dataset_inst),
+        "columnflow": cf_version,
+    }
+    digest = hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()[:10]
+    _hash_cache[cache_key] = digest
+
+    _logger.debug(f"selection hash of dataset {dataset_inst.name} with shift {shift}: {digest}")
+
+    return digest
+
+
+def selection_hash_store_parts(task: law.Task, store_parts: law.util.InsertableDict) -> law.util.InsertableDict:
+    """
+    Store parts modifier that inserts the :py:func:`selection_hash` of *task* after its version, so
+    that outputs are addressed by the content they depend on. Tasks without a selector or dataset
+    are left unchanged.
+    """
+    if not all(getattr(task, attr, None) for attr in ["selector_inst", "dataset_inst"]):
+        return store_parts
+
+    part = f"hash__{selection_hash(task)}"
+    if "version" in store_parts:
+        store_parts.insert_after("version", "selection_hash", part)
+    else:
+        store_parts["selection_hash"] = part
+
+    return store_parts
@@ -11,30 +11,73 @@ from columnflow.selection.cms.met_filters import met_filters
 from columnflow.selection.cms.json_filter import json_filter
 from columnflow.selection.cms.jets import jet_veto_map
 
-from columnflow.production.categories import category_ids
 from columnflow.production.util import attach_coffea_behavior
 from columnflow.production.cms.mc_weight import mc_weight
-from columnflow.production.cms.electron import electron_weights
-from columnflow.production.cms.muon import muon_weights
 from columnflow.production.processes import process_ids
 
-from h4l.selection.lepton import electron_selection, muon_selection
+from h4l.selection.lepton import (
+    electron_selection, muon_selection, electron_sf_mask, muon_sf_mask, lepton_sf_mask_hash,
+    LEPTON_SF_MASK_HASH_STATS,
+)
 from h4l.selection.trigger import trigger_selection
+from h4l.production.categories import category_ids
+from h4l.production.weights import electron_weights, muon_weights
+from h4l.production.invariant_mass import zz_candidate
+from h4l.production.jets import variation_columns
 
-from h4l.util import build_2e2mu, build_4sf
+from h4l.util import (
+    best_zz_candidate, evaluate_on_subset, mask_from_indices, instrument_step, compute_dtype,
+)
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
 
+def zz_selection(
+    electrons: ak.Array,
+    muons: ak.Array,
+    dtype: np.dtype = np.float32,
+) -> dict[str, ak.Array]:
+    """
+    Lepton pT and ZZ candidate requirements of the official HZZ selection, given the selected
+    *electrons* and *muons*. Returns the per-event step masks, as well as the best ZZ candidate
+    built with floating point *dtype*.
+    """
+    # leading/subleading lepton pT requirement
+    leptons = ak.concatenate([electrons, muons], axis=1)
+    leptons = leptons[ak.argsort(leptons.pt, axis=1, ascending=False)]
+    leptons = ak.pad_none(leptons, 2, axis=1)
+    lead_pt = leptons.pt[:, 0]
+    sublead_pt = leptons.pt[:, 1]
+    # Bonus: Leading lepton must have pT > 20 GeV, subleading pT > 10 GeV
+    lepton_pt = ak.fill_none((lead_pt > 20) & (sublead_pt > 10), False)
+
+    # arbitrate between all 2e2mu, 4e and 4mu candidates in one compiled pass, applying ghost
+    # removal, QCD suppression, the Z mass requirements and the smart cut (see best_zz_candidate)
+    best = best_zz_candidate(electrons, muons, dtype=dtype)
+    level = np.asarray(best.level)
+
+    return {
+        "lepton_pt": lepton_pt,
+        # All Z candidates must have 12 < mll < 120 GeV
+        "z_candidate": level >= 1,
+        # The Z1 candidate must have mZ1 > 40 GeV
+        "z1_mass": level >= 2,
+        # The ZZ candidate must have mZZ > 70 GeV
+        "zz_mass": level >= 3,
+        "m4l_window": ak.fill_none((best.zz.mass > 105) & (best.zz.mass < 140), False),
+        "zz_candidate": best,
+    }
+
+
 @selector(
     uses={
         "event",
-        category_ids,
+        category_ids, variation_columns,
         attach_coffea_behavior, json_filter, mc_weight,
         electron_weights, muon_weights,
         electron_selection, muon_selection,
-        trigger_selection,
+        trigger_selection, zz_candidate,
         increment_stats, process_ids
     },
     produces={
@@ -42,7 +85,7 @@ ak = maybe_import("awkward")
         attach_coffea_behavior, json_filter, mc_weight,
         electron_weights, muon_weights,
         electron_selection, muon_selection,
-        trigger_selection,
+        trigger_selection, zz_candidate,
         increment_stats, process_ids,
     },
     # sandbox=dev_sandbox("bash::$CF_BASE/sandboxes/venv_columnar.sh"),
@@ -54,6 +97,9 @@ def default(
     stats: defaultdict,
     **kwargs,
 ) -> tuple[ak.Array, SelectionResult]:
+    # apply shifts of jet columns stored as relative uncertainties by the calibrators
+    events = self[variation_columns](events, **kwargs)
+
     # ensure coffea behaviors are loaded
     events = self[attach_coffea_behavior](events, **kwargs)
     events = self[category_ids](events, **kwargs)
@@ -67,19 +113,23 @@ def default(
 
     # filter bad data events according to golden lumi mask
     if self.dataset_inst.is_data:
-        events, json_filter_results = self[json_filter](events, **kwargs)
+        with instrument_step(self, "json_filter", events, stats=stats, **kwargs):
+            events, json_filter_results = self[json_filter](events, **kwargs)
         results += json_filter_results
 
     # run trigger selection
-    events, trigger_results = self[trigger_selection](events, call_force=True, **kwargs)
+    with instrument_step(self, "trigger", events, stats=stats, **kwargs):
+        events, trigger_results = self[trigger_selection](events, call_force=True, **kwargs)
     results += trigger_results
 
     # run electron selection
-    events, ele_results = self[electron_selection](events, call_force=True, **kwargs)
+    with instrument_step(self, "electron_selection", events, stats=stats, **kwargs):
+        events, ele_results = self[electron_selection](events, call_force=True, **kwargs)
     results += ele_results
 
     # run muon selection
-    events, muon_results = self[muon_selection](events, call_force=True, **kwargs)
+    with instrument_step(self, "muon_selection", events, stats=stats, **kwargs):
+        events, muon_results = self[muon_selection](events, call_force=True, **kwargs)
     results += muon_results
 
     # get indices of selected leptons
@@ -92,17 +142,19 @@ def default(
 
     # add lepton SFs only for selected leptons to avoid out-of-range inputs
     if self.dataset_inst.is_mc:
-        ele_local_idx = ak.local_index(events.Electron.pt)
-        mu_local_idx = ak.local_index(events.Muon.pt)
-        electron_mask = ak.any(ele_local_idx[..., None] == ele_idx[:, None, :], axis=-1)
-        muon_mask = ak.any(mu_local_idx[..., None] == muon_idx[:, None, :], axis=-1)
+        electron_mask = mask_from_indices(ele_idx, events.Electron)
+        muon_mask = mask_from_indices(muon_idx, events.Muon)
         # SFs are only valid in a defined kinematic range; guard against out-of-bounds
-        ele_sc_eta = abs(events.Electron.eta + events.Electron.deltaEtaSC)
-        electron_mask = electron_mask & (events.Electron.pt >= 10.0) & (ele_sc_eta < 2.5)
-        # muon SFs are typically valid only above ~15 GeV in UL; guard against low-pt
-        muon_mask = muon_mask & (events.Muon.pt >= 15.0) & (abs(events.Muon.eta) < 2.4)
-        events = self[electron_weights](events, electron_mask=electron_mask, **kwargs)
-        events = self[muon_weights](events, muon_mask=muon_mask, **kwargs)
+        electron_mask = electron_mask & electron_sf_mask(events.Electron)
+        muon_mask = muon_mask & muon_sf_mask(events.Muon)
+        with instrument_step(self, "lepton_sfs", events, stats=stats, **kwargs):
+            events = self[electron_weights](events, electron_mask=electron_mask, **kwargs)
+            events = self[muon_weights](events, muon_mask=muon_mask, **kwargs)
+
+        # count events per hash of the mask definition in the stats, so that producers can check
+        # whether the weights can be reused (see h4l.production.default)
+        sf_hashes = stats.setdefault(LEPTON_SF_MASK_HASH_STATS, defaultdict(float))
+        sf_hashes[str(lepton_sf_mask_hash(self.config_inst))] += len(events)
 
     # count selected leptons
     n_ele = ak.num(electrons, axis=1)
@@ -113,41 +165,21 @@ def default(
 
     # Task 2.
     # Implement official HZZ Selection
-    
-    # leading/subleading lepton pT requirement
-    leptons = ak.concatenate([electrons, muons], axis=1)
-    leptons = leptons[ak.argsort(leptons.pt, axis=1, ascending=False)]
-    leptons = ak.pad_none(leptons, 2, axis=1)
-    lead_pt = leptons.pt[:, 0]
-    sublead_pt = leptons.pt[:, 1]
-    # Bonus: Leading lepton must have pT > 20 GeV, subleading pT > 10 GeV
-    results.steps["lepton_pt"] = ak.fill_none((lead_pt > 20) & (sublead_pt > 10), False)
-
-    ele_plus = electrons[electrons.charge > 0]
-    ele_minus = electrons[electrons.charge < 0]
-    mu_plus = muons[muons.charge > 0]
-    mu_minus = muons[muons.charge < 0]
-
-    zz_2e2mu = build_2e2mu(mu_plus, mu_minus, ele_plus, ele_minus)
-    zz_4e = build_4sf(ele_plus, ele_minus)
-    zz_4mu = build_4sf(mu_plus, mu_minus)
-    zz_inclusive = ak.concatenate([zz_2e2mu, zz_4e, zz_4mu], axis=1)
-
-    # All Z candidates must have 12 < mll < 120 GeV
-    z_mass_mask = (
-        (zz_inclusive.z1.mass > 12) & (zz_inclusive.z1.mass < 120) &
-        (zz_inclusive.z2.mass > 12) & (zz_inclusive.z2.mass < 120)
-    )
-    # The Z1 candidate must have mZ1 > 40 GeV
-    z1_mass_mask = z_mass_mask & (zz_inclusive.z1.mass > 40)
-    # The ZZ candidate must have mZZ > 70 GeV
-    zz_mass_mask = z1_mass_mask & (zz_inclusive.zz.mass > 70)
-
-    results.steps["z_candidate"] = ak.fill_none(ak.any(z_mass_mask, axis=1), False)
-    results.steps["z1_mass"] = ak.fill_none(ak.any(z1_mass_mask, axis=1), False)
-    results.steps["zz_mass"] = ak.fill_none(ak.any(zz_mass_mask, axis=1), False)
-    m4l_window_mask = (zz_inclusive.zz.mass > 105) & (zz_inclusive.zz.mass < 140)
-    results.steps["m4l_window"] = ak.fill_none(ak.any(m4l_window_mask, axis=1), False)
+    # (the remaining steps are only evaluated on events with at least four leptons and
+    # scattered back to all events afterwards, see evaluate_on_subset)
+    with instrument_step(self, "zz_candidates", events, stats=stats, **kwargs):
+        zz_results = evaluate_on_subset(
+            results.steps["four_leptons"],
+            zz_selection,
+            electrons,
+            muons,
+            dtype=compute_dtype(self.config_inst),
+        )
+        for step in ["lepton_pt", "z_candidate", "z1_mass", "zz_mass", "m4l_window"]:
+            results.steps[step] = zz_results[step]
+
+        # store the best candidate for later producers
+        events = self[zz_candidate](events, candidate=zz_results["zz_candidate"], **kwargs)
 
     # post selection build process IDs
     events = self[process_ids](events, **kwargs)
@@ -176,13 +208,14 @@ def default(
           },
       }
 
-    events, results = self[increment_stats](
-        events,
-        results,
-        stats,
-        weight_map=weight_map,
-        group_map=group_map,
-        **kwargs,
-    )
+    with instrument_step(self, "increment_stats", events, stats=stats, **kwargs):
+        events, results = self[increment_stats](
+            events,
+            results,
+            stats,
+            weight_map=weight_map,
+            group_map=group_map,
+            **kwargs,
+        )
 
     return events, results
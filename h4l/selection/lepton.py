@@ -1,6 +1,11 @@
 
 from __future__ import annotations
 
+import hashlib
+import inspect
+
+import order as od
+
 from columnflow.selection import Selector, SelectionResult, selector
 from columnflow.util import maybe_import, dev_sandbox
 from h4l.util import IF_NANO_V9, IF_NANO_V10
@@ -9,6 +14,37 @@ np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
 
+def electron_sf_mask(electrons: ak.Array) -> ak.Array:
+    """
+    Returns a mask of *electrons* within the validity range of the electron scale factors.
+    """
+    sc_eta = abs(electrons.eta + electrons.deltaEtaSC)
+    return (electrons.pt >= 10.0) & (sc_eta < 2.5)
+
+
+def muon_sf_mask(muons: ak.Array) -> ak.Array:
+    """
+    Returns a mask of *muons* within the validity range of the muon scale factors (typically only
+    above ~15 GeV in UL).
+    """
+    return (muons.pt >= 15.0) & (abs(muons.eta) < 2.4)
+
+
+# key of the selection stats counting events per lepton_sf_mask_hash
+LEPTON_SF_MASK_HASH_STATS = "num_events_per_lepton_sf_mask_hash"
+
+
+def lepton_sf_mask_hash(config_inst: od.Config) -> int:
+    """
+    Returns a 32 bit hash of the definition of the lepton scale factor masks above and of the scale
+    factor names in *config_inst*, identifying the configuration the lepton weights were computed
+    with.
+    """
+    content = [inspect.getsource(func) for func in [electron_sf_mask, muon_sf_mask]]
+    content += [repr(config_inst.x(f"{lep}_sf_names", None)) for lep in ["electron", "muon"]]
+    return int(hashlib.sha256("\n".join(content).encode()).hexdigest()[:8], 16)
+
+
 @selector(
     uses=(
         {
@@ -32,13 +68,13 @@ def electron_selection(
 ):
     min_pt = 7
     pt = events.Electron.pt
-    fSCeta = abs(events.Electron.eta + events.Electron.deltaEtaSC)
 
-    # era-dependent selection (filled below)
-    electron_base_mask = ak.ones_like(events.Electron.pt)
+    # era-dependent MVA working point, looked up in a table of thresholds per pt and |eta_SC| bin
+    # (see cfg.x.electron_mva_wp), or no requirement when no table is defined for this era
+    electron_base_mask = ak.ones_like(pt, dtype=bool)
 
-    era = self.config_inst.campaign.x.year
-    if era == 2017 or era == 2018:
+    wp = self.config_inst.x("electron_mva_wp", None)
+    if wp:
         if self.config_inst.campaign.x.version < 10:
             # using 2017 WP and training (ElectronMVAEstimatorRun2Fall17IsoV2Values)
             # since this is the only one available in Run2 UL nanoAODs
@@ -46,41 +82,13 @@ def electron_selection(
         else:
             BDT = events.Electron.mvaHZZIso
 
-        # pre-UL WP for Run II (miniAOD branch: Run2_CutBased_BTag16)
-        if self.config_inst.campaign.x("preUL", False):
-            electron_base_mask = (
-                (
-                    (pt <= 10.) & (
-                        (fSCeta < 0.8 & BDT > 0.85216885148) |
-                        (fSCeta >= 0.8 & fSCeta < 1.479 & BDT > 0.82684550976) |
-                        (fSCeta >= 1.479 & BDT > 0.86937630022)
-                    )
-                ) |
-                (
-                    (pt > 10.) & (
-                        (fSCeta < 0.8 & BDT > 0.98248928759) |
-                        (fSCeta >= 0.8 & fSCeta < 1.479 & BDT > 0.96919224579) |
-                        (fSCeta >= 1.479 & BDT > 0.79349796445))
-                )
-            )
-
-        else:  # UL WP (miniAOD branch Run2_CutBased_UL)
-            electron_base_mask = (
-                (
-                    (pt <= 10.) & (
-                        ((fSCeta < 0.8) & (BDT > 0.9128577458)) |
-                        ((fSCeta >= 0.8) & (fSCeta < 1.479) & (BDT > 0.9056792368)) |
-                        ((fSCeta >= 1.479) & (BDT > 0.9439440575))
-                    )
-                ) |
-                (
-                    (pt > 10.) & (
-                        ((fSCeta < 0.8) & (BDT > 0.1559788054)) |
-                        ((fSCeta >= 0.8) & (fSCeta < 1.479) & (BDT > 0.0273863727)) |
-                        ((fSCeta >= 1.479) & (BDT > -0.5532483665))
-                    )
-                )
-            )
+        # compute bin indices once on the flat arrays and gather the thresholds
+        flat_pt = np.asarray(ak.flatten(pt))
+        flat_sc_eta = np.abs(np.asarray(ak.flatten(events.Electron.eta + events.Electron.deltaEtaSC)))
+        pt_bin = np.digitize(flat_pt, wp.pt_edges, right=True)
+        eta_bin = np.digitize(flat_sc_eta, wp.eta_sc_edges)
+        threshold = np.asarray(wp.thresholds)[pt_bin, eta_bin]
+        electron_base_mask = ak.unflatten(np.asarray(ak.flatten(BDT)) > threshold, ak.num(pt, axis=1))
 
     # mask for selecting electrons
     electron_mask = (
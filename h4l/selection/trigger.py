@@ -1,30 +1,59 @@
-
 from __future__ import annotations
 
 from columnflow.selection import Selector, SelectionResult, selector
+from columnflow.columnar_util import set_ak_column
 from columnflow.util import maybe_import
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
 
-@selector
+def trigger_word_dtype(trigger_bits: dict[str, int]) -> type:
+    """
+    Returns the smallest unsigned integer type that can hold all *trigger_bits*.
+    """
+    n_bits = max(trigger_bits.values(), default=0) + 1
+    for dtype in (np.uint16, np.uint32, np.uint64):
+        if n_bits <= np.iinfo(dtype).bits:
+            return dtype
+    raise ValueError(f"cannot pack {n_bits} trigger bits into a single integer")
+
+
+def trigger_mask(trigger_bits: dict[str, int], triggers) -> int:
+    """
+    Returns the integer mask with the bits of all *triggers* set, given the bit positions in
+    *trigger_bits* (usually ``cfg.x.trigger_bits``).
+    """
+    mask = 0
+    for trigger in triggers:
+        mask |= 1 << trigger_bits[trigger]
+    return mask
+
+
+@selector(
+    produces={"trigger_bits"},
+)
 def trigger_selection(
     self: Selector,
     events: ak.Array,
     **kwargs,
 ) -> tuple[ak.Array, SelectionResult]:
 
-    # start with an all-false mask
-    sel_trigger = ak.Array(np.zeros(len(events), dtype=bool))
-
-    # pick events that passed one of the required triggers
-    for trigger in self.dataset_inst.x("require_triggers", []):
-        sel_trigger = sel_trigger | events.HLT[trigger]
+    # pack the decisions of all configured triggers into one word per event
+    # (bit positions given by cfg.x.trigger_bits)
+    trigger_bits = np.zeros(len(events), dtype=self.trigger_dtype)
+    for trigger, bit in self.config_inst.x.trigger_bits.items():
+        trigger_bits[np.asarray(events.HLT[trigger])] |= self.trigger_dtype(1 << bit)
 
+    # pick events that passed one of the required triggers,
     # but reject events that also passed one of the triggers to veto
-    for trigger in self.dataset_inst.x("veto_triggers", []):
-        sel_trigger = sel_trigger & ~events.HLT[trigger]
+    sel_trigger = (
+        ((trigger_bits & self.require_mask) != 0) &
+        ((trigger_bits & self.veto_mask) == 0)
+    )
+
+    # store the packed word for downstream trigger studies
+    events = set_ak_column(events, "trigger_bits", trigger_bits)
 
     return events, SelectionResult(
         steps={
@@ -44,3 +73,11 @@ def trigger_selection_init(self: Selector) -> None:
         f"HLT.{trigger}"
         for trigger in self.config_inst.x.all_triggers
     }
+
+    # precompute the word type and the per-dataset masks of required and vetoed triggers
+    trigger_bits = self.config_inst.x.trigger_bits
+    self.trigger_dtype = trigger_word_dtype(trigger_bits)
+    dataset_inst = getattr(self, "dataset_inst", None)
+    if dataset_inst:
+        self.require_mask = self.trigger_dtype(trigger_mask(trigger_bits, dataset_inst.x("require_triggers", [])))
+        self.veto_mask = self.trigger_dtype(trigger_mask(trigger_bits, dataset_inst.x("veto_triggers", [])))
@@ -3,3 +3,6 @@
 
 # provisioning imports
 import h4l.tasks.base
+import h4l.tasks.histograms
+import h4l.tasks.plotting
+import h4l.tasks.inference
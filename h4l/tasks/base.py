@@ -4,9 +4,24 @@
 Custom base tasks.
 """
 
+from __future__ import annotations
+
 from columnflow.tasks.framework.base import BaseTask
+from columnflow.types import Any
 
 
 class H4LTask(BaseTask):
 
     task_namespace = "h4l"
+
+    @classmethod
+    def resolve_param_values_pre_init(cls, params: dict[str, Any]) -> dict[str, Any]:
+        # h4l tasks create or consume histograms, which are filled for all leaf categories, so the
+        # lazily declared category combinations are created before categories are resolved (and
+        # therefore exist in all tasks that run in the same process from here on)
+        from h4l.config.categories import materialize_category_combinations
+
+        for config_inst in params.get("config_insts") or []:
+            materialize_category_combinations(config_inst)
+
+        return super().resolve_param_values_pre_init(params)
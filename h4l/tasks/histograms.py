@@ -0,0 +1,253 @@
+# coding: utf-8
+
+"""
+Tasks to produce histograms as compact partials and to merge them in a parallel tree reduction.
+"""
+
+from __future__ import annotations
+
+import os
+import contextlib
+import concurrent.futures
+
+import luigi
+import law
+
+from columnflow.tasks.framework.base import BaseTask, Requirements
+from columnflow.tasks.histograms import CreateHistograms, MergeHistograms, MergeShiftedHistograms
+from columnflow.hist_util import update_ax_labels
+from columnflow.util import maybe_import
+from columnflow.types import TYPE_CHECKING
+
+from h4l.tasks.base import H4LTask
+
+if TYPE_CHECKING:
+    hist = maybe_import("hist")
+
+
+class PartialHistogramsTarget(object):
+    """
+    Mixin for directory targets of partial histograms (see
+    :py:class:`h4l.histogramming.partials.PartialHistogram`), added to local or remote directory
+    targets by :py:func:`partial_histograms_target`. :py:meth:`dump` and :py:meth:`load` accept and
+    return a dictionary of ``hist.Hist`` objects, mapped to variable names, just like the pickle file
+    of :py:class:`CreateHistograms`, so that the formatter argument is ignored. Contents are always
+    written into a temporary directory first, which is moved into place (local targets) or
+    transferred (remote targets) only once all histograms are written, so that failures never leave
+    an incomplete output.
+    """
+
+    def dump(self, histograms: dict[str, hist.Hist], formatter: str | None = None, **kwargs) -> None:
+        from h4l.histogramming.partials import dump_partial_histograms
+
+        if not isinstance(self, law.LocalTarget):
+            with self.localize("w", is_tmp=True) as tmp:
+                dump_partial_histograms(histograms, tmp.abspath)
+            return
+
+        # temporary sibling directory on the same file system, renamed at the end
+        self.parent.touch()
+        tmp = law.LocalDirectoryTarget(is_tmp=True, tmp_dir=self.parent.abspath)
+        try:
+            dump_partial_histograms(histograms, tmp.abspath)
+            self.remove()
+            os.rename(tmp.abspath, self.abspath)
+        finally:
+            tmp.remove(silent=True)
+
+    def load(self, formatter: str | None = None, **kwargs) -> dict[str, hist.Hist]:
+        from h4l.histogramming.partials import PartialHistogram, partial_histogram_names
+        with self.localize("r") as tmp:
+            return {
+                name: PartialHistogram.load(tmp.abspath, name, mmap=False).to_hist()
+                for name in partial_histogram_names(tmp.abspath)
+            }
+
+
+# mixed target classes per directory target class
+_partial_target_classes: dict[type, type] = {}
+
+
+def partial_histograms_target(target: law.FileSystemDirectoryTarget) -> law.FileSystemDirectoryTarget:
+    """
+    Adds the :py:class:`PartialHistogramsTarget` mixin to the directory *target* in-place and
+    returns it.
+    """
+    cls = target.__class__
+    if cls not in _partial_target_classes:
+        _partial_target_classes[cls] = type(f"PartialHistograms{cls.__name__}", (PartialHistogramsTarget, cls), {})
+    target.__class__ = _partial_target_classes[cls]
+    return target
+
+
+class CreatePartialHistograms(H4LTask, CreateHistograms):
+    """
+    Same as :py:class:`columnflow.tasks.histograms.CreateHistograms`, but storing histograms as
+    memory-mappable partials in a directory instead of a pickle file.
+    """
+
+    workflow_condition = CreateHistograms.workflow_condition.copy()
+
+    @workflow_condition.output
+    def output(self):
+        target = self.target(f"hist__vars_{self.variables_repr}__{self.branch}", dir=True)
+        return {"hists": partial_histograms_target(target)}
+
+
+class PartialHistogramsMergeMixin(BaseTask):
+    """
+    Mixin for tasks that (transitively) require :py:class:`MergePartialHistograms`, adding its
+    parameters so that they can be set on the command line of the requiring task and are forwarded
+    upstream.
+    """
+
+    merge_workers = luigi.IntParameter(
+        default=4,
+        significant=False,
+        description="number of processes merging partial histograms in parallel; no pool is used when 1; "
+        "default: 4",
+    )
+    merge_fan_in = luigi.IntParameter(
+        default=8,
+        significant=False,
+        description="maximum number of partial histograms merged by a single process at a time; default: 8",
+    )
+
+
+class MergePartialHistograms(H4LTask, PartialHistogramsMergeMixin, MergeHistograms):
+    """
+    Same as :py:class:`columnflow.tasks.histograms.MergeHistograms`, with identical outputs, but
+    merging the partial histograms of :py:class:`CreatePartialHistograms` in a tree reduction.
+    Groups of at most *merge_fan_in* partials per variable are summed by a pool of *merge_workers*
+    processes, with intermediate results written to a temporary directory, so that memory is
+    bounded by the number of workers times the size of a single merged histogram.
+    """
+
+    # upstream requirements
+    reqs = Requirements(
+        MergeHistograms.reqs,
+        CreateHistograms=CreatePartialHistograms,
+    )
+
+    def merge_partials(self, sources: dict[str, list[tuple[str, str]]], tmp_dir: str) -> dict[str, tuple[str, str]]:
+        """
+        Reduces the partial histograms in *sources*, mapping variable names to lists of directory
+        and name pairs, level by level until a single partial per variable remains, and returns its
+        location. Intermediate partials are written to *tmp_dir* and removed once merged.
+        """
+        from h4l.histogramming.partials import PartialHistogram, merge_partial_files
+
+        if self.merge_fan_in < 2:
+            raise ValueError(f"merge_fan_in must be at least 2, got {self.merge_fan_in}")
+
+        pool = None
+        if self.merge_workers > 1:
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.merge_workers)
+
+        try:
+            level = 0
+            while any(len(locations) > 1 for locations in sources.values()):
+                level += 1
+                self.publish_message(f"merging partial histograms, level {level}")
+
+                # submit all groups of all variables of this level, passing single partials through
+                groups = []
+                for variable_name, locations in sources.items():
+                    for i in range(0, len(locations), self.merge_fan_in):
+                        group = locations[i:i + self.merge_fan_in]
+                        if len(group) == 1:
+                            result = group[0]
+                        else:
+                            destination = (tmp_dir, f"{variable_name}__{level}_{i}")
+                            result = (
+                                pool.submit(merge_partial_files, group, destination)
+                                if pool else merge_partial_files(group, destination)
+                            )
+                        groups.append((variable_name, group, result))
+
+                # collect results in order and remove merged intermediate partials
+                sources = {variable_name: [] for variable_name in sources}
+                for variable_name, group, result in groups:
+                    if isinstance(result, concurrent.futures.Future):
+                        result = result.result()
+                    sources[variable_name].append(result)
+                    if len(group) == 1:
+                        continue
+                    for directory, name in group:
+                        if directory != tmp_dir:
+                            continue
+                        for path in PartialHistogram.paths(directory, name):
+                            if os.path.exists(path):
+                                os.remove(path)
+        finally:
+            if pool:
+                pool.shutdown()
+
+        return {variable_name: locations[0] for variable_name, locations in sources.items()}
+
+    @law.decorator.notify
+    @law.decorator.log
+    def run(self):
+        from h4l.histogramming.partials import PartialHistogram, partial_histogram_names
+
+        # prepare inputs and outputs
+        inputs = self.input()["collection"]
+        outputs = self.output()
+
+        # run the hist_producer setup
+        self._array_function_post_init()
+
+        # reduce the partial histograms per variable, localizing remote inputs
+        tmp_dir = law.LocalDirectoryTarget(is_tmp=True)
+        tmp_dir.touch()
+        with contextlib.ExitStack() as stack:
+            directories = [
+                stack.enter_context(inp["hists"].localize("r")).abspath
+                for inp in inputs.targets.values()
+            ]
+            variable_names = partial_histogram_names(directories[0])
+            sources = {
+                variable_name: [(directory, variable_name) for directory in directories]
+                for variable_name in variable_names
+            }
+            merged_locations = self.merge_partials(sources, tmp_dir.abspath)
+
+        # create a separate file per output variable
+        for variable_name in self.iter_progress(variable_names, len(variable_names)):
+            self.publish_message(f"writing merged histogram for '{variable_name}'")
+            merged = PartialHistogram.load(*merged_locations[variable_name]).to_hist()
+
+            # update axis labels from variable insts for consistency
+            update_ax_labels([merged], self.config_inst, variable_name)
+
+            # post-process the merged histogram
+            merged = self.hist_producer_inst.run_post_process_merged_hist(h=merged, task=self)
+
+            # ensure the format is compatible
+            if self.hist_producer_inst.post_process_merged_compatibility_check:
+                CreateHistograms.check_histogram_compatibility(merged)
+
+            # do not overwrite permissions when the file was already existing
+            perm = 0 if outputs["hists"][variable_name].exists() else None
+
+            # write the output
+            outputs["hists"][variable_name].dump(merged, perm=perm, formatter="pickle")
+
+        # optionally remove inputs
+        if self.remove_previous:
+            inputs.remove()
+
+
+class MergeShiftedPartialHistograms(H4LTask, PartialHistogramsMergeMixin, MergeShiftedHistograms):
+    """
+    Same as :py:class:`columnflow.tasks.histograms.MergeShiftedHistograms`, but requiring
+    :py:class:`MergePartialHistograms` per shift.
+    """
+
+    resolution_task_cls = MergePartialHistograms
+
+    # upstream requirements
+    reqs = Requirements(
+        MergeShiftedHistograms.reqs,
+        MergeHistograms=MergePartialHistograms,
+    )
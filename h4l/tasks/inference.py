@@ -0,0 +1,28 @@
+# coding: utf-8
+
+"""
+Inference tasks based on histograms merged from compact partials.
+"""
+
+from columnflow.tasks.framework.base import Requirements
+from columnflow.tasks.cms import inference
+
+from h4l.tasks.base import H4LTask
+from h4l.tasks.histograms import (
+    PartialHistogramsMergeMixin, MergePartialHistograms, MergeShiftedPartialHistograms,
+)
+
+
+class CreateDatacards(H4LTask, PartialHistogramsMergeMixin, inference.CreateDatacards):
+    """
+    Same as :py:class:`columnflow.tasks.cms.inference.CreateDatacards`, but requiring
+    :py:class:`h4l.tasks.histograms.MergeShiftedPartialHistograms`.
+    """
+
+    resolution_task_cls = MergePartialHistograms
+
+    # upstream requirements
+    reqs = Requirements(
+        inference.CreateDatacards.reqs,
+        MergeShiftedHistograms=MergeShiftedPartialHistograms,
+    )
@@ -0,0 +1,60 @@
+# coding: utf-8
+
+"""
+Plotting tasks based on histograms merged from compact partials.
+"""
+
+from columnflow.tasks.framework.base import Requirements
+from columnflow.tasks import plotting
+
+from h4l.tasks.base import H4LTask
+from h4l.tasks.histograms import (
+    PartialHistogramsMergeMixin, MergePartialHistograms, MergeShiftedPartialHistograms,
+)
+
+
+class PlotVariables1D(H4LTask, PartialHistogramsMergeMixin, plotting.PlotVariables1D):
+    """
+    Same as :py:class:`columnflow.tasks.plotting.PlotVariables1D`, but requiring
+    :py:class:`h4l.tasks.histograms.MergePartialHistograms`.
+    """
+
+    resolution_task_cls = MergePartialHistograms
+
+    # upstream requirements
+    reqs = Requirements(
+        plotting.PlotVariables1D.reqs,
+        MergeHistograms=MergePartialHistograms,
+    )
+
+
+class PlotVariables2D(H4LTask, PartialHistogramsMergeMixin, plotting.PlotVariables2D):
+    """
+    Same as :py:class:`columnflow.tasks.plotting.PlotVariables2D`, but requiring
+    :py:class:`h4l.tasks.histograms.MergePartialHistograms`.
+    """
+
+    resolution_task_cls = MergePartialHistograms
+
+    # upstream requirements
+    reqs = Requirements(
+        plotting.PlotVariables2D.reqs,
+        MergeHistograms=MergePartialHistograms,
+    )
+
+
+class PlotShiftedVariables1D(H4LTask, PartialHistogramsMergeMixin, plotting.PlotShiftedVariables1D):
+    """
+    Same as :py:class:`columnflow.tasks.plotting.PlotShiftedVariables1D`, but requiring
+    :py:class:`h4l.tasks.histograms.MergePartialHistograms` and
+    :py:class:`h4l.tasks.histograms.MergeShiftedPartialHistograms`.
+    """
+
+    resolution_task_cls = MergePartialHistograms
+
+    # upstream requirements
+    reqs = Requirements(
+        plotting.PlotShiftedVariables1D.reqs,
+        MergeHistograms=MergePartialHistograms,
+        MergeShiftedHistograms=MergeShiftedPartialHistograms,
+    )
@@ -6,27 +6,127 @@ Helpful utils.
 
 from __future__ import annotations
 
-__all__ = ["IF_NANO_V9", "IF_NANO_V10"]
+__all__ = [
+    "IF_NANO_V9", "IF_NANO_V10", "build_zz_candidates", "best_zz_candidate", "evaluate_on_subset",
+    "mask_from_indices", "instrumentation_enabled", "instrument_step", "uses_audit_enabled",
+    "track_column_access", "audit_uses", "lv_xyzt", "lv_mass", "load_correction_set",
+    "correction_cache_dir", "jagged_buffer", "jagged_ufunc", "correction_bin_edges",
+    "group_by_bins", "compute_dtype", "counter_random",
+]
 
+import os
 import re
+import math
+import gzip
+import json
+import hashlib
 import itertools
 import time
+import contextlib
 from typing import Any, Hashable, Iterable, Callable
 from functools import wraps, reduce, partial
 import tracemalloc
 
 import law
+import order as od
 
 from columnflow.types import Any
-from columnflow.columnar_util import ArrayFunction, deferred_column, get_ak_routes
+from columnflow.columnar_util import (
+    ArrayFunction, Route, EMPTY_FLOAT, deferred_column, get_ak_routes, mandatory_coffea_columns,
+)
 from columnflow.util import maybe_import
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 coffea = maybe_import("coffea")
+maybe_import("coffea.nanoevents.methods.vector")
+numba = maybe_import("numba")
 
 _logger = law.logger.get_logger(__name__)
 
+# nominal Z boson mass used to rank Z candidates
+Z_MASS = 91.1876
+
+
+def compute_dtype(config_inst: od.Config | None = None) -> np.dtype:
+    """
+    Returns the floating point type for intermediate arrays of the h4l calibrators, selectors and
+    producers, as configured by the auxiliary entry ``compute_dtype`` of *config_inst*, defaulting
+    to float32, i.e., the precision of NanoAOD inputs. Compiled kernels accumulate quantities that
+    are prone to cancellation (e.g. masses of nearly collinear pairs) in float64 registers
+    regardless of this setting.
+    """
+    name = config_inst.x("compute_dtype", "float32") if config_inst is not None else "float32"
+    return np.dtype(name)
+
+
+def njit(*args, **kwargs):
+    """
+    Wrapper around ``numba.njit`` that falls back to the plain python function when numba is not
+    available (e.g. when only the config is loaded outside of the columnar sandbox). Can be used
+    with or without arguments.
+    """
+    if numba:
+        return numba.njit(*args, **kwargs)
+
+    if len(args) == 1 and callable(args[0]) and not kwargs:
+        return args[0]
+    return lambda func: func
+
+
+def _lv_fields(lv: ak.Array, fields: list[str], dtype: np.dtype | None) -> list[ak.Array]:
+    # fields of the Lorentz vectors *lv*, optionally converted to *dtype*
+    values = [lv[field] for field in fields]
+    return values if dtype is None else [ak.values_astype(value, dtype) for value in values]
+
+
+def lv_xyzt(lv: ak.Array, dtype: np.dtype | None = None) -> ak.Array:
+    """
+    Converts the Lorentz vectors *lv* of any structure into cartesian ``LorentzVector``'s with
+    fields x, y, z and t. Vectors that are already cartesian are only relabeled. When *dtype* is
+    given (e.g. the configured :py:func:`compute_dtype`), input fields are converted to it first.
+    """
+    fields = set(lv.fields)
+    if {"x", "y", "z", "t"} <= fields:
+        x, y, z, t = _lv_fields(lv, ["x", "y", "z", "t"], dtype)
+    else:
+        pt, eta, phi, mass = _lv_fields(lv, ["pt", "eta", "phi", "mass"], dtype)
+        x = pt * np.cos(phi)
+        y = pt * np.sin(phi)
+        z = pt * np.sinh(eta)
+        t = np.sqrt(x**2 + y**2 + z**2 + mass**2)
+
+    return ak.zip(
+        {"x": x, "y": y, "z": z, "t": t},
+        with_name="LorentzVector",
+        behavior=coffea.nanoevents.methods.vector.behavior,
+    )
+
+
+def lv_mass(lv: ak.Array, dtype: np.dtype | None = None) -> ak.Array:
+    """
+    Converts the cartesian Lorentz vectors *lv* of any structure into ``PtEtaPhiMLorentzVector``'s.
+    Vectors without transverse momentum get an eta of zero and negative squared masses are clipped
+    to zero. Vectors that already have pt, eta, phi and mass fields are only relabeled. When *dtype*
+    is given (e.g. the configured :py:func:`compute_dtype`), input fields are converted to it first.
+    """
+    fields = set(lv.fields)
+    if {"pt", "eta", "phi", "mass"} <= fields:
+        pt, eta, phi, mass = _lv_fields(lv, ["pt", "eta", "phi", "mass"], dtype)
+    else:
+        x, y, z, t = _lv_fields(lv, ["x", "y", "z", "t"], dtype)
+        pt = np.sqrt(x**2 + y**2)
+        eta = np.arcsinh(z / ak.where(pt > 0, pt, np.inf))
+        phi = np.arctan2(y, x)
+        mass = np.sqrt(np.maximum(t**2 - pt**2 - z**2, 0.0))
+
+    return ak.zip(
+        {"pt": pt, "eta": eta, "phi": phi, "mass": mass},
+        with_name="PtEtaPhiMLorentzVector",
+        behavior=coffea.nanoevents.methods.vector.behavior,
+    )
+
+
 def build_2e2mu(muons_plus, muons_minus, electrons_plus, electrons_minus):
     mu1, mu2, e1, e2 = ak.unzip(
         ak.cartesian([muons_plus, muons_minus, electrons_plus, electrons_minus])
@@ -65,6 +165,1052 @@ def build_4sf(leptons_plus, leptons_minus):
     return ak.zip({"z1": z1, "z2": z2, "zz": zz}, depth_limit=1)
 
 
+@njit(cache=True)
+def _set_pt_eta_phi_mass(out, k, px, py, pz, e):
+    # convert a cartesian four-vector into pt, eta, phi and mass, stored in column *k* of *out*
+    # (arguments are float64 sums, see _sum_p4)
+    pt = np.sqrt(px**2 + py**2)
+    out[0, k] = pt
+    out[1, k] = np.arcsinh(pz / pt) if pt > 0 else np.sign(pz) * np.inf
+    out[2, k] = np.arctan2(py, px)
+    out[3, k] = np.sqrt(max(e**2 - px**2 - py**2 - pz**2, 0.0))
+
+
+@njit(cache=True)
+def _sum_p4(p4, a, b):
+    # sum of the four-vectors *a* and *b* in *p4*, accumulated in double precision regardless of
+    # the dtype of *p4*, as masses of nearly collinear pairs suffer from cancellation
+    return (
+        np.float64(p4[a, 0]) + np.float64(p4[b, 0]),
+        np.float64(p4[a, 1]) + np.float64(p4[b, 1]),
+        np.float64(p4[a, 2]) + np.float64(p4[b, 2]),
+        np.float64(p4[a, 3]) + np.float64(p4[b, 3]),
+    )
+
+
+@njit(cache=True)
+def _fill_z_pair(z1, z2, zz, lep, k, p4, a, b, c, d):
+    # build the two Z candidates (a, b) and (c, d) from the cartesian four-vectors in *p4*,
+    # assign the one closer to the nominal Z mass to z1 and store both together with their sum,
+    # as well as the indices (into p4) of the leptons forming z1 and z2
+    ax, ay, az, ae = _sum_p4(p4, a, b)
+    bx, by, bz, be = _sum_p4(p4, c, d)
+    m_a = np.sqrt(max(ae**2 - ax**2 - ay**2 - az**2, 0.0))
+    m_b = np.sqrt(max(be**2 - bx**2 - by**2 - bz**2, 0.0))
+    if abs(m_a - Z_MASS) < abs(m_b - Z_MASS):
+        _set_pt_eta_phi_mass(z1, k, ax, ay, az, ae)
+        _set_pt_eta_phi_mass(z2, k, bx, by, bz, be)
+        lep[0, k], lep[1, k], lep[2, k], lep[3, k] = a, b, c, d
+    else:
+        _set_pt_eta_phi_mass(z1, k, bx, by, bz, be)
+        _set_pt_eta_phi_mass(z2, k, ax, ay, az, ae)
+        lep[0, k], lep[1, k], lep[2, k], lep[3, k] = c, d, a, b
+    _set_pt_eta_phi_mass(zz, k, ax + bx, ay + by, az + bz, ae + be)
+
+
+@njit(cache=True)
+def _pair_mass(p4, a, b):
+    px, py, pz, e = _sum_p4(p4, a, b)
+    return np.sqrt(max(e**2 - px**2 - py**2 - pz**2, 0.0))
+
+
+@njit(cache=True)
+def _split_charges(start, stop, charge, shift, plus, minus):
+    # store indices (shifted by *shift*) of positively and negatively charged leptons
+    n_plus = n_minus = 0
+    for j in range(start, stop):
+        if charge[j] > 0:
+            plus[n_plus] = shift + j
+            n_plus += 1
+        elif charge[j] < 0:
+            minus[n_minus] = shift + j
+            n_minus += 1
+    return n_plus, n_minus
+
+
+@njit(cache=True)
+def _add_4sf_quads(quads, n, plus, n_plus, minus, n_minus):
+    # same-flavor pairings in the order of build_4sf: first all "a" pairings (p0 m0, p1 m1),
+    # then all "b" pairings (p0 m1, p1 m0), each looping over plus pairs, then minus pairs
+    for swap in range(2):
+        for i0 in range(n_plus):
+            for i1 in range(i0 + 1, n_plus):
+                for j0 in range(n_minus):
+                    for j1 in range(j0 + 1, n_minus):
+                        quads[n, 0] = plus[i0]
+                        quads[n, 1] = minus[j1] if swap else minus[j0]
+                        quads[n, 2] = plus[i1]
+                        quads[n, 3] = minus[j0] if swap else minus[j1]
+                        n += 1
+    return n
+
+
+@njit(cache=True)
+def _event_quads(i, e_offsets, e_charge, m_offsets, m_charge, ep, em, mp, mm, quads):
+    # fill *quads* with the indices (a, b, c, d) of the leptons of all ZZ candidates of event *i*,
+    # forming the pairs (a, b) and (c, d) where a and c are positively charged, in the order of
+    # build_2e2mu, build_4sf(electrons) and build_4sf(muons); returns the number of candidates
+    n_ep, n_em = _split_charges(e_offsets[i], e_offsets[i + 1], e_charge, 0, ep, em)
+    n_mp, n_mm = _split_charges(m_offsets[i], m_offsets[i + 1], m_charge, e_offsets[-1], mp, mm)
+    n = 0
+    for a in range(n_mp):
+        for b in range(n_mm):
+            for c in range(n_ep):
+                for d in range(n_em):
+                    quads[n, 0], quads[n, 1], quads[n, 2], quads[n, 3] = mp[a], mm[b], ep[c], em[d]
+                    n += 1
+    n = _add_4sf_quads(quads, n, ep, n_ep, em, n_em)
+    n = _add_4sf_quads(quads, n, mp, n_mp, mm, n_mm)
+    return n
+
+
+@njit(cache=True)
+def _count_zz_candidates(e_offsets, e_charge, m_offsets, m_charge):
+    n_events = len(e_offsets) - 1
+    counts = np.zeros(n_events, dtype=np.int64)
+    for i in range(n_events):
+        n_ep = n_em = n_mp = n_mm = 0
+        for j in range(e_offsets[i], e_offsets[i + 1]):
+            if e_charge[j] > 0:
+                n_ep += 1
+            elif e_charge[j] < 0:
+                n_em += 1
+        for j in range(m_offsets[i], m_offsets[i + 1]):
+            if m_charge[j] > 0:
+                n_mp += 1
+            elif m_charge[j] < 0:
+                n_mm += 1
+        counts[i] = (
+            n_mp * n_mm * n_ep * n_em +
+            n_ep * (n_ep - 1) * n_em * (n_em - 1) // 2 +
+            n_mp * (n_mp - 1) * n_mm * (n_mm - 1) // 2
+        )
+    return counts
+
+
+@njit(cache=True)
+def _fill_zz_candidates(e_offsets, e_charge, m_offsets, m_charge, p4, cand_offsets, max_leptons, max_cands):
+    # p4 holds the cartesian four-vectors of all electrons followed by all muons
+    n_cands = cand_offsets[-1]
+    z1 = np.empty((4, n_cands), dtype=p4.dtype)
+    z2 = np.empty((4, n_cands), dtype=p4.dtype)
+    zz = np.empty((4, n_cands), dtype=p4.dtype)
+    # indices into p4 of the leptons of z1 (first two) and z2 (last two)
+    lep = np.empty((4, n_cands), dtype=np.int64)
+
+    # scratch buffers, allocated once
+    ep, em = np.empty(max_leptons, dtype=np.int64), np.empty(max_leptons, dtype=np.int64)
+    mp, mm = np.empty(max_leptons, dtype=np.int64), np.empty(max_leptons, dtype=np.int64)
+    quads = np.empty((max_cands, 4), dtype=np.int64)
+
+    for i in range(len(e_offsets) - 1):
+        k = cand_offsets[i]
+        if k == cand_offsets[i + 1]:
+            continue
+        n = _event_quads(i, e_offsets, e_charge, m_offsets, m_charge, ep, em, mp, mm, quads)
+        for q in range(n):
+            _fill_z_pair(z1, z2, zz, lep, k + q, p4, quads[q, 0], quads[q, 1], quads[q, 2], quads[q, 3])
+
+    return z1, z2, zz, lep
+
+
+@njit(cache=True)
+def _delta_r2(eta, phi, a, b):
+    dphi = (phi[a] - phi[b] + np.pi) % (2 * np.pi) - np.pi
+    return (eta[a] - eta[b])**2 + dphi**2
+
+
+@njit(cache=True)
+def _best_zz_candidates(
+    e_offsets, e_charge, m_offsets, m_charge, p4, pt, eta, phi, max_leptons, max_cands,
+    min_delta_r, min_os_mass,
+):
+    # per event, loop over all candidates in the order of _event_quads, apply the HZZ candidate
+    # requirements and store the best one, as well as the highest cut level reached by any of them
+    n_events = len(e_offsets) - 1
+    n_ele = e_offsets[-1]
+    best = np.full(n_events, -1, dtype=np.int64)
+    level = np.zeros(n_events, dtype=np.int8)
+    z1 = np.full((4, n_events), np.nan, dtype=p4.dtype)
+    z2 = np.full((4, n_events), np.nan, dtype=p4.dtype)
+    zz = np.full((4, n_events), np.nan, dtype=p4.dtype)
+    lep = np.zeros((4, n_events), dtype=np.int64)
+
+    # scratch buffers, allocated once
+    ep, em = np.empty(max_leptons, dtype=np.int64), np.empty(max_leptons, dtype=np.int64)
+    mp, mm = np.empty(max_leptons, dtype=np.int64), np.empty(max_leptons, dtype=np.int64)
+    quads = np.empty((max_cands, 4), dtype=np.int64)
+    min_delta_r2 = min_delta_r**2
+
+    for i in range(n_events):
+        n = _event_quads(i, e_offsets, e_charge, m_offsets, m_charge, ep, em, mp, mm, quads)
+        best_dz = np.inf
+        best_pt_sum = -np.inf
+        for q in range(n):
+            a, b, c, d = quads[q, 0], quads[q, 1], quads[q, 2], quads[q, 3]
+
+            # ghost removal: delta r between all leptons
+            if (
+                _delta_r2(eta, phi, a, b) <= min_delta_r2 or _delta_r2(eta, phi, a, c) <= min_delta_r2 or
+                _delta_r2(eta, phi, a, d) <= min_delta_r2 or _delta_r2(eta, phi, b, c) <= min_delta_r2 or
+                _delta_r2(eta, phi, b, d) <= min_delta_r2 or _delta_r2(eta, phi, c, d) <= min_delta_r2
+            ):
+                continue
+
+            # QCD suppression: mass of all opposite-sign pairs, regardless of flavor
+            m_ab, m_cd = _pair_mass(p4, a, b), _pair_mass(p4, c, d)
+            m_ad, m_cb = _pair_mass(p4, a, d), _pair_mass(p4, c, b)
+            if min(m_ab, m_cd, m_ad, m_cb) <= min_os_mass:
+                continue
+
+            # assign z1 and z2
+            if abs(m_ab - Z_MASS) < abs(m_cd - Z_MASS):
+                m_z1, m_z2, pt_sum_z2 = m_ab, m_cd, pt[c] + pt[d]
+            else:
+                m_z1, m_z2, pt_sum_z2 = m_cd, m_ab, pt[a] + pt[b]
+
+            # level 1: both Z candidates with 12 < m < 120
+            if not (12.0 < m_z1 < 120.0 and 12.0 < m_z2 < 120.0):
+                continue
+            level[i] = max(level[i], 1)
+
+            # level 2: z1 mass above 40
+            if m_z1 <= 40.0:
+                continue
+            level[i] = max(level[i], 2)
+
+            # level 3: four-lepton mass above 70 and the "smart cut" for 4e and 4mu candidates,
+            # rejecting candidates whose alternative pairing za/zb has a za closer to the Z mass
+            # than z1 while zb is below 12
+            ax, ay, az, ae = _sum_p4(p4, a, b)
+            bx, by, bz, be = _sum_p4(p4, c, d)
+            px, py, pz, e = ax + bx, ay + by, az + bz, ae + be
+            if e**2 - px**2 - py**2 - pz**2 <= 70.0**2:
+                continue
+            if (a < n_ele) == (c < n_ele):
+                if abs(m_ad - Z_MASS) < abs(m_cb - Z_MASS):
+                    m_za, m_zb = m_ad, m_cb
+                else:
+                    m_za, m_zb = m_cb, m_ad
+                if abs(m_za - Z_MASS) < abs(m_z1 - Z_MASS) and m_zb < 12.0:
+                    continue
+            level[i] = 3
+
+            # ranking: z1 closest to the Z mass, then highest scalar pt sum of the z2 leptons
+            dz = abs(m_z1 - Z_MASS)
+            if dz < best_dz or (dz == best_dz and pt_sum_z2 > best_pt_sum):
+                best_dz = dz
+                best_pt_sum = pt_sum_z2
+                best[i] = q
+                _fill_z_pair(z1, z2, zz, lep, i, p4, a, b, c, d)
+
+    return best, level, z1, z2, zz, lep
+
+
+def _cartesian_p4(leptons: ak.Array, dtype: np.dtype = np.float32) -> np.ndarray:
+    # flat (n, 4) array of px, py, pz, e
+    pt = np.asarray(ak.flatten(leptons.pt), dtype=dtype)
+    eta = np.asarray(ak.flatten(leptons.eta), dtype=dtype)
+    phi = np.asarray(ak.flatten(leptons.phi), dtype=dtype)
+    mass = np.asarray(ak.flatten(leptons.mass), dtype=dtype)
+    pz = pt * np.sinh(eta)
+    return np.stack([
+        pt * np.cos(phi),
+        pt * np.sin(phi),
+        pz,
+        np.sqrt(pt**2 + pz**2 + mass**2),
+    ], axis=1)
+
+
+def _offsets(leptons: ak.Array) -> np.ndarray:
+    offsets = np.zeros(len(leptons) + 1, dtype=np.int64)
+    np.cumsum(ak.num(leptons, axis=1), out=offsets[1:])
+    return offsets
+
+
+def _zz_kernel_inputs(electrons: ak.Array, muons: ak.Array, dtype: np.dtype) -> dict[str, Any]:
+    # flat buffers and sizes shared by the zz candidate kernels
+    e_offsets = _offsets(electrons)
+    m_offsets = _offsets(muons)
+    e_charge = np.asarray(ak.flatten(electrons.charge))
+    m_charge = np.asarray(ak.flatten(muons.charge))
+    counts = _count_zz_candidates(e_offsets, e_charge, m_offsets, m_charge)
+    max_leptons = max(np.max(np.diff(e_offsets), initial=1), np.max(np.diff(m_offsets), initial=1))
+    return {
+        "e_offsets": e_offsets,
+        "e_charge": e_charge,
+        "m_offsets": m_offsets,
+        "m_charge": m_charge,
+        "p4": np.concatenate([_cartesian_p4(electrons, dtype), _cartesian_p4(muons, dtype)], axis=0),
+        "counts": counts,
+        "max_leptons": int(max_leptons),
+        "max_cands": int(max(np.max(counts, initial=1), 1)),
+    }
+
+
+def _zz_records(inputs: dict[str, Any], z1: np.ndarray, z2: np.ndarray, zz: np.ndarray, lep: np.ndarray) -> dict:
+    # translate indices into p4 to flavors and local indices within the electron/muon collections
+    # and create flat z1, z2 and zz records
+    e_offsets, m_offsets = inputs["e_offsets"], inputs["m_offsets"]
+    n_ele = e_offsets[-1]
+    flavor = np.where(lep < n_ele, 11, 13).astype(np.int32)
+    local_idx = np.concatenate([
+        np.arange(n_ele) - np.repeat(e_offsets[:-1], np.diff(e_offsets)),
+        np.arange(m_offsets[-1]) - np.repeat(m_offsets[:-1], np.diff(m_offsets)),
+    ])[lep].astype(np.int32)
+
+    def to_record(values, **fields):
+        return ak.zip(
+            {**dict(zip(("pt", "eta", "phi", "mass"), values)), **fields},
+            with_name="PtEtaPhiMLorentzVector",
+        )
+
+    return {
+        "z1": to_record(z1, flavor=flavor[0], lep_idx1=local_idx[0], lep_idx2=local_idx[1]),
+        "z2": to_record(z2, flavor=flavor[2], lep_idx1=local_idx[2], lep_idx2=local_idx[3]),
+        "zz": to_record(zz),
+    }
+
+
+def build_zz_candidates(electrons: ak.Array, muons: ak.Array, dtype: np.dtype = np.float32) -> ak.Array:
+    """
+    Builds all ZZ candidates from the jagged *electrons* and *muons* collections in a single
+    compiled pass over their flat pt, eta, phi, mass and charge buffers.
+
+    The result is identical to concatenating the outputs of :py:func:`build_2e2mu`,
+    :py:func:`build_4sf` for electrons and :py:func:`build_4sf` for muons (in this order), but no
+    intermediate jagged pairings are created. As for the awkward helpers, the result is a per-event
+    record with the jagged fields ``z1``, ``z2`` and ``zz``, each holding ``pt``, ``eta``, ``phi``
+    and ``mass``. *z1* and *z2* additionally contain the ``flavor`` (11 or 13) of their leptons and
+    their positions ``lep_idx1`` and ``lep_idx2`` in the respective input collection.
+
+    Four-vectors are stored with *dtype* (see :py:func:`compute_dtype`), whereas pair sums and
+    masses are computed in double precision.
+    """
+    inputs = _zz_kernel_inputs(electrons, muons, dtype)
+    counts = inputs["counts"]
+    cand_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=cand_offsets[1:])
+
+    z1, z2, zz, lep = _fill_zz_candidates(
+        inputs["e_offsets"], inputs["e_charge"], inputs["m_offsets"], inputs["m_charge"], inputs["p4"],
+        cand_offsets, inputs["max_leptons"], inputs["max_cands"],
+    )
+    records = _zz_records(inputs, z1, z2, zz, lep)
+
+    return ak.zip({
+        name: ak.unflatten(record, counts)
+        for name, record in records.items()
+    }, depth_limit=1)
+
+
+def best_zz_candidate(
+    electrons: ak.Array,
+    muons: ak.Array,
+    min_delta_r: float = 0.02,
+    min_os_mass: float = 4.0,
+    dtype: np.dtype = np.float32,
+) -> ak.Array:
+    """
+    Performs the HZZ best-candidate arbitration for the jagged *electrons* and *muons* in a single
+    compiled pass over their flat buffers, without materializing any of the candidates.
+
+    Each candidate (enumerated as in :py:func:`build_zz_candidates`) must pass the ghost removal
+    (delta R between all leptons above *min_delta_r*), the QCD suppression (mass of all
+    opposite-sign pairs above *min_os_mass*), 12 < m(Z) < 120 for both Z candidates (level 1),
+    m(Z1) > 40 (level 2), as well as m(4l) > 70 and the "smart cut" (level 3). Among the candidates
+    reaching level 3, the one with Z1 closest to the Z mass is chosen, followed by the highest
+    scalar pt sum of the Z2 leptons in case of ties.
+
+    Returns a flat record per event with the fields ``index`` (position of the best candidate in
+    the output of :py:func:`build_zz_candidates`, -1 if there is none), ``level`` (the highest
+    level reached by any candidate), and ``z1``, ``z2`` and ``zz`` of the best candidate as in
+    :py:func:`build_zz_candidates` (*None* if there is none). Inputs and outputs use *dtype*, see
+    :py:func:`build_zz_candidates`.
+    """
+    inputs = _zz_kernel_inputs(electrons, muons, dtype)
+    flat = lambda field: np.concatenate([
+        np.asarray(ak.flatten(electrons[field]), dtype=dtype),
+        np.asarray(ak.flatten(muons[field]), dtype=dtype),
+    ])
+
+    best, level, z1, z2, zz, lep = _best_zz_candidates(
+        inputs["e_offsets"], inputs["e_charge"], inputs["m_offsets"], inputs["m_charge"], inputs["p4"],
+        flat("pt"), flat("eta"), flat("phi"), inputs["max_leptons"], inputs["max_cands"],
+        min_delta_r, min_os_mass,
+    )
+    records = _zz_records(inputs, z1, z2, zz, lep)
+    has_best = best >= 0
+
+    return ak.zip({
+        "index": best,
+        "level": level,
+        **{name: ak.mask(record, has_best) for name, record in records.items()},
+    }, depth_limit=1)
+
+
+def evaluate_on_subset(
+    mask: ak.Array | np.ndarray,
+    func: Callable,
+    *args,
+    fill_values: dict[str, Any] | None = None,
+    **kwargs,
+) -> dict[str, ak.Array | np.ndarray]:
+    """
+    Evaluates an expensive block *func* only on the rows of *args* that pass the (cheap) prefilter
+    *mask* and scatters its results back to the full length. *func* is called with the compressed
+    *args* and *kwargs* and must return a dictionary of arrays with one entry per passed row.
+
+    Flat results are returned as numpy arrays in which rows that skipped the block are set to the
+    value in *fill_values* for that key, defaulting to *False* for booleans and ``EMPTY_FLOAT``
+    otherwise. Nested results are gathered back as awkward arrays with *None* in skipped rows,
+    unless a fill value is given explicitly.
+    """
+    mask = np.asarray(ak.fill_none(mask, False), dtype=bool)
+    fill_values = fill_values or {}
+    n = len(mask)
+    idx = np.flatnonzero(mask)
+
+    results = func(*(arg[idx] for arg in args), **kwargs)
+
+    # option-type index to gather nested results back to full length
+    gather_idx = None
+
+    scattered = {}
+    for key, value in results.items():
+        if isinstance(value, np.ndarray) or (value.ndim == 1 and not value.fields):
+            value = np.asarray(value)
+            fill_value = fill_values.get(key, False if value.dtype == bool else EMPTY_FLOAT)
+            full = np.full(n, fill_value, dtype=value.dtype)
+            full[idx] = value
+        else:
+            if gather_idx is None:
+                gather_idx = np.full(n, -1, dtype=np.int64)
+                gather_idx[idx] = np.arange(len(idx))
+                gather_idx = ak.mask(gather_idx, mask)
+            full = value[gather_idx]
+            if key in fill_values:
+                full = ak.fill_none(full, fill_values[key], axis=0)
+        scattered[key] = full
+
+    return scattered
+
+
+def mask_from_indices(indices: ak.Array, layout: ak.Array) -> ak.Array:
+    """
+    Converts the jagged, event-local *indices* (e.g. object indices in a ``SelectionResult``) into
+    a boolean mask with the same structure as the collection *layout*, where all entries referred to
+    by *indices* are *True*. The scatter is performed on the flat buffers in linear time.
+    """
+    counts = np.asarray(ak.num(layout, axis=1))
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    # shift local indices by the event offsets and scatter into a flat mask
+    flat_idx = np.asarray(ak.flatten(indices + offsets[:-1], axis=1))
+    mask = np.zeros(offsets[-1], dtype=bool)
+    mask[flat_idx] = True
+
+    return ak.unflatten(mask, counts)
+
+
+def instrumentation_enabled() -> bool:
+    """
+    Returns whether the per-step instrumentation of :py:func:`instrument_step` is enabled, either
+    through the ``H4L_INSTRUMENT`` environment variable or, if not set, the ``h4l_instrument``
+    option in the ``[analysis]`` section of the law config.
+    """
+    flag = os.getenv("H4L_INSTRUMENT")
+    if flag is None:
+        flag = law.config.get_expanded("analysis", "h4l_instrument", False)
+    return law.util.flag_to_bool(flag)
+
+
+# peak memory of the currently running steps of instrument_step, outermost first, observed before
+# their peaks were reset by nested steps
+_instrument_peaks: list[int] = []
+
+
+@contextlib.contextmanager
+def instrument_step(
+    func: ArrayFunction,
+    step: str,
+    events: ak.Array,
+    stats: dict | None = None,
+    task: law.Task | None = None,
+    **kwargs,
+):
+    """
+    Context manager measuring the wall time, the event rate, the allocated bytes and the peak memory
+    of the code block *step* executed within the array function *func* on *events*. Does nothing
+    unless :py:func:`instrumentation_enabled`.
+
+    The summable numbers (seconds, events and allocated bytes) are added to *stats* under
+    ``instrumentation.<step>.*`` so that they are merged across chunks and branches. When *task* is
+    given, the full record is appended to the JSONL sidecar ``instrumentation_<branch>.jsonl`` in the
+    output directory of the task. Additional *kwargs* are accepted (and ignored) so that the keyword
+    arguments of the array function can be forwarded as is. Steps can be nested, in which case the
+    peak of the enclosing step includes that of the nested one. Memory tracing started outside of
+    this function is not reset, so that the peak of such a step might include earlier allocations.
+
+    .. code-block:: python
+
+        with instrument_step(self, "trigger", events, stats=stats, **kwargs):
+            events, trigger_results = self[trigger_selection](events, **kwargs)
+    """
+    if not instrumentation_enabled():
+        yield
+        return
+
+    # start memory tracing if not done by an outer caller already
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    mem_start, mem_peak = tracemalloc.get_traced_memory()
+
+    # only reset the peak when tracing is owned by this or an enclosing step, which keeps the peak
+    # observed so far in the stack
+    owns_peak = started_tracing or bool(_instrument_peaks)
+    if owns_peak:
+        if _instrument_peaks:
+            _instrument_peaks[-1] = max(_instrument_peaks[-1], mem_peak)
+        tracemalloc.reset_peak()
+        _instrument_peaks.append(0)
+    t_start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - t_start
+        mem_end, mem_peak = tracemalloc.get_traced_memory()
+        if owns_peak:
+            # include peaks of nested steps, and pass the peak on to the enclosing step
+            mem_peak = max(mem_peak, _instrument_peaks.pop())
+            if _instrument_peaks:
+                _instrument_peaks[-1] = max(_instrument_peaks[-1], mem_peak)
+        if started_tracing:
+            tracemalloc.stop()
+
+        n_events = len(events)
+        record = {
+            "func": func.cls_name,
+            "step": step,
+            "events": n_events,
+            "seconds": duration,
+            "events_per_second": n_events / duration if duration > 0 else 0.0,
+            "allocated_bytes": mem_end - mem_start,
+            "peak_bytes": mem_peak - mem_start,
+        }
+
+        # only summable quantities go into the stats
+        if stats is not None:
+            for key in ["seconds", "events", "allocated_bytes"]:
+                stats[f"instrumentation.{step}.{key}"] += record[key]
+
+        # append the full record to the per-branch sidecar
+        if task is not None:
+            branch = getattr(task, "branch", -1)
+            record["branch"] = branch
+            path = task.local_path(f"instrumentation_{branch}.jsonl")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+        _logger.debug(
+            f"{func.cls_name}.{step}: {duration:.3f} s, {record['events_per_second']:.1f} events/s, "
+            f"peak {record['peak_bytes'] / 1024**2:.1f} MB",
+        )
+
+
+def uses_audit_enabled() -> bool:
+    """
+    Returns whether the audit of declared column usage (see :py:func:`audit_uses`) is enabled,
+    either through the ``H4L_AUDIT_USES`` environment variable or, if not set, the
+    ``h4l_audit_uses`` option in the ``[analysis]`` section of the law config.
+    """
+    flag = os.getenv("H4L_AUDIT_USES")
+    if flag is None:
+        flag = law.config.get_expanded("analysis", "h4l_audit_uses", False)
+    return law.util.flag_to_bool(flag)
+
+
+def _form_key_routes(form, route: tuple = (), routes: dict | None = None) -> dict[str, tuple[str, bool]]:
+    """
+    Maps the form keys of all nodes in *form* to the dot-format route of the column they belong to
+    and whether the node is a leaf holding the actual column data.
+    """
+    if routes is None:
+        routes = {}
+
+    if form.is_record:
+        for field, content in zip(form.fields, form.contents):
+            _form_key_routes(content, route + (field,), routes)
+    elif form.is_union:
+        for content in form.contents:
+            _form_key_routes(content, route, routes)
+    elif hasattr(form, "content"):
+        _form_key_routes(form.content, route, routes)
+
+    if form.form_key is not None:
+        routes[form.form_key] = (".".join(route), form.is_numpy)
+
+    return routes
+
+
+def track_column_access(events: ak.Array) -> tuple[ak.Array, dict[str, set[str]]]:
+    """
+    Returns a copy of *events* whose buffers are only materialized on first access, and a dict that
+    is filled with the routes of columns whose data was accessed (``"data"``) and of collections of
+    which only the structure (e.g. counts) was accessed (``"structure"``). Works transparently with
+    numpy, numba and awkward operations as the tracking happens on the level of buffers.
+    """
+    form, length, container = ak.to_buffers(events)
+    routes = _form_key_routes(form)
+    accessed = {"data": set(), "structure": set()}
+
+    def lazy_buffer(key, buffer):
+        route, is_leaf = routes[key.rsplit("-", 1)[0]]
+
+        def materialize():
+            accessed["data" if is_leaf else "structure"].add(route)
+            return buffer
+
+        return materialize
+
+    lazy_events = ak.from_buffers(
+        form,
+        length,
+        {key: lazy_buffer(key, buffer) for key, buffer in container.items()},
+        behavior=events.behavior,
+        attrs=events.attrs,
+    )
+
+    return lazy_events, accessed
+
+
+def audit_uses(
+    func: ArrayFunction,
+    events: ak.Array,
+    *args,
+    invoke: Callable | None = None,
+    **kwargs,
+) -> tuple[Any, dict[str, list[str]]]:
+    """
+    Invokes the array function *func* (or *invoke* instead, when given) with *events* wrapped by
+    :py:func:`track_column_access`, and all *args* and *kwargs*, and compares the columns read during
+    the call to the ones declared in its (resolved) ``uses``. Returns the result of the call and a
+    report with the sorted lists of columns that are
+
+        - ``"declared_unused"``: declared but never read (only counting collection sizes does not
+          count as reading a column),
+        - ``"undeclared_used"``: read but not declared (mandatory coffea columns excluded), and
+        - ``"structure_only"``: collections of which only the structure was accessed.
+    """
+    lazy_events, accessed = track_column_access(events)
+    result = (invoke or func)(lazy_events, *args, **kwargs)
+
+    # freeze the accessed columns, as later materializations of the result are not caused by func
+    used = set(accessed["data"])
+    structure_only = accessed["structure"] - {
+        ".".join(column.split(".")[:i]) for column in used for i in range(1, column.count(".") + 1)
+    }
+    declared = {Route(route).column for route in func.used_columns}
+    ignore = set(mandatory_coffea_columns)
+
+    report = {
+        "declared_unused": sorted(
+            column for column in declared
+            if not any(law.util.multi_match(used_column, [column]) for used_column in used)
+        ),
+        "undeclared_used": sorted(
+            column for column in used - ignore
+            if not law.util.multi_match(column, list(declared))
+        ),
+        "structure_only": sorted(structure_only),
+    }
+
+    return result, report
+
+
+# process-wide caches of file hashes and correction sets
+_file_hashes: dict[tuple, str] = {}
+_correction_sets: dict[str, Any] = {}
+
+
+def _file_hash(path: str) -> str:
+    # content hash of the file at *path*, cached as long as its modification time and size persist
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key not in _file_hashes:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        _file_hashes[key] = h.hexdigest()
+    return _file_hashes[key]
+
+
+def correction_cache_dir() -> str | None:
+    """
+    Returns the directory in which decompressed correction files are stored for reuse across
+    processes, configured by the ``h4l_correction_cache_dir`` option in the ``[analysis]`` section
+    of the law config, or *None* when not set.
+    """
+    path = law.config.get_expanded("analysis", "h4l_correction_cache_dir", None)
+    return os.path.expandvars(os.path.expanduser(path)) if path else None
+
+
+def load_correction_set(target: law.FileSystemFileTarget | str) -> Any:
+    """
+    Drop-in replacement for :py:func:`columnflow.util.load_correction_set` that loads the correction
+    set in the file *target* only once per process, keyed by the hash of its content.
+
+    Compressed files are decompressed once into the :py:func:`correction_cache_dir` (when set), so
+    that subsequent processes can let correctionlib parse the plain json file directly instead of
+    decompressing and decoding it in python.
+
+    This set-level cache is the only one. Callers, including the columnflow producers and
+    calibrators using the patched function, index the returned set by correction name, which is a
+    cheap lookup of correction objects that are shared as long as the set is cached.
+    """
+    import correctionlib
+
+    # extend the Correction object
+    correctionlib.highlevel.Correction.__call__ = correctionlib.highlevel.Correction.evaluate
+
+    path = target if isinstance(target, str) else target.abspath
+    path = os.path.abspath(os.path.expandvars(os.path.expanduser(path)))
+    file_hash = _file_hash(path)
+    if file_hash in _correction_sets:
+        return _correction_sets[file_hash]
+
+    if path.endswith(".json"):
+        correction_set = correctionlib.CorrectionSet.from_file(path)
+    else:
+        # assume the input file is compressed
+        cache_dir = correction_cache_dir()
+        json_path = os.path.join(cache_dir, f"{file_hash}.json") if cache_dir else None
+        if json_path and os.path.exists(json_path):
+            correction_set = correctionlib.CorrectionSet.from_file(json_path)
+        else:
+            with gzip.open(path, "rb") as f:
+                content = f.read()
+            if json_path:
+                # write atomically, as several processes might do this at the same time
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = f"{json_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(content)
+                os.replace(tmp_path, json_path)
+            correction_set = correctionlib.CorrectionSet.from_string(content.decode("utf-8"))
+
+    _correction_sets[file_hash] = correction_set
+    _logger.debug(f"loaded correction set from {path} (hash {file_hash[:10]})")
+
+    return correction_set
+
+
+def _writable_view(layout) -> np.ndarray | None:
+    # writable view of the flat content buffer of a (jagged) array of numbers, or None
+    if isinstance(layout, ak.contents.NumpyArray):
+        data = layout.data
+    elif isinstance(layout, ak.contents.ListOffsetArray) and isinstance(layout.content, ak.contents.NumpyArray):
+        offsets = np.asarray(layout.offsets)
+        data = layout.content.data
+        data = data[offsets[0]:offsets[-1]] if isinstance(data, np.ndarray) else None
+    else:
+        return None
+
+    if not isinstance(data, np.ndarray) or data.ndim != 1 or not data.flags.writeable:
+        return None
+
+    return data
+
+
+def _wrap_buffer(array: ak.Array, buffer: np.ndarray) -> ak.Array:
+    # packed, (at most singly jagged) array with its content replaced by the flat buffer
+    layout = ak.to_layout(array)
+    content = ak.contents.NumpyArray(buffer, parameters=layout.content.parameters if layout.is_list else None)
+    if layout.is_list:
+        content = ak.contents.ListOffsetArray(layout.offsets, content, parameters=layout.parameters)
+    return ak.Array(content, behavior=array.behavior, attrs=array.attrs)
+
+
+def jagged_buffer(array: ak.Array, inplace: bool = False) -> tuple[ak.Array, np.ndarray]:
+    """
+    Returns the (at most singly jagged) *array* of numbers together with a writable, flat view of
+    its content buffer. Changes to the view are directly reflected in the returned array.
+
+    By default, the content of *array* is copied once into a new buffer, so that *array* and all
+    other arrays sharing its buffer remain unchanged. With *inplace* set to *True*, the returned
+    array is *array* itself whenever possible, and changes to the view are visible to all arrays
+    sharing the same buffer. This should only be used for buffers allocated by the caller itself.
+    Only when the content is not contiguous or read-only (e.g. when backed by arrow memory), it is
+    packed into a new, writable buffer first.
+    """
+    if not inplace:
+        array = ak.to_packed(array)
+        view = np.array(ak.flatten(array, axis=None))
+        return _wrap_buffer(array, view), view
+
+    view = _writable_view(ak.to_layout(array))
+    if view is None:
+        array = ak.to_packed(array)
+        view = _writable_view(ak.to_layout(array))
+        if view is None:
+            array = ak.copy(array)
+            view = _writable_view(ak.to_layout(array))
+        if view is None:
+            raise TypeError(f"cannot obtain a flat content buffer of array with type {array.type}")
+
+    return array, view
+
+
+def jagged_ufunc(
+    array: ak.Array,
+    ufunc: np.ufunc,
+    *args,
+    mask: ak.Array | np.ndarray | None = None,
+    inplace: bool = False,
+) -> ak.Array:
+    """
+    Applies the numpy *ufunc* with *array* as first operand and additional operands *args* (scalars
+    or arrays with the same structure) to the flat content buffer of *array*, and returns the result
+    wrapped with the original offsets. When *mask* is given, only entries where it is *True* are
+    changed. Example:
+
+    .. code-block:: python
+
+        # scale jets with pt < 30 GeV by 1.1, with a single new pt content buffer
+        pt = jagged_ufunc(events.Jet.pt, np.multiply, 1.1, mask=events.Jet.pt < 30)
+
+    By default, the result is written into a single, new buffer and *array* is left unchanged. With
+    *inplace* set to *True*, the buffer of *array* is changed in place instead (see
+    :py:func:`jagged_buffer`), which should only be done for arrays allocated by the caller itself.
+    """
+    if inplace:
+        array, buffer = jagged_buffer(array, inplace=True)
+        out = buffer
+    else:
+        array = ak.to_packed(array)
+        buffer = np.asarray(ak.flatten(array, axis=None))
+        out = buffer.copy() if mask is not None else np.empty_like(buffer)
+
+    # flatten operands and mask
+    flat = lambda arr: np.asarray(ak.flatten(arr, axis=None)) if isinstance(arr, ak.Array) else arr  # noqa: E731
+    args = [flat(arg) for arg in args]
+    where = True if mask is None else flat(mask)
+
+    ufunc(buffer, *args, out=out, where=where)
+
+    # wrap the new buffer with the original offsets
+    return array if inplace else _wrap_buffer(array, out)
+
+
+# bin edges of binned inputs (or None for categorical ones) per correction set and correction
+_correction_bin_edges: dict[tuple[int, str], dict[str, np.ndarray | None] | None] = {}
+
+
+def _collect_bin_edges(node: Any, edges: dict[str, list]) -> bool:
+    # recursively collects edges per binned input into *edges* (None for categorical inputs),
+    # returns False when the node is not piecewise constant in its inputs
+    if isinstance(node, (int, float)):
+        return True
+    if not isinstance(node, dict):
+        return False
+
+    def add(name, _edges):
+        if isinstance(_edges, dict):
+            _edges = np.linspace(_edges["low"], _edges["high"], _edges["n"] + 1)
+        if edges.get(name, []) is not None:
+            edges.setdefault(name, []).extend(_edges)
+
+    nodetype = node.get("nodetype")
+    if nodetype == "binning":
+        add(node["input"], node["edges"])
+        content = node["content"]
+    elif nodetype == "multibinning":
+        for name, _edges in zip(node["inputs"], node["edges"]):
+            add(name, _edges)
+        content = node["content"]
+    elif nodetype == "category":
+        edges[node["input"]] = None
+        content = [item["value"] for item in node["content"]]
+        if node.get("default") is not None:
+            content.append(node["default"])
+    else:
+        # formulas, transforms, etc.
+        return False
+
+    # flow behavior can be a constant or another node as well
+    flow = node.get("flow")
+    if isinstance(flow, dict):
+        content = [*content, flow]
+
+    return all(_collect_bin_edges(child, edges) for child in content)
+
+
+def correction_bin_edges(correction: Any) -> dict[str, np.ndarray | None] | None:
+    """
+    Returns a dictionary mapping the names of the inputs of a correctionlib *correction* to the
+    union of all bin edges used for them anywhere in the correction, or *None* for categorical
+    inputs. Inputs that are not used for binning or categorization are missing. *None* is returned
+    when the correction is not piecewise constant in its inputs (e.g. due to formulas), or when its
+    json content is not available (i.e., when it was not loaded through a highlevel correction set).
+    """
+    context = getattr(correction, "_context", None)
+    data = getattr(context, "_data", None)
+    key = (id(context), correction.name)
+    if key in _correction_bin_edges:
+        return _correction_bin_edges[key]
+
+    edges = None
+    if isinstance(data, str):
+        content = next(
+            (corr for corr in json.loads(data)["corrections"] if corr["name"] == correction.name),
+            None,
+        )
+        _edges = {}
+        if content is not None and _collect_bin_edges(content["data"], _edges):
+            edges = {
+                name: (None if values is None else np.unique(np.asarray(values, dtype=np.float64)))
+                for name, values in _edges.items()
+            }
+    _correction_bin_edges[key] = edges
+
+    return edges
+
+
+def group_by_bins(
+    edges: dict[str, np.ndarray | None],
+    values: dict[str, np.ndarray],
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Groups the flat arrays in *values* by the cells defined by the bin *edges* of the corresponding
+    inputs (see :py:func:`correction_bin_edges`), or by their exact value for categorical inputs
+    (*None* edges). Values without edges are ignored. Non-finite values form a separate group per
+    input. Returns the index of one representative entry per group, and the group index of each
+    entry, so that a piecewise constant function *f* can be evaluated as
+
+    .. code-block:: python
+
+        first, inverse = group_by_bins(edges, values)
+        result = f(*(arr[first] for arr in values.values()))[inverse]
+    """
+    n = len(next(iter(values.values()))) if values else 0
+    codes = np.zeros(n, dtype=np.int64)
+    for name, arr in values.items():
+        if name not in edges:
+            continue
+        arr = np.asarray(arr)
+        if edges[name] is None:
+            _, idx = np.unique(arr, return_inverse=True)
+            n_cells = idx.max() + 1 if n else 1
+        else:
+            # cells [edge_i, edge_i+1), plus underflow, overflow and non-finite values
+            idx = np.searchsorted(edges[name], arr, side="right")
+            n_cells = len(edges[name]) + 2
+            idx[~np.isfinite(arr)] = n_cells - 1
+        codes = codes * n_cells + idx
+
+    _, first, inverse = np.unique(codes, return_index=True, return_inverse=True)
+
+    return first, inverse.reshape(-1)
+
+
+# constants of the Philox4x32 generator (Salmon et al., "Parallel random numbers: as easy as
+# 1, 2, 3", SC11), held in 64 bit to keep products of 32 bit words exact
+_PHILOX_M0 = np.uint64(0xD2511F53)
+_PHILOX_M1 = np.uint64(0xCD9E8D57)
+_PHILOX_W0 = np.uint64(0x9E3779B9)
+_PHILOX_W1 = np.uint64(0xBB67AE85)
+_PHILOX_MASK = np.uint64(0xFFFFFFFF)
+_PHILOX_SHIFT = np.uint64(32)
+
+
+@njit(cache=True)
+def _philox4x32(c0, c1, c2, c3, k0, k1):
+    # ten rounds of Philox4x32 on the counter (c0, c1, c2, c3) with key (k0, k1), all given as
+    # uint64 holding 32 bit words
+    for _ in range(10):
+        p0 = _PHILOX_M0 * c0
+        p1 = _PHILOX_M1 * c2
+        c0, c1, c2, c3 = (
+            (p1 >> _PHILOX_SHIFT) ^ c1 ^ k0,
+            p1 & _PHILOX_MASK,
+            (p0 >> _PHILOX_SHIFT) ^ c3 ^ k1,
+            p0 & _PHILOX_MASK,
+        )
+        k0 = (k0 + _PHILOX_W0) & _PHILOX_MASK
+        k1 = (k1 + _PHILOX_W1) & _PHILOX_MASK
+    return c0, c1, c2, c3
+
+
+@njit(cache=True)
+def _to_unit(a, b):
+    # uniform double in the open interval (0, 1) from the upper 53 bits of two 32 bit words
+    return (np.float64((a >> np.uint64(5)) * np.uint64(67108864) + (b >> np.uint64(6))) + 0.5) / 9007199254740992.0
+
+
+@njit(cache=True)
+def _counter_variates(seeds, offsets, stream, normal, out):
+    # fills *out* with one variate per object, keyed by the seed of its event and counted by its
+    # local index and the *stream*
+    for i in range(len(seeds)):
+        k0 = seeds[i] & _PHILOX_MASK
+        k1 = seeds[i] >> _PHILOX_SHIFT
+        for j in range(offsets[i + 1] - offsets[i]):
+            r0, r1, r2, r3 = _philox4x32(np.uint64(j), stream, np.uint64(0), np.uint64(0), k0, k1)
+            u = _to_unit(r0, r1)
+            if normal:
+                # Box-Muller transform of the two uniforms
+                u = math.sqrt(-2.0 * math.log(u)) * math.cos(2.0 * math.pi * _to_unit(r2, r3))
+            out[offsets[i] + j] = u
+
+
+def counter_random(
+    seeds: ak.Array | np.ndarray,
+    objects: ak.Array | None = None,
+    stream: int = 0,
+    distribution: str = "uniform",
+    dtype: np.dtype = np.float64,
+) -> ak.Array | np.ndarray:
+    """
+    Returns reproducible random variates for all *objects* of a jagged collection in one call,
+    drawn from a counter-based Philox4x32-10 generator that is keyed by the per-event *seeds* (e.g.
+    ``events.deterministic_seed``) and counted by the local index of each object and the *stream*
+    id. The result has the same layout as *objects*, or one variate per event when *objects* is
+    *None*. *distribution* is either ``"uniform"`` (in the open interval (0, 1)) or ``"normal"``
+    (standard normal). Example:
+
+    .. code-block:: python
+
+        # relative jet resolution smearing
+        smear = 1.0 + res * counter_random(events.deterministic_seed, events.Jet, stream=1, distribution="normal")
+
+    As each variate only depends on the seed of its event, the index of the object and the stream
+    id, results do not depend on the chunking of events or the order of processing. Independent
+    random numbers for the same objects (e.g. different smearings) should use different streams.
+    """
+    if distribution not in {"uniform", "normal"}:
+        raise ValueError(f"unknown distribution '{distribution}', expected 'uniform' or 'normal'")
+    if not 0 <= stream < 2**32:
+        raise ValueError(f"stream id must be an unsigned 32 bit integer, got {stream}")
+
+    seeds = np.asarray(seeds).astype(np.uint64, copy=False)
+    offsets = np.arange(len(seeds) + 1, dtype=np.int64)
+    if objects is not None:
+        np.cumsum(ak.num(objects, axis=1), out=offsets[1:])
+
+    out = np.empty(offsets[-1], dtype=np.float64)
+    _counter_variates(seeds, offsets, np.uint64(stream), distribution == "normal", out)
+    out = out.astype(dtype, copy=False)
+
+    if objects is None:
+        return out
+    return ak.unflatten(out, offsets[1:] - offsets[:-1])
+
+
 def masked_sorted_indices(mask: ak.Array, sort_var: ak.Array, ascending: bool = False) -> ak.Array:
   """
   Helper function to obtain the correct indices of an object mask
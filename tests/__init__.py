@@ -5,7 +5,7 @@
 Entry point for all tests.
 """
 
-__all__ = []
+__all__ = ["UtilTest", "WeightsTest"]
 
 # adjust the path to import the package
 import os
@@ -15,4 +15,5 @@ sys.path.append(base)
 import h4l  # noqa
 
 # import all tests
-# ...
+from .test_util import *
+from .test_weights import *
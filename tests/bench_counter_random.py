@@ -0,0 +1,66 @@
+# coding: utf-8
+
+"""
+Benchmark of the counter-based random numbers of h4l.util.counter_random against normal variates
+drawn from one np.random.Generator per object (as for deterministic smearings in columnflow), on
+synthetic jet collections. Also checks that results do not depend on the chunking of events. Run
+with
+
+    python tests/bench_counter_random.py [n_events] [mean_jets]
+
+in the columnar sandbox.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import awkward as ak
+
+base = os.path.normpath(os.path.join(os.path.abspath(__file__), "../.."))
+sys.path.append(base)
+
+from h4l.util import counter_random  # noqa
+
+
+def generator_normal(seeds, jets):
+    # one generator per object, seeded by the event seed shifted by the local object index
+    flat_seeds = np.asarray(ak.flatten(ak.local_index(jets, axis=1) + seeds), dtype=np.uint64)
+    values = np.asarray([np.random.Generator(np.random.SFC64(int(seed))).normal() for seed in flat_seeds])
+    return ak.unflatten(values, ak.num(jets, axis=1))
+
+
+def main(n_events=100000, mean_jets=4.0, chunk_size=7919):
+    rng = np.random.default_rng(11)
+    seeds = rng.integers(0, 2**63, n_events, dtype=np.uint64)
+    counts = rng.poisson(mean_jets, n_events)
+    jets = ak.unflatten(ak.zip({"pt": rng.exponential(40.0, counts.sum())}), counts)
+
+    # warm up the jit compilation
+    counter_random(seeds[:10], jets[:10], distribution="normal")
+
+    t0 = time.perf_counter()
+    whole = counter_random(seeds, jets, stream=1, distribution="normal")
+    t_counter = time.perf_counter() - t0
+
+    chunked = ak.concatenate([
+        counter_random(seeds[i:i + chunk_size], jets[i:i + chunk_size], stream=1, distribution="normal")
+        for i in range(0, n_events, chunk_size)
+    ])
+
+    t0 = time.perf_counter()
+    generator_normal(seeds, jets)
+    t_generator = time.perf_counter() - t0
+
+    flat = np.asarray(ak.flatten(whole))
+    print(f"events: {n_events}, jets: {len(flat)}")
+    print(f"counter-based: {t_counter:8.3f} s")
+    print(f"generators   : {t_generator:8.3f} s")
+    print(f"speedup      : {t_generator / t_counter:8.1f}")
+    print(f"chunk independent: {bool(ak.all(whole == chunked))}")
+    print(f"mean: {flat.mean():.4f}, std: {flat.std():.4f}")
+
+
+if __name__ == "__main__":
+    main(*[float(arg) if i else int(arg) for i, arg in enumerate(sys.argv[1:])])
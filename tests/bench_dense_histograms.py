@@ -0,0 +1,116 @@
+# coding: utf-8
+
+"""
+Benchmark of the single-pass dense histogram filling of h4l.histogramming.default against
+columnflow's fill_hist per variable and weight variant on synthetic events, checking that values
+and variances agree in all bins including flow bins. Run with
+
+    python tests/bench_dense_histograms.py [n_events]
+
+in the columnar sandbox.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import awkward as ak
+import order as od
+
+base = os.path.normpath(os.path.join(os.path.abspath(__file__), "../.."))
+sys.path.append(base)
+
+from columnflow.hist_util import create_hist_from_variables, fill_hist  # noqa
+from columnflow.columnar_util import EMPTY_FLOAT  # noqa
+from h4l.histogramming.default import DenseHistogram, fill_dense_histograms  # noqa
+
+
+def main(n_events=200000):
+    rng = np.random.default_rng(3)
+
+    config_inst = od.Config(name="bench", id=1, campaign=od.Campaign("bench", 1))
+    variable_insts = {
+        "m4l": config_inst.add_variable(name="m4l", binning=(40, 70.0, 170.0)),
+        "z1_mass": config_inst.add_variable(name="z1_mass", binning=[0, 20, 40, 60, 80, 100, 120]),
+        "n_ele": config_inst.add_variable(name="n_ele", binning=(6, -0.5, 5.5), discrete_x=True),
+        "jet_pt": config_inst.add_variable(name="jet_pt", binning=(20, 0.0, 200.0)),
+    }
+    var_keys = [("m4l",), ("z1_mass",), ("n_ele",), ("jet_pt",), ("m4l", "z1_mass")]
+
+    n_cats = rng.integers(0, 3, n_events)
+    n_jets = rng.integers(0, 4, n_events)
+    # values including NaN, values on the last edge, missing values replaced by a null value as done
+    # by Route.apply, and None, which fill_dense_histograms treats like NaN
+    values = {
+        "m4l": np.where(rng.random(n_events) < 0.01, np.nan, rng.uniform(60.0, 180.0, n_events)),
+        "z1_mass": np.where(rng.random(n_events) < 0.01, 120.0, rng.uniform(-5.0, 130.0, n_events)),
+        "n_ele": rng.integers(0, 7, n_events),
+        "jet_pt": ak.unflatten(
+            ak.mask(
+                np.where(rng.random(n_jets.sum()) < 0.01, np.nan, rng.uniform(0.0, 250.0, n_jets.sum())),
+                rng.random(n_jets.sum()) > 0.01,
+            ),
+            n_jets,
+        ),
+    }
+    values["z1_mass"][rng.random(n_events) < 0.01] = EMPTY_FLOAT
+    category = ak.unflatten(rng.choice([1, 110, 220, 320], n_cats.sum()), n_cats)
+    process = rng.choice([11, 12], n_events)
+    weights = {0: rng.normal(1.0, 0.3, n_events), 5: rng.normal(1.0, 0.3, n_events)}
+
+    # dense filling of all variables and weight variants at once
+    t0 = time.perf_counter()
+    dense = {key: DenseHistogram([variable_insts[name] for name in key]) for key in var_keys}
+    fill_dense_histograms(
+        dense,
+        {key: [values[name] for name in key] for key in var_keys},
+        category,
+        process,
+        weights,
+    )
+    dense = {key: h.to_hist() for key, h in dense.items()}
+    t_dense = time.perf_counter() - t0
+
+    # filling per variable and weight variant, with None replaced by NaN as fill_hist cannot handle it
+    ref_values = {name: (ak.fill_none(v, np.nan) if isinstance(v, ak.Array) else v) for name, v in values.items()}
+    t0 = time.perf_counter()
+    ref = {}
+    for key in var_keys:
+        ref[key] = create_hist_from_variables(
+            *[variable_insts[name] for name in key],
+            categorical_axes=[("category", "intcat"), ("process", "intcat"), ("shift", "intcat")],
+            weight=True,
+        )
+        for shift_id, weight in weights.items():
+            fill_data = {"category": category, "process": process, "shift": shift_id, "weight": weight}
+            fill_hist(ref[key], fill_data | {name: ref_values[name] for name in key})
+    t_ref = time.perf_counter() - t0
+
+    # compare all bins, looked up by categorical values, requiring exact agreement
+    max_diff = 0.0
+    for key in var_keys:
+        for cat in [1, 110, 220, 320]:
+            for proc in [11, 12]:
+                for shift_id in weights:
+                    views = [
+                        h[{
+                            "category": h.axes["category"].index(cat),
+                            "process": h.axes["process"].index(proc),
+                            "shift": h.axes["shift"].index(shift_id),
+                        }].view(flow=True)
+                        for h in (dense[key], ref[key])
+                    ]
+                    for field in ["value", "variance"]:
+                        max_diff = max(max_diff, np.max(np.abs(views[0][field] - views[1][field])))
+                        np.testing.assert_array_equal(views[0][field], views[1][field])
+
+    print(f"events: {n_events}, histograms: {len(var_keys)}, weight variants: {len(weights)}")
+    print(f"dense    : {t_dense:8.3f} s")
+    print(f"fill_hist: {t_ref:8.3f} s")
+    print(f"speedup  : {t_ref / t_dense:8.1f}")
+    print(f"max abs difference of values and variances: {max_diff:.3e}")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,173 @@
+# coding: utf-8
+
+"""
+Benchmark of the compiled jet-lepton cleaning in jet_lepton_cleaner against the previous,
+awkward-based implementation on synthetic events. Run with
+
+    python tests/bench_jet_lepton_cleaner.py [n_events] [mean_jets]
+
+in the columnar sandbox.
+"""
+
+import os
+import sys
+import time
+import types
+import tracemalloc
+
+import numpy as np
+import awkward as ak
+
+base = os.path.normpath(os.path.join(os.path.abspath(__file__), "../.."))
+sys.path.append(base)
+
+from h4l.util import lv_xyzt, lv_mass  # noqa
+from h4l.calibration.jets import jet_lepton_cleaner  # noqa
+
+
+def make_events(rng, n_events, mean_jets):
+    def objects(mean, mass, **extra):
+        counts = rng.poisson(mean, n_events)
+        n = counts.sum()
+        fields = {
+            "pt": rng.uniform(5.0, 100.0, n).astype(np.float32),
+            "eta": rng.uniform(-2.5, 2.5, n).astype(np.float32),
+            "phi": rng.uniform(-np.pi, np.pi, n).astype(np.float32),
+            "mass": (np.full(n, mass) if mass is not None else rng.uniform(0.0, 15.0, n)).astype(np.float32),
+        }
+        fields.update({key: func(n, counts) for key, func in extra.items()})
+        return counts, ak.unflatten(ak.zip(fields), counts)
+
+    n_ele, electrons = objects(2.0, 0.000511)
+    n_mu, muons = objects(2.0, 0.10566)
+
+    def lep_idx(n_lep, fraction):
+        def func(n, counts):
+            # local lepton index or -1 (also out-of-range indices are tolerated)
+            n_lep_per_jet = np.repeat(n_lep, counts)
+            idx = (rng.uniform(size=n) * np.maximum(n_lep_per_jet, 1)).astype(np.int16)
+            return np.where((rng.uniform(size=n) < fraction) & (n_lep_per_jet > 0), idx, -1)
+        return func
+
+    _, jets = objects(
+        mean_jets,
+        None,
+        rawFactor=lambda n, _: rng.uniform(0.0, 0.3, n).astype(np.float32),
+        chEmEF=lambda n, _: rng.uniform(0.0, 1.0, n).astype(np.float32),
+        muEF=lambda n, _: rng.uniform(0.0, 1.0, n).astype(np.float32),
+        electronIdx1=lep_idx(n_ele, 0.3),
+        electronIdx2=lep_idx(n_ele, 0.1),
+        muonIdx1=lep_idx(n_mu, 0.3),
+        muonIdx2=lep_idx(n_mu, 0.1),
+    )
+
+    return ak.zip({"Jet": jets, "Electron": electrons, "Muon": muons}, depth_limit=1)
+
+
+def clean_reference(events, tolerance=0.1):
+    # previous implementation, with the mass computed from the full three-momentum, evaluated in
+    # double precision like the compiled version (masses of cleaned jets suffer from cancellation)
+    is_float = lambda array: array.layout.content.dtype.kind == "f"  # noqa: E731
+    events = ak.zip({
+        name: ak.zip({
+            field: ak.values_astype(coll[field], np.float64) if is_float(coll[field]) else coll[field]
+            for field in coll.fields
+        })
+        for name in events.fields
+        for coll in [events[name]]
+    }, depth_limit=1)
+    jets = events.Jet
+    jet_lv = lv_xyzt(ak.zip({
+        "pt": jets.pt * (1 - jets.rawFactor),
+        "eta": jets.eta,
+        "phi": jets.phi,
+        "mass": jets.mass * (1 - jets.rawFactor),
+    }))
+
+    def matched(leptons, idx):
+        idx = ak.mask(idx, (idx >= 0) & (idx < ak.num(leptons, axis=1)))
+        return leptons[idx]
+
+    jet_leptons_types = [
+        (matched(events.Electron, jets.electronIdx1), "e"),
+        (matched(events.Electron, jets.electronIdx2), "e"),
+        (matched(events.Muon, jets.muonIdx1), "mu"),
+        (matched(events.Muon, jets.muonIdx2), "mu"),
+    ]
+    jet_pf_energies = {"mu": jet_lv.t * jets.muEF, "e": jet_lv.t * jets.chEmEF}
+
+    for jet_lepton, jet_lepton_type in jet_leptons_types:
+        lep_lv = lv_xyzt(jet_lepton)
+        cleaned = lv_xyzt(ak.zip({c: jet_lv[c] - lep_lv[c] for c in "xyzt"}))
+        jet_pf_energy = jet_pf_energies[jet_lepton_type]
+        compatible = lep_lv.t < (1 + tolerance) * jet_pf_energy
+        mass_sq = cleaned.t**2 - (cleaned.x**2 + cleaned.y**2 + cleaned.z**2)
+        cleaned_m = lv_mass(cleaned)
+        jet_m = lv_mass(jet_lv)
+        eta = lambda lv: np.arcsinh(lv.z / np.sqrt(lv.x**2 + lv.y**2))  # noqa: E731
+        dphi = (cleaned_m.phi - jet_m.phi + np.pi) % (2 * np.pi) - np.pi
+        delta_r = np.sqrt((eta(cleaned) - eta(jet_lv))**2 + dphi**2)
+        angle_small = (delta_r <= np.pi / 2) | (cleaned_m.pt < 10)
+        do_clean = ak.fill_none(compatible & (mass_sq >= -tolerance) & angle_small, False)
+        jet_lv = lv_xyzt(ak.zip({c: ak.where(do_clean, cleaned[c], jet_lv[c]) for c in "xyzt"}))
+        jet_pf_energies[jet_lepton_type] = ak.where(do_clean, jet_pf_energy - lep_lv.t, jet_pf_energy)
+
+    jet_lv = lv_mass(jet_lv)
+    return {
+        var: ak.where(np.isfinite(value), value, 0)
+        for var in ["pt", "eta", "phi", "mass"]
+        for value in [ak.fill_none(ak.nan_to_none(jet_lv[var]), 0.0)]
+    }
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = func(*args)
+    duration = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, duration, peak
+
+
+def main(n_events=100000, mean_jets=6.0):
+    rng = np.random.default_rng(42)
+    events = make_events(rng, n_events, mean_jets)
+    # the cleaner only reads the config of its instance (for the default compute_dtype, see
+    # h4l.util.compute_dtype), so call the underlying function directly
+    inst = types.SimpleNamespace(config_inst=None)
+    cleaner = lambda events: jet_lepton_cleaner.call_func(inst, events)  # noqa: E731
+
+    # warm up the jit compilation
+    cleaner(ak.copy(events[:10]))
+
+    # each run gets a fresh copy of the events, which must be left unchanged
+    inputs = ak.copy(events)
+    ref, t_ref, mem_ref = measure(clean_reference, inputs)
+    inputs = ak.copy(events)
+    new, t_new, mem_new = measure(cleaner, inputs)
+    for name in events.fields:
+        for field in events[name].fields:
+            np.testing.assert_array_equal(
+                ak.to_numpy(ak.flatten(inputs[name][field])),
+                ak.to_numpy(ak.flatten(events[name][field])),
+                err_msg=f"input {name}.{field} changed",
+            )
+
+    for var in ["pt", "eta", "phi", "mass"]:
+        np.testing.assert_allclose(
+            ak.to_numpy(ak.flatten(new.Jet[var])),
+            ak.to_numpy(ak.flatten(ref[var])).astype(np.float32),
+            rtol=1e-4,
+            atol=1e-3,
+            err_msg=var,
+        )
+
+    print(f"events: {n_events}, mean jets: {mean_jets}")
+    print(f"awkward : {t_ref:8.3f} s, peak memory {mem_ref / 1024**2:8.1f} MB")
+    print(f"compiled: {t_new:8.3f} s, peak memory {mem_new / 1024**2:8.1f} MB")
+    print(f"speed-up: {t_ref / t_new:.1f}x, memory ratio: {mem_ref / max(mem_new, 1):.1f}x")
+
+
+if __name__ == "__main__":
+    main(*[float(arg) if i else int(arg) for i, arg in enumerate(sys.argv[1:])])
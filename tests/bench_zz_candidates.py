@@ -0,0 +1,224 @@
+# coding: utf-8
+
+"""
+Benchmark of the compiled ZZ candidate builder against the awkward-based reference helpers on
+synthetic events with high lepton multiplicity, and cross-check of the compiled best-candidate
+arbitration against a brute-force python implementation. Run with
+
+    python tests/bench_zz_candidates.py [n_events] [mean_leptons]
+
+in the columnar sandbox.
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import awkward as ak
+
+base = os.path.normpath(os.path.join(os.path.abspath(__file__), "../.."))
+sys.path.append(base)
+
+from h4l.util import build_zz_candidates, best_zz_candidate, build_2e2mu, build_4sf, Z_MASS  # noqa
+
+
+def make_leptons(rng, n_events, mean, mass):
+    from coffea.nanoevents.methods import vector
+
+    counts = rng.poisson(mean, n_events)
+    n = counts.sum()
+    leptons = ak.zip(
+        {
+            "pt": rng.uniform(5.0, 100.0, n).astype(np.float32),
+            "eta": rng.uniform(-2.5, 2.5, n).astype(np.float32),
+            "phi": rng.uniform(-np.pi, np.pi, n).astype(np.float32),
+            "mass": np.full(n, mass, dtype=np.float32),
+            "charge": rng.choice([-1, 1], n).astype(np.int32),
+        },
+        with_name="PtEtaPhiMLorentzVector",
+        behavior=vector.behavior,
+    )
+    return ak.unflatten(leptons, counts)
+
+
+def as_double(leptons):
+    # copy of leptons with double precision kinematics
+    return ak.zip(
+        {f: (leptons[f] if f == "charge" else ak.values_astype(leptons[f], np.float64)) for f in leptons.fields},
+        with_name="PtEtaPhiMLorentzVector",
+        behavior=leptons.behavior,
+    )
+
+
+def build_reference(electrons, muons):
+    ele_plus = electrons[electrons.charge > 0]
+    ele_minus = electrons[electrons.charge < 0]
+    mu_plus = muons[muons.charge > 0]
+    mu_minus = muons[muons.charge < 0]
+    return ak.concatenate([
+        build_2e2mu(mu_plus, mu_minus, ele_plus, ele_minus),
+        build_4sf(ele_plus, ele_minus),
+        build_4sf(mu_plus, mu_minus),
+    ], axis=1)
+
+
+def reference_leptons(electrons, muons):
+    # flavors and local indices of the leptons forming z1 and z2 of all candidates, in the order and
+    # with the z1/z2 assignment of build_reference
+    def tag(leptons, flavor):
+        leptons = ak.with_field(leptons, ak.local_index(leptons, axis=1), "idx")
+        return ak.with_field(leptons, ak.full_like(leptons.charge, flavor), "flavor")
+
+    def assign(a1, a2, b1, b2):
+        # leptons of the pair (a1, a2) form z1 if it is closer to the Z mass, else (b1, b2)
+        is_a = abs((a1 + a2).mass - Z_MASS) < abs((b1 + b2).mass - Z_MASS)
+        pick = lambda x, y, field: ak.where(is_a, x[field], y[field])
+        return {
+            "z1": (pick(a1, b1, "flavor"), pick(a1, b1, "idx"), pick(a2, b2, "idx")),
+            "z2": (pick(b1, a1, "flavor"), pick(b1, a1, "idx"), pick(b2, a2, "idx")),
+        }
+
+    def build_4sf(plus, minus):
+        pp, mm = ak.unzip(ak.cartesian([ak.combinations(plus, 2), ak.combinations(minus, 2)], axis=1))
+        return [
+            assign(pp["0"], mm["0"], pp["1"], mm["1"]),
+            assign(pp["0"], mm["1"], pp["1"], mm["0"]),
+        ]
+
+    electrons, muons = tag(electrons, 11), tag(muons, 13)
+    ele_plus, ele_minus = electrons[electrons.charge > 0], electrons[electrons.charge < 0]
+    mu_plus, mu_minus = muons[muons.charge > 0], muons[muons.charge < 0]
+    mu1, mu2, e1, e2 = ak.unzip(ak.cartesian([mu_plus, mu_minus, ele_plus, ele_minus]))
+    parts = [assign(mu1, mu2, e1, e2), *build_4sf(ele_plus, ele_minus), *build_4sf(mu_plus, mu_minus)]
+
+    return {
+        z: {
+            field: ak.concatenate([part[z][i] for part in parts], axis=1)
+            for i, field in enumerate(["flavor", "lep_idx1", "lep_idx2"])
+        }
+        for z in ["z1", "z2"]
+    }
+
+
+def best_reference(electrons, muons, min_delta_r=0.02, min_os_mass=4.0):
+    # brute-force HZZ arbitration in python on the candidates enumerated by build_zz_candidates,
+    # returning the index of the best candidate and the highest level reached per event
+    cands = build_zz_candidates(electrons, muons, dtype=np.float64)
+    leptons = {11: ak.to_list(electrons), 13: ak.to_list(muons)}
+
+    def p4(lep):
+        pz = lep["pt"] * np.sinh(lep["eta"])
+        return np.array([
+            lep["pt"] * np.cos(lep["phi"]),
+            lep["pt"] * np.sin(lep["phi"]),
+            pz,
+            np.sqrt(lep["pt"]**2 + pz**2 + lep["mass"]**2),
+        ])
+
+    def mass(*leps):
+        px, py, pz, e = sum(p4(lep) for lep in leps)
+        return np.sqrt(max(e**2 - px**2 - py**2 - pz**2, 0.0))
+
+    def delta_r(l1, l2):
+        dphi = (l1["phi"] - l2["phi"] + np.pi) % (2 * np.pi) - np.pi
+        return np.sqrt((l1["eta"] - l2["eta"])**2 + dphi**2)
+
+    best, level = [], []
+    for i, event_cands in enumerate(ak.to_list(cands)):
+        best_key, best_index, max_level = None, -1, 0
+        for k, (z1, z2) in enumerate(zip(event_cands["z1"], event_cands["z2"])):
+            leps = [
+                leptons[z["flavor"]][i][z[idx]]
+                for z in (z1, z2)
+                for idx in ("lep_idx1", "lep_idx2")
+            ]
+            pairs = [(leps[x], leps[y]) for x in range(4) for y in range(x + 1, 4)]
+            if any(delta_r(l1, l2) <= min_delta_r for l1, l2 in pairs):
+                continue
+            if any(mass(l1, l2) <= min_os_mass for l1, l2 in pairs if l1["charge"] != l2["charge"]):
+                continue
+            m_z1, m_z2 = mass(*leps[:2]), mass(*leps[2:])
+            if not (12.0 < m_z1 < 120.0 and 12.0 < m_z2 < 120.0):
+                continue
+            max_level = max(max_level, 1)
+            if m_z1 <= 40.0:
+                continue
+            max_level = max(max_level, 2)
+            if mass(*leps) <= 70.0:
+                continue
+            if z1["flavor"] == z2["flavor"]:
+                # alternative pairing of the z1 leptons with the opposite-sign lepton of z2
+                l3, l4 = leps[2:] if leps[0]["charge"] != leps[2]["charge"] else leps[:1:-1]
+                m_za, m_zb = sorted([mass(leps[0], l3), mass(leps[1], l4)], key=lambda m: abs(m - Z_MASS))
+                if abs(m_za - Z_MASS) < abs(m_z1 - Z_MASS) and m_zb < 12.0:
+                    continue
+            max_level = 3
+            key = (abs(m_z1 - Z_MASS), -(leps[2]["pt"] + leps[3]["pt"]))
+            if best_key is None or key < best_key:
+                best_key, best_index = key, k
+        best.append(best_index)
+        level.append(max_level)
+
+    return np.array(best), np.array(level)
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = func(*args)
+    duration = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, duration, peak
+
+
+def main(n_events=100000, mean_leptons=4.0):
+    rng = np.random.default_rng(42)
+    electrons = make_leptons(rng, n_events, mean_leptons, 0.000511)
+    muons = make_leptons(rng, n_events, mean_leptons, 0.10566)
+
+    # warm up the jit compilation
+    build_zz_candidates(electrons[:10], muons[:10])
+
+    ref, t_ref, mem_ref = measure(build_reference, electrons, muons)
+    new, t_new, mem_new = measure(build_zz_candidates, electrons, muons)
+
+    # compare results in double precision, in which the float32 rounding of masses of light pairs
+    # (up to ~0.04 GeV in the reference) vanishes, so that the z1/z2 assignment is unambiguous
+    electrons, muons = as_double(electrons), as_double(muons)
+    ref = build_reference(electrons, muons)
+    ref_leptons = reference_leptons(electrons, muons)
+    new = build_zz_candidates(electrons, muons, dtype=np.float64)
+    assert ak.all(ak.num(ref.zz, axis=1) == ak.num(new.zz, axis=1))
+    flat = lambda array: ak.to_numpy(ak.flatten(array))
+    for z in ["z1", "z2", "zz"]:
+        for field in ["pt", "eta", "phi", "mass"]:
+            np.testing.assert_allclose(
+                flat(getattr(new[z], field)),
+                flat(getattr(ref[z], field)),
+                rtol=0,
+                atol=1e-2,
+                err_msg=f"{z}.{field}",
+            )
+    for z in ["z1", "z2"]:
+        for field in ["flavor", "lep_idx1", "lep_idx2"]:
+            np.testing.assert_array_equal(flat(new[z][field]), flat(ref_leptons[z][field]), err_msg=f"{z}.{field}")
+
+    # brute-force check of the best-candidate arbitration
+    n_check = min(n_events, 5000)
+    best = best_zz_candidate(electrons[:n_check], muons[:n_check], dtype=np.float64)
+    ref_best, ref_level = best_reference(electrons[:n_check], muons[:n_check])
+    np.testing.assert_array_equal(ak.to_numpy(best.level), ref_level)
+    np.testing.assert_array_equal(ak.to_numpy(best.index), ref_best)
+
+    n_cands = int(ak.sum(ak.num(new.zz, axis=1)))
+    print(f"events: {n_events}, mean leptons per flavor: {mean_leptons}, candidates: {n_cands}")
+    print(f"awkward : {t_ref:8.3f} s, peak memory {mem_ref / 1024**2:8.1f} MB")
+    print(f"compiled: {t_new:8.3f} s, peak memory {mem_new / 1024**2:8.1f} MB")
+    print(f"speed-up: {t_ref / t_new:.1f}x, memory ratio: {mem_ref / max(mem_new, 1):.1f}x")
+
+
+if __name__ == "__main__":
+    main(*[float(arg) if i else int(arg) for i, arg in enumerate(sys.argv[1:])])
@@ -0,0 +1,82 @@
+# coding: utf-8
+
+
+__all__ = ["UtilTest"]
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import awkward as ak
+
+from h4l.util import jagged_buffer, jagged_ufunc, instrument_step
+
+
+class UtilTest(unittest.TestCase):
+
+    def make_jets(self):
+        pt = ak.Array([[10.0, 40.0, 25.0], [], [60.0, 5.0]])
+        return ak.zip({"pt": pt, "eta": ak.zeros_like(pt)})
+
+    def test_jagged_buffer(self):
+        jets = self.make_jets()
+        parent_pt = jets[1:].pt
+        values, buffer = jagged_buffer(jets.pt)
+        buffer *= 2
+        self.assertEqual(values.tolist(), [[20.0, 80.0, 50.0], [], [120.0, 10.0]])
+        self.assertEqual(jets.pt.tolist(), [[10.0, 40.0, 25.0], [], [60.0, 5.0]])
+        self.assertEqual(parent_pt.tolist(), [[], [60.0, 5.0]])
+
+        # explicit in-place changes of a buffer allocated here
+        pt = ak.Array([[1.0, 2.0], [3.0]])
+        values, buffer = jagged_buffer(pt, inplace=True)
+        buffer += 1
+        self.assertEqual(pt.tolist(), [[2.0, 3.0], [4.0]])
+
+    def test_jagged_ufunc(self):
+        jets = self.make_jets()
+        sliced = jets[:2]
+        mask = jets.pt < 30
+
+        scaled = jagged_ufunc(jets.pt, np.multiply, 2.0, mask=mask)
+        self.assertEqual(scaled.tolist(), [[20.0, 40.0, 50.0], [], [60.0, 10.0]])
+        self.assertEqual(jets.pt.tolist(), [[10.0, 40.0, 25.0], [], [60.0, 5.0]])
+
+        # slices and their parents are unchanged
+        scaled = jagged_ufunc(sliced.pt, np.add, sliced.eta + 1)
+        self.assertEqual(scaled.tolist(), [[11.0, 41.0, 26.0], []])
+        self.assertEqual(sliced.pt.tolist(), [[10.0, 40.0, 25.0], []])
+        self.assertEqual(jets.pt.tolist(), [[10.0, 40.0, 25.0], [], [60.0, 5.0]])
+
+        # explicit in-place changes
+        pt = ak.Array([[1.0, 2.0], [3.0]])
+        jagged_ufunc(pt, np.multiply, 3.0, inplace=True)
+        self.assertEqual(pt.tolist(), [[3.0, 6.0], [9.0]])
+
+    def test_instrument_step_nested_peak(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        func = mock.Mock(cls_name="func")
+        task = mock.Mock(branch=0, local_path=lambda name: os.path.join(tmp_dir, name))
+        events = np.zeros(10)
+
+        with mock.patch.dict(os.environ, {"H4L_INSTRUMENT": "1"}):
+            with instrument_step(func, "outer", events, task=task):
+                # large allocation released before the nested step
+                buf = np.ones(8 * 1024**2 // 8)
+                del buf
+                with instrument_step(func, "inner", events, task=task):
+                    buf = np.ones(1024**2 // 8)
+                    del buf
+
+        with open(os.path.join(tmp_dir, "instrumentation_0.jsonl")) as f:
+            peaks = {record["step"]: record["peak_bytes"] for record in map(json.loads, f)}
+
+        # the nested step must neither hide the peak of the enclosing step nor include it
+        self.assertGreaterEqual(peaks["outer"], 8 * 1024**2)
+        self.assertLess(peaks["inner"], 2 * 1024**2)
+        self.assertGreaterEqual(peaks["inner"], 1024**2)
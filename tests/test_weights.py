@@ -0,0 +1,180 @@
+# coding: utf-8
+
+
+__all__ = ["WeightsTest"]
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import awkward as ak
+import law
+import order as od
+
+from columnflow.util import DotDict
+from columnflow.production.cms.electron import electron_weights as cf_electron_weights, ElectronSFConfig
+from columnflow.production.cms.muon import muon_weights as cf_muon_weights, MuonSFConfig
+
+from h4l.production.weights import BinnedCorrection, electron_weights, muon_weights
+
+
+def _binned(inputs, edges, values):
+    # multibinning node over *inputs* with clamped flow
+    return {
+        "nodetype": "multibinning",
+        "inputs": inputs,
+        "edges": edges,
+        "content": [float(v) for v in values],
+        "flow": "clamp",
+    }
+
+
+def _category(input_name, content):
+    return {
+        "nodetype": "category",
+        "input": input_name,
+        "content": [{"key": key, "value": value} for key, value in content.items()],
+    }
+
+
+def make_correction_set(rng):
+    eta_edges = [-2.5, -1.566, -1.444, 0.0, 1.444, 1.566, 2.5]
+    pt_edges = [10.0, 20.0, 35.0, 50.0, 100.0, 500.0]
+    abseta_edges = [0.0, 0.9, 1.2, 2.1, 2.4]
+    n_ele = (len(eta_edges) - 1) * (len(pt_edges) - 1)
+    n_mu = (len(abseta_edges) - 1) * (len(pt_edges) - 1)
+
+    electron = {
+        "name": "electron_id",
+        "version": 2,
+        "inputs": [
+            {"name": "year", "type": "string"},
+            {"name": "ValType", "type": "string"},
+            {"name": "WorkingPoint", "type": "string"},
+            {"name": "eta", "type": "real"},
+            {"name": "pt", "type": "real"},
+        ],
+        "output": {"name": "weight", "type": "real"},
+        "data": _category("year", {
+            "2022": _category("ValType", {
+                syst: _category("WorkingPoint", {
+                    wp: _binned(["eta", "pt"], [eta_edges, pt_edges], rng.uniform(0.8, 1.2, n_ele))
+                    for wp in ["loose", "tight"]
+                })
+                for syst in ["sf", "sfup", "sfdown"]
+            }),
+        }),
+    }
+    muon = {
+        "name": "muon_id",
+        "version": 1,
+        "inputs": [
+            {"name": "abseta", "type": "real"},
+            {"name": "pt", "type": "real"},
+            {"name": "scale_factors", "type": "string"},
+        ],
+        "output": {"name": "weight", "type": "real"},
+        "data": _category("scale_factors", {
+            syst: _binned(["abseta", "pt"], [abseta_edges, pt_edges], rng.uniform(0.8, 1.2, n_mu))
+            for syst in ["nominal", "systup", "systdown"]
+        }),
+    }
+
+    return {"schema_version": 2, "corrections": [electron, muon]}
+
+
+def make_events(rng, n_events):
+    def objects(mean, **fields):
+        counts = rng.poisson(mean, n_events)
+        n = counts.sum()
+        return ak.unflatten(ak.zip({name: func(n).astype(np.float32) for name, func in fields.items()}), counts)
+
+    electrons = objects(
+        2.0,
+        pt=lambda n: rng.exponential(30.0, n) + 5.0,
+        eta=lambda n: rng.uniform(-2.6, 2.6, n),
+        phi=lambda n: rng.uniform(-np.pi, np.pi, n),
+        deltaEtaSC=lambda n: rng.normal(0.0, 0.02, n),
+    )
+    muons = objects(
+        2.0,
+        pt=lambda n: rng.exponential(30.0, n) + 5.0,
+        eta=lambda n: rng.uniform(-2.5, 2.5, n),
+    )
+
+    return ak.zip({"Electron": electrons, "Muon": muons}, depth_limit=1)
+
+
+class WeightsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        import correctionlib.schemav2 as cs
+
+        rng = np.random.default_rng(7)
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.correction_file = os.path.join(cls.tmp_dir, "sf.json")
+        with open(cls.correction_file, "w") as f:
+            f.write(cs.CorrectionSet.model_validate(make_correction_set(rng)).model_dump_json(exclude_unset=True))
+
+        cls.events = make_events(rng, 2000)
+
+    @classmethod
+    def tearDownClass(cls):
+        law.LocalDirectoryTarget(cls.tmp_dir).remove()
+
+    def setup_producer(self, cls, **aux):
+        analysis_inst = od.Analysis("test", 1)
+        config_inst = analysis_inst.add_config(od.Campaign("test", 1))
+        config_inst.aux.update(aux)
+        dataset_inst = od.Dataset("test_mc", 1, is_data=False)
+        inst = cls(inst_dict={
+            "analysis_inst": analysis_inst,
+            "config_inst": config_inst,
+            "dataset_inst": dataset_inst,
+        })
+        files = DotDict(electron_sf=law.LocalFileTarget(self.correction_file), muon_sf=self.correction_file)
+        inst.run_setup(task=None, reqs={inst.cls_name: DotDict(external_files=DotDict(files=files))})
+        return inst
+
+    def assert_weights_equal(self, events, cf_events, weight_name):
+        for postfix in ["", "_up", "_down"]:
+            column = f"{weight_name}{postfix}"
+            np.testing.assert_array_equal(np.asarray(events[column]), np.asarray(cf_events[column]), err_msg=column)
+
+    def test_electron_weights(self):
+        working_points = [
+            "tight",
+            # multiple working points evaluated on masked, flat inputs
+            {
+                "loose": (lambda variable_map: variable_map["pt"] < 30),
+                "tight": (lambda variable_map: variable_map["pt"] >= 30),
+            },
+        ]
+        for working_point in working_points:
+            sf_config = ElectronSFConfig(correction="electron_id", campaign="2022", working_point=working_point)
+            aux = {"electron_sf": sf_config}
+            cf_inst = self.setup_producer(cf_electron_weights, **aux)
+            inst = self.setup_producer(electron_weights, **aux)
+            self.assertIsInstance(inst.electron_sf_corrector, BinnedCorrection)
+            self.assertIsNotNone(inst.electron_sf_corrector.edges)
+
+            for mask in [Ellipsis, self.events.Electron.pt > 15]:
+                cf_events = cf_inst(self.events, electron_mask=mask)
+                events = inst(self.events, electron_mask=mask)
+                self.assert_weights_equal(events, cf_events, "electron_weight")
+                self.assertFalse(np.all(np.asarray(events.electron_weight) == 1))
+
+    def test_muon_weights(self):
+        aux = {"muon_sf": MuonSFConfig(correction="muon_id", min_pt=10.0)}
+        cf_inst = self.setup_producer(cf_muon_weights, **aux)
+        inst = self.setup_producer(muon_weights, **aux)
+        self.assertIsInstance(inst.muon_sf_corrector, BinnedCorrection)
+        self.assertIsNotNone(inst.muon_sf_corrector.edges)
+
+        for mask in [Ellipsis, abs(self.events.Muon.eta) < 2.4]:
+            cf_events = cf_inst(self.events, muon_mask=mask)
+            events = inst(self.events, muon_mask=mask)
+            self.assert_weights_equal(events, cf_events, "muon_weight")
+            self.assertFalse(np.all(np.asarray(events.muon_weight) == 1))
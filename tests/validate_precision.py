@@ -0,0 +1,111 @@
+# coding: utf-8
+
+"""
+Validation of the float32 precision policy (see h4l.util.compute_dtype) against float64 on
+synthetic events. The best ZZ candidate and the ZZ observables are computed with both compute
+dtypes and, per output variable, the largest absolute and relative differences, the fraction of
+events with a different candidate, and the largest difference of the normalized distributions in
+100 bins as well as of their cumulative distributions are reported. Run with
+
+    python tests/validate_precision.py [n_events] [mean_leptons]
+
+in the columnar sandbox.
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import awkward as ak
+import order as od
+
+base = os.path.normpath(os.path.join(os.path.abspath(__file__), "../.."))
+sys.path.append(base)
+
+from h4l.util import best_zz_candidate  # noqa
+from h4l.production.zz_observables import zz_observables, zz_observables_columns  # noqa
+
+
+def make_leptons(rng, n_events, mean, mass):
+    counts = rng.poisson(mean, n_events)
+    n = counts.sum()
+    leptons = ak.zip({
+        "pt": rng.exponential(25.0, n).astype(np.float32) + 5.0,
+        "eta": rng.uniform(-2.5, 2.5, n).astype(np.float32),
+        "phi": rng.uniform(-np.pi, np.pi, n).astype(np.float32),
+        "mass": np.full(n, mass, dtype=np.float32),
+        "charge": rng.choice([-1, 1], n).astype(np.int32),
+    })
+    return ak.unflatten(leptons, counts)
+
+
+def compute(events, dtype):
+    config_inst = od.Config(name=f"validate_{dtype}", id=1, campaign=od.Campaign("validate", 1))
+    config_inst.x.compute_dtype = dtype
+
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    best = best_zz_candidate(events.Electron, events.Muon, dtype=np.dtype(dtype))
+    zz_cand = ak.zip({
+        f"{z}_{var}": ak.fill_none(best[z][var], -1)
+        for z in ["z1", "z2"]
+        for var in ["flavor", "lep_idx1", "lep_idx2"]
+    })
+    obs = zz_observables.call_func(
+        type("Producer", (), {"config_inst": config_inst})(),
+        ak.with_field(events, zz_cand, "ZZCand"),
+    )
+    duration = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    values = {
+        f"{z}_{var}": np.asarray(ak.fill_none(best[z][var], np.nan), dtype=np.float64)
+        for z in ["z1", "z2", "zz"]
+        for var in ["pt", "eta", "mass"]
+    }
+    values.update({name: np.asarray(obs[name], dtype=np.float64) for name in zz_observables_columns})
+
+    return np.asarray(best.index), values, duration, peak
+
+
+def main(n_events=200000, mean_leptons=2.5):
+    rng = np.random.default_rng(7)
+    events = ak.zip({
+        "Electron": make_leptons(rng, n_events, mean_leptons, 0.000511),
+        "Muon": make_leptons(rng, n_events, mean_leptons, 0.10566),
+    }, depth_limit=1)
+
+    # warm up the jit compilation for both dtypes
+    for dtype in ["float32", "float64"]:
+        compute(events[:10], dtype)
+
+    idx64, ref, t64, mem64 = compute(events, "float64")
+    idx32, new, t32, mem32 = compute(events, "float32")
+
+    same = (idx32 == idx64) & (idx64 >= 0)
+    print(f"events: {n_events}, with candidate: {np.sum(idx64 >= 0)}")
+    print(f"different best candidate: {np.mean(idx32 != idx64):.2e}")
+    print(f"float64: {t64:8.3f} s, peak memory {mem64 / 1024**2:8.1f} MB")
+    print(f"float32: {t32:8.3f} s, peak memory {mem32 / 1024**2:8.1f} MB")
+    print("")
+    print(f"{'variable':<16} {'max abs diff':>14} {'max rel diff':>14} {'max bin diff':>14} {'max cdf diff':>14}")
+    for name in ref:
+        a, b = ref[name][same], new[name][same]
+        diff = np.abs(a - b)
+        rel = diff / np.maximum(np.abs(a), 1e-6)
+
+        # compare normalized distributions in 100 bins spanning the float64 range
+        lo, hi = np.min(a), np.max(a)
+        h64, edges = np.histogram(a, bins=100, range=(lo, hi if hi > lo else lo + 1))
+        h32, _ = np.histogram(b, bins=edges)
+        bin_diff = np.max(np.abs(h64 - h32)) / max(len(a), 1)
+        cdf_diff = np.max(np.abs(np.cumsum(h64) - np.cumsum(h32))) / max(len(a), 1)
+
+        print(f"{name:<16} {diff.max():>14.3e} {rel.max():>14.3e} {bin_diff:>14.3e} {cdf_diff:>14.3e}")
+
+
+if __name__ == "__main__":
+    main(*[float(arg) if i else int(arg) for i, arg in enumerate(sys.argv[1:])])